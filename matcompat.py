@@ -25,12 +25,6 @@ import numpy as np
 import scipy
 import matcompat
 
-# if available import pylab (from matlibplot)
-try:
-    import matplotlib.pylab as plt
-except ImportError:
-    pass
-
 import types
 
 #does structure have attribute/field name 
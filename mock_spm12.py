@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Stand-in for run_spm12.sh to run the pipeline without the MATLAB Runtime and SPM install (benchmarks, CI)
+
+It is called like run_spm12.sh, with template_dict['matlab_cmd'] set to:
+python3 mock_spm12.py [--startup SECONDS] [--delay SECONDS] <mcr_root> script
+and nipype appending the generated m-file. Instead of evaluating MATLAB it recognizes the spm jobs of the scripts
+generated by nipype and vbm_entities_layer (version probe, ApplyTransform reorientation, NewSegment, Smooth,
+SmoothSweep, SubjectBatch and CohortBatch) and writes synthetic outputs with the names and shapes spm writes:
+Re.nii, c*Re.nii (input space), wc*Re.nii and mwc*Re.nii (TPM space, the TPM tissue volume), Re_seg8.mat and
+smoothed s* copies.
+
+--startup sleeps once per call (MATLAB Runtime startup) and --delay once per segmented subject.
+An input file name containing MOCK_FAIL fails its subject like a spm error.
+If MOCK_SPM12_LEDGER is set the seconds slept are appended to that file, to separate spm time from orchestration time
+"""
+import os, re, sys, time, shutil, argparse
+import numpy as np
+import nibabel as nib
+import scipy.io
+
+# Version printed for the nipype version probe, the spm_version of template_dict
+SPM_NAME = 'SPM12'
+SPM_RELEASE = '7771'
+
+# Input file names containing this fail their subject
+MOCK_FAIL = 'mock_fail'
+
+# Patterns of the jobs of a script, run in the order they appear
+REORIENT = re.compile(r"infile = '(?P<infile>[^']+)';\s*outfile = '(?P<outfile>[^']+)';?")
+SEGMENT = re.compile(
+    r"(?P<batch>\w+\{\d+\})\.spm\.(?:spatial\.preproc|tools\.preproc8)\.channel(?:\(1\))?\.vols = (?P<vols>\{.*?\});",
+    re.DOTALL)
+SMOOTH = re.compile(r"(?P<batch>\w+\{\d+\})\.spm\.spatial\.smooth\.data = (?P<data>\{.*?\}|[^;\n]+);", re.DOTALL)
+SMOOTH_DEPENDENCY = re.compile(r"smooth\.data\(\d+\) = cfg_dep\('Segment: (?P<map>m?wc)(?P<tissue>\d) Images'")
+SWEEP = re.compile(r"vbm_sweep_files = (?P<data>\{.*?\}|[^;\n]+);", re.DOTALL)
+SMOOTH_FILES = re.compile(r"vbm_smooth_files\{(?P<n>\d+)\} = (?P<data>\{.*?\});", re.DOTALL)
+STATUS = re.compile(r"vbm_fid = fopen\('(?P<file>[^']+)', 'w'\);")
+
+
+class SubjectError(Exception):
+    pass
+
+
+def cell_files(cell):
+    """Returns the file names of a matlab cell array of 'file,1' strings"""
+    return [each.split(',')[0] for each in re.findall(r"'([^']+)'", cell)]
+
+
+def ledger(seconds):
+    time.sleep(seconds)
+    if seconds and os.environ.get('MOCK_SPM12_LEDGER'):
+        with open(os.environ['MOCK_SPM12_LEDGER'], 'a') as fp:
+            fp.write('%f\n' % seconds)
+
+
+def reorient(infile, outfile, transform_file):
+    if MOCK_FAIL in os.path.basename(infile):
+        raise SubjectError('mock spm failure on ' + infile)
+    img = nib.load(infile)
+    try:
+        transform = scipy.io.loadmat(transform_file)['M']
+    except (OSError, NotImplementedError, ValueError, KeyError):
+        # missing or v7.3 (hdf5) mat file, the reorientation keeps the affine
+        transform = np.eye(4)
+    out_img = nib.Nifti1Image(np.asanyarray(img.dataobj), transform.dot(img.affine), img.header)
+    nib.save(out_img, outfile)
+
+
+def job_region(script, position):
+    """Returns the part of the script between the spm_jobman runs around position, the settings of the job at position"""
+    start = script.rfind("spm_jobman('run'", 0, position)
+    end = script.find("spm_jobman('run'", position)
+    return script[max(start, 0):end if end >= 0 else len(script)]
+
+
+def segment(job, delay):
+    """Writes the outputs of a NewSegment job, job is the part of the script with its settings (job_region)"""
+    out = dict()
+    for vol in cell_files(SEGMENT.search(job).group('vols')):
+        pth, name = os.path.split(vol)
+        base = os.path.splitext(name)[0]
+        if MOCK_FAIL in base or not os.path.isfile(vol):
+            raise SubjectError('mock spm failure on ' + vol)
+        ledger(delay)
+        img = nib.load(vol)
+        tpm_files = dict(re.findall(r"tissue\((\d)\)\.tpm = \{\.*\s*'([^',]+),\d+'", job))
+        tpm = nib.load(tpm_files.get('1', ''))
+        for tissue in sorted(tpm_files):
+            native = re.search(r"tissue\(%s\)\.native\(1\) = (\d)" % tissue, job)
+            warped = re.findall(r"tissue\(%s\)\.warped\((\d)\) = (\d)" % tissue, job)
+            warped = dict(warped)
+            if native and native.group(1) == '1':
+                nib.save(nib.Nifti1Image(np.zeros(img.shape[:3], np.uint8), img.affine),
+                         os.path.join(pth, 'c%s%s.nii' % (tissue, base)))
+            data = np.asarray(tpm.dataobj[..., int(tissue) - 1], dtype=np.float32)
+            for index, prefix in (('1', 'wc'), ('2', 'mwc')):
+                if warped.get(index) == '1':
+                    nib.save(nib.Nifti1Image(data, tpm.affine),
+                             os.path.join(pth, '%s%s%s.nii' % (prefix, tissue, base)))
+        scipy.io.savemat(os.path.join(pth, base + '_seg8.mat'), {'image': vol, 'tpm': tpm.get_filename()})
+        out[vol] = base
+    return out
+
+
+def smooth(files, prefixes):
+    for file in files:
+        if not os.path.isfile(file):
+            raise SubjectError('mock spm cannot smooth missing ' + file)
+        for prefix in prefixes:
+            shutil.copyfile(file, os.path.join(os.path.dirname(file), prefix + os.path.basename(file)))
+
+
+def run_script(script, delay):
+    """Runs the jobs of a script in the order they appear, failed subjects of a cohort batch are written to its status file"""
+    jobs = sorted(
+        [(m.start(), 'reorient', m) for m in REORIENT.finditer(script)] +
+        [(m.start(), 'segment', m) for m in SEGMENT.finditer(script)] +
+        [(m.start(), 'smooth', m) for m in SMOOTH.finditer(script)] +
+        [(m.start(), 'dependency', m) for m in list(SMOOTH_DEPENDENCY.finditer(script))[:1]] +
+        [(m.start(), 'sweep', m) for m in SWEEP.finditer(script)] +
+        [(m.start(), 'status', m) for m in STATUS.finditer(script)],
+        key=lambda job: job[0])
+    prefix = re.search(r"smooth\.prefix = '([^']*)'", script)
+    prefixes = [prefix.group(1) if prefix else 's']
+    sweep_prefixes = re.search(r"vbm_sweep_prefix = (\{.*?\});", script)
+    if sweep_prefixes:
+        sweep_prefixes = re.findall(r"'([^']*)'", sweep_prefixes.group(1))
+    smooth_files = {int(m.group('n')): cell_files(m.group('data')) for m in SMOOTH_FILES.finditer(script)}
+    cohort = bool(smooth_files)
+
+    # subject of each reoriented file, in the order of a cohort batch
+    subjects, failed, segmented = dict(), dict(), list()
+    for position, kind, match in jobs:
+        if kind == 'reorient':
+            subject = len(subjects) + 1
+            subjects[match.group('outfile')] = subject
+            try:
+                reorient(match.group('infile'), match.group('outfile'),
+                         re.search(r"transform = load\('([^']+)'\)", script[position:]).group(1))
+            except SubjectError as e:
+                if not cohort:
+                    raise
+                failed[subject] = str(e)
+        elif kind == 'segment':
+            vols = cell_files(match.group('vols'))
+            subject = subjects.get(vols[0])
+            if subject in failed:
+                continue
+            try:
+                segmented.extend(segment(job_region(script, position), delay).items())
+            except SubjectError as e:
+                if not cohort:
+                    raise
+                failed[subject] = str(e)
+        elif kind == 'dependency':
+            # smoothing of the wc*, mwc* images of the segmentation of the batch (cfg_dep)
+            smooth([
+                os.path.join(os.path.dirname(vol), '%s%s%s.nii' % (m.group('map'), m.group('tissue'), base))
+                for vol, base in segmented for m in SMOOTH_DEPENDENCY.finditer(script)
+            ], prefixes)
+        elif kind in ('smooth', 'sweep'):
+            data = match.group('data')
+            if data.startswith('{'):
+                files = cell_files(data)
+            elif data.startswith('vertcat(vbm_smooth_files'):
+                files = [file for n in sorted(smooth_files) if n not in failed for file in smooth_files[n]]
+            elif data.startswith('vbm_smooth_files{vbm_n}'):
+                # per subject fallback after a failed smoothing of all subjects, not reached here
+                continue
+            else:
+                files = list()
+            smooth(files, sweep_prefixes if kind == 'sweep' else prefixes)
+        elif kind == 'status':
+            with open(match.group('file'), 'w') as fp:
+                for subject in range(1, len(smooth_files) + 1):
+                    fp.write('%d\t%s\n' % (subject in failed, failed.get(subject, '')))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='run_spm12.sh stand-in writing synthetic spm outputs')
+    parser.add_argument('--startup', type=float, default=0, help='seconds slept per call, as the MATLAB Runtime startup')
+    parser.add_argument('--delay', type=float, default=0, help='seconds slept per segmented subject')
+    parser.add_argument('mcr_root')
+    parser.add_argument('mode', choices=['script'])
+    parser.add_argument('script_file')
+    args = parser.parse_args(argv)
+
+    with open(args.script_file) as fp:
+        script = fp.read()
+    ledger(args.startup)
+
+    if 'NIPYPE path' in script:
+        print('NIPYPE path:/opt/spm12/fsroot/spm/spm12|name:%s|release:%s' % (SPM_NAME, SPM_RELEASE))
+        return 0
+    try:
+        run_script(script, args.delay)
+    except Exception as e:
+        sys.stderr.write('MATLAB code threw an exception:\n%s\n' % str(e))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
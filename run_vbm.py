@@ -47,18 +47,15 @@ def stdchannel_redirected(stdchannel, dest_filename):
 
 import ujson as json
 import warnings, os, glob, sys
-import nibabel as nib
-import numpy as np, scipy.io, spm_matrix as s
 
 with warnings.catch_warnings():
     warnings.filterwarnings("ignore")
-# Load Nipype spm interface #
-from nipype.interfaces import spm
-import vbm_use_cases_layer,vbm_standalone_use_cases_layer
-
-#Stop printing nipype.workflow info to stdout
-from nipype import logging
-logging.getLogger('nipype.workflow').setLevel('CRITICAL')
+# nipype, nibabel, scipy and the use case layers are imported by the functions that use them,
+# so that importing this module (every coinstac call, invalid inputs included) stays fast.
+# The budget of this import is checked by vbm_microbenchmark.py --only import_run_vbm and test/test_import_time.py
+import spm_worker
+import vbm_timing
+import vbm_cache
 
 #Create a dictionary to store all paths to softwares,templates & store parameters, names of output files
 
@@ -116,6 +113,60 @@ template_dict = {
         1,
     'implicit_masking':
     False,
+    'max_workers':
+    1,
+    'spm_worker':
+    False,
+    'spm_worker_mock':
+    False,
+    'spm_worker_socket':
+    None,
+    'spm_batch':
+    'node',
+    'spm_batch_size':
+    10,
+    'result_cache_dir':
+    None,
+    'result_cache_max_gb':
+    20,
+    'rerun':
+    False,
+    'stage_manifest_name':
+    'vbm_stages.json',
+    'ledger_filename':
+    'vbm_ledger.sqlite',
+    'output_profile':
+    'full',
+    'output_storage':
+    'nii',
+    'storage_threads':
+    4,
+    'output_archive':
+    'zip',
+    'covariates_layout':
+    'copy',
+    'coinstac_cache':
+    None,
+    'smooth_backend':
+    'spm',
+    'smooth_threads':
+    4,
+    'timings_filename':
+    'vbm_timings.json',
+    'trace_filename':
+    'vbm_trace.json',
+    'metrics_filename':
+    'vbm_metrics.json',
+    'profile_dir':
+    None,
+    'spm_version_cache':
+    None,
+    'spm_version_refresh':
+    False,
+    'mcr_cache':
+    True,
+    'mcr_cache_dir':
+    None,
     'correlation_value':
     0.90,
     'vbm_output_dirname':
@@ -188,9 +239,55 @@ This file is used to :
 
 transf_mat_path is the path to the transformation matrix used in running the reorient step of the pipeline
 scan_type is the type of structural scans on which is accepted by this pipeline
-FWHM_SMOOTH is the full width half maximum smoothing kernel value in mm in x,y,z directions
+FWHM_SMOOTH is the full width half maximum smoothing kernel value in mm in x,y,z directions, or a list of such kernels for a smoothing sweep.
+The first kernel writes s* images as usual, each other kernel of a sweep writes images prefixed with its size, ex: s8wc1Re.nii, s8mwc1Re.nii
 vbm_output_dirname is the name of the output directory to which the outputs from this pipeline are written to
 vbm_qc_filename is the name of the VBM quality control text file , which is placed in vbm_output_dirname
+max_workers is the number of subjects pre-processed in parallel, each in its own worker process. Default 1 runs the subjects serially
+spm_worker=True keeps the MATLAB Runtime loaded in max_workers persistent spm workers (spm_worker.py) instead of starting it for every spm job
+spm_worker_mock=True replaces the MATLAB Runtime of these workers by the mock worker, for testing without MATLAB
+spm_worker_socket is set at start to the socket of the workers, the spm interfaces (vbm_entities_layer.use_spm) send their jobs to it
+spm_batch selects how spm jobs are run: 'node' runs the nipype workflow and smooth_images (one spm job per step),
+'subject' runs reorientation, segmentation and smoothing of wc*, mwc* images of a subject as one spm batch (vbm_entities_layer.SubjectBatch),
+'cohort' runs spm_batch_size subjects stage by stage (all reorientations, all segmentations, one smoothing) in one matlab run (vbm_entities_layer.CohortBatch)
+spm_batch_size is the number of subjects in one cohort batch, a failed subject does not fail the other subjects of its batch
+result_cache_dir is the directory of the persistent result cache (vbm_cache.py), None disables it. Subjects whose scan, TPM, spm version
+and output parameters match a cached entry are restored from it instead of running spm
+result_cache_max_gb is the size limit of the result cache, least recently used entries are evicted at the end of each run
+rerun=True reuses the outputs of a previous run in the same output directory and only recomputes the stages (reorient, segment, smooth,
+QC, render, file output) whose inputs or parameters changed, ex: changing FWHM_SMOOTH re-runs smoothing and QC on the existing wc*, mwc* images
+stage_manifest_name is the file in which each subject's anat directory records the stage keys of its last run (vbm_cache.stage_keys),
+the one beside the ledger records those of the last file output
+ledger_filename is the SQLite ledger in the output directory with the state, stage reached, correlation value, error and wall time of each
+subject (vbm_ledger.py). A run in the same output directory skips the subjects done whose stage keys did not change and outputs still exist
+output_profile selects the maps written by the segmentation, smoothed, listed in the covariates files and archived
+(vbm_entities_layer.OUTPUT_PROFILES): 'minimal' writes c1, c2, smwc1, smwc2 (with wc1, mwc1, mwc2, swc1 of the QC and the
+display image), 'standard' grey matter, white matter and CSF maps and 'full' the maps of all six tissues
+output_storage selects how the images of vbm_spm12 are kept (vbm_storage.py): 'nii' as written by spm, 'nii.gz' gzip compressed,
+'int16.nii.gz' and 'uint8.nii.gz' with the tissue maps scaled to 16/8 bit integers and compressed. Images are compressed by
+storage_threads threads in the background while the next subject is in spm
+output_archive='zip' zips the output directory as download_outputs (vbm_archive.py): the files of each subject are appended
+to the zip by storage_threads threads once it is done, a restarted run resumes the zip. 'none' returns the directory itself
+covariates_layout='copy' copies the image of each subject to the covariates directory of each type, 'link' hard links it
+(vbm_spm12_file_output.link_file, a reflink or symbolic link across filesystems), the zip stores linked files once
+metrics_filename records the bytes each subject wrote to its output directory and those DataSink hard linked into it
+The input scan of each subject is cloned (reflink) or copied to its output directory, or decompressed for .nii.gz inputs,
+without decoding the image (vbm_storage.stage_input), the outputs never share the file of an input. metrics_filename records how it was staged and the copies it wrote
+coinstac_cache is the cache field of the coinstac input, run_pipeline returns in it the record of the run (vbm_cache.coinstac_record),
+so that the next run only hashes and pre-processes new or changed covariate entries and only copies and archives their outputs
+smooth_backend selects what smooths the wc*, mwc* images: 'spm' runs spm.Smooth, 'python' runs the numpy/scipy port of spm_smooth (spm_smooth.py)
+in smooth_threads threads, which skips a MATLAB start per subject. Its outputs match spm.Smooth within spm_smooth.TOLERANCE
+timings_filename is the file in the output directory with the wall and cpu time of every stage of every subject (vbm_timing.py),
+trace_filename has the same timings as Chrome trace events and a summary per stage is appended to log_filename
+metrics_filename lists the peak RSS, cpu time and read/written bytes of the spm (MATLAB Runtime) processes of each subject,
+the jobs run by persistent spm workers included (worker_jobs)
+profile_dir is the directory of the cProfile (.pstats) and tracemalloc profiles of the python stages (vbm_timing.PROFILED_STAGES), None disables profiling
+spm_version_cache is the json file keeping the spm version found at a previous start (vbm_cache.spm_info), None probes spm at every start.
+It is probed again when run_spm12.sh, the MCR root or the spm CTF change, or when spm_version_refresh=True
+mcr_cache=True gives each of the max_workers worker slots its own MATLAB Runtime component cache (MCR_CACHE_ROOT), copied from the one
+extracted when the image was built, on /dev/shm when it has room (vbm_cache.prepare_mcr_cache). mcr_cache_dir is set to their directory
+at start, None when the image has no extracted cache or /dev/shm has no room (the MATLAB Runtime default location is used),
+launches with a cold and a warm cache are listed apart in metrics_filename
 
 For nifti files , it is assumed that they are T1w (T1 weighted) type of scans
 FWHM_SMOOTH is an optional parameter that can be passed as json in args['input']['opts']
@@ -207,29 +304,48 @@ with warnings.catch_warnings():
 
 def software_check():
     """This function returns the spm standalone version installed inside the docker
+    It is read from spm_version_cache unless the spm install of matlab_cmd changed (vbm_cache.spm_info)
     """
-    spm.SPMCommand.set_mlab_paths(
-        matlab_cmd=template_dict['matlab_cmd'], use_mcr=True)
-    return (spm.SPMCommand().version)
+    # Load the spm interfaces of the pipeline #
+    import vbm_entities_layer
+    #Stop printing nipype.workflow info to stdout
+    from nipype import logging
+    logging.getLogger('nipype.workflow').setLevel('CRITICAL')
+
+    # Sets the matlab_cmd of the spm interfaces, or the socket of the spm workers that run their jobs,
+    # MATLAB only starts when the version is not cached
+    vbm_entities_layer.use_spm(template_dict['matlab_cmd'], template_dict['spm_worker_socket'])
+    vbm_cache.spm_info(template_dict['matlab_cmd'], template_dict['spm_version_cache'],
+                       vbm_entities_layer.spm_cmd(template_dict['matlab_cmd']), template_dict['spm_version_refresh'])
+    return (vbm_entities_layer.SPMCommand().version)
 
 def convert_reorientparams_save_to_mat_script():
+    """This function writes the reorientation parameters as the matrix M of transf_mat_path
+    The file is left as it is when it already holds the same matrix, so that its mtime only changes with the parameters
+    """
+    import numpy as np, scipy.io, spm_matrix as s
     try:
         pi = 22 / 7
-        scipy.io.savemat('/computation/transform.mat',
-                         mdict={'M': np.around(s.spm_matrix([template_dict['options_reorient_params_x_mm'],
-                                                             template_dict['options_reorient_params_y_mm'],
-                                                             template_dict['options_reorient_params_z_mm'],
-                                                             template_dict['options_reorient_params_pitch'] * (
-                                                                         pi / 180),
-                                                             template_dict['options_reorient_params_roll'] * (pi / 180),
-                                                             template_dict['options_reorient_params_yaw'] * (pi / 180),
-                                                             template_dict['options_reorient_params_x_scaling'],
-                                                             template_dict['options_reorient_params_y_scaling'],
-                                                             template_dict['options_reorient_params_z_scaling'],
-                                                             template_dict['options_reorient_params_x_affine'],
-                                                             template_dict['options_reorient_params_y_affine'],
-                                                             template_dict['options_reorient_params_z_affine']], 1),
-                                               decimals=4)[0]})
+        M = np.around(s.spm_matrix([template_dict['options_reorient_params_x_mm'],
+                                    template_dict['options_reorient_params_y_mm'],
+                                    template_dict['options_reorient_params_z_mm'],
+                                    template_dict['options_reorient_params_pitch'] * (pi / 180),
+                                    template_dict['options_reorient_params_roll'] * (pi / 180),
+                                    template_dict['options_reorient_params_yaw'] * (pi / 180),
+                                    template_dict['options_reorient_params_x_scaling'],
+                                    template_dict['options_reorient_params_y_scaling'],
+                                    template_dict['options_reorient_params_z_scaling'],
+                                    template_dict['options_reorient_params_x_affine'],
+                                    template_dict['options_reorient_params_y_affine'],
+                                    template_dict['options_reorient_params_z_affine']], 1),
+                      decimals=4)[0]
+        if os.path.isfile(template_dict['transf_mat_path']):
+            try:
+                if np.array_equal(scipy.io.loadmat(template_dict['transf_mat_path'])['M'], M):
+                    return
+            except (ValueError, KeyError, OSError):
+                pass
+        scipy.io.savemat(template_dict['transf_mat_path'], mdict={'M': M})
     except Exception as e:
         sys.stderr.write('Unable to convert reorientation params to transform.mat Error_log:'+str(e)+str(traceback.format_exc()))
 
@@ -237,12 +353,19 @@ def convert_reorientparams_save_to_mat_script():
 def args_parser(args):
     """ This function extracts options from arguments
     """
+    # Start from the first kernel if a previous run set a smoothing sweep
+    if isinstance(template_dict['FWHM_SMOOTH'][0], list):
+        template_dict['FWHM_SMOOTH'] = template_dict['FWHM_SMOOTH'][0]
     if 'options_smoothing_x_mm' in args['input']:
          template_dict['FWHM_SMOOTH'][0]= float(args['input']['options_smoothing_x_mm'])
     if 'options_smoothing_y_mm' in args['input']:
          template_dict['FWHM_SMOOTH'][1]= float(args['input']['options_smoothing_y_mm'])
     if 'options_smoothing_z_mm' in args['input']:
         template_dict['FWHM_SMOOTH'][2] = float(args['input']['options_smoothing_z_mm'])
+    if 'options_smoothing_fwhm_sweep' in args['input'] and args['input']['options_smoothing_fwhm_sweep']:
+        template_dict['FWHM_SMOOTH'] = [template_dict['FWHM_SMOOTH']] + [
+            [float(fwhm)] * 3 for fwhm in args['input']['options_smoothing_fwhm_sweep']
+            if [float(fwhm)] * 3 != template_dict['FWHM_SMOOTH']]
     if 'options_smoothing_implicit_masking' in args['input']:
         template_dict['implicit_masking']=args['input']['options_smoothing_implicit_masking']
 
@@ -300,10 +423,72 @@ def args_parser(args):
     if 'options_cleanup' in args['input']:
         template_dict['cleanup']=int(args['input']['options_cleanup'])
 
+    if 'options_max_workers' in args['input']:
+        template_dict['max_workers']=max(1, int(args['input']['options_max_workers']))
+
+    if 'options_spm_worker' in args['input']:
+        template_dict['spm_worker']=args['input']['options_spm_worker']
+
+    if 'options_spm_worker_mock' in args['input']:
+        template_dict['spm_worker_mock']=args['input']['options_spm_worker_mock']
+
+    if 'options_spm_batch' in args['input']:
+        template_dict['spm_batch']=args['input']['options_spm_batch']
+
+    if 'options_spm_batch_size' in args['input']:
+        template_dict['spm_batch_size']=max(1, int(args['input']['options_spm_batch_size']))
+
+    if 'options_result_cache' in args['input'] and args['input']['options_result_cache']:
+        template_dict['result_cache_dir']=os.path.join(
+            args['state'].get('cacheDirectory', args['state']['outputDirectory']), 'vbm_result_cache')
+
+    if 'options_result_cache_max_gb' in args['input']:
+        template_dict['result_cache_max_gb']=float(args['input']['options_result_cache_max_gb'])
+
+    template_dict['coinstac_cache']=args.get('cache') or dict()
+
+    if 'options_rerun' in args['input']:
+        template_dict['rerun']=args['input']['options_rerun']
+
+    if 'options_output_profile' in args['input']:
+        template_dict['output_profile']=args['input']['options_output_profile']
+
+    if 'options_output_storage' in args['input']:
+        template_dict['output_storage']=args['input']['options_output_storage']
+
+    if 'options_storage_threads' in args['input']:
+        template_dict['storage_threads']=max(1, int(args['input']['options_storage_threads']))
+
+    if 'options_output_archive' in args['input']:
+        template_dict['output_archive']=args['input']['options_output_archive']
+
+    if 'options_covariates_layout' in args['input']:
+        template_dict['covariates_layout']=args['input']['options_covariates_layout']
+
+    if 'options_smooth_backend' in args['input']:
+        template_dict['smooth_backend']=args['input']['options_smooth_backend']
+
+    if 'options_smooth_threads' in args['input']:
+        template_dict['smooth_threads']=max(1, int(args['input']['options_smooth_threads']))
+
+    template_dict['spm_version_cache']=os.path.join(
+        args['state'].get('cacheDirectory', args['state']['outputDirectory']), 'vbm_spm_version.json')
+
+    if 'options_refresh_spm_version' in args['input']:
+        template_dict['spm_version_refresh']=args['input']['options_refresh_spm_version']
+
+    if 'options_mcr_cache' in args['input']:
+        template_dict['mcr_cache']=args['input']['options_mcr_cache']
+
+    template_dict['profile_dir']=None
+    if 'options_profile' in args['input'] and args['input']['options_profile']:
+        template_dict['profile_dir']=os.path.join(args['state']['outputDirectory'], 'vbm_profiles')
+
     if 'regression_resample_voxel_size' in args['input']:
         template_dict['regression_resample_voxel_size']=tuple([float(args['input']['regression_resample_voxel_size'])]*3)
 
     if 'registration_template' in args['input']:
+        import nibabel as nib
         if os.path.isfile(args['input']['registration_template']) and (str(
                 ((nib.load(template_dict['tpm_path'])).shape)) == str(
             ((nib.load(args['input']['registration_template'])).shape))):
@@ -356,6 +541,8 @@ def data_parser(args):
     # We are only concerned with pre-processing
     covariates = args['input']['covariates'];
 
+    import vbm_standalone_use_cases_layer
+
     computation_output = vbm_standalone_use_cases_layer.setup_pipeline(
         data=nifti_paths,
         write_dir=WriteDir,
@@ -365,20 +552,48 @@ def data_parser(args):
     return computation_output
 
 def start(args):
-    # Check if spm is running
-    with stdchannel_redirected(sys.stderr, os.devnull):
-        spm_check = software_check()
-    if spm_check != template_dict['spm_version']:
-        raise EnvironmentError("spm unable to start in vbm docker")
-
     # Read json args
     # args = json.loads(sys.stdin.read())
 
     # Parse args
     args_parser(args)
+    vbm_timing.reset()
+    vbm_timing.configure(**template_dict)
+
+    # One MATLAB Runtime component cache per worker slot, this process launches spm with the cache of slot 0
+    template_dict['mcr_cache_dir'] = None
+    if template_dict['mcr_cache']:
+        template_dict['mcr_cache_dir'] = vbm_cache.prepare_mcr_cache(template_dict['max_workers'])
+        vbm_cache.use_mcr_cache(template_dict['mcr_cache_dir'], 0)
+
+    # Keep spm loaded in persistent workers, the spm interfaces send every spm job of this run to them
+    template_dict['spm_worker_socket'] = None
+    spm_server = None
+    if template_dict['spm_worker']:
+        with vbm_timing.stage('spm_worker_start', children=True):
+            spm_server = spm_worker.start_server(template_dict['matlab_cmd'],
+                                                 template_dict['max_workers'],
+                                                 template_dict['spm_worker_mock'],
+                                                 template_dict['mcr_cache_dir'])
+        template_dict['spm_worker_socket'] = spm_server.socket_path
 
-    #Convert reorient params to mat file if they exist
-    convert_reorientparams_save_to_mat_script()
-
-    # Parse input data and run the code
-    return data_parser(args)
+    try:
+        # Check if spm is running
+        # Starts the MATLAB Runtime once, its time is the MCR startup time of every spm job,
+        # unless the spm version is read from spm_version_cache
+        with stdchannel_redirected(sys.stderr, os.devnull), vbm_timing.stage('mcr_startup', children=True):
+            spm_check = software_check()
+        if spm_check != template_dict['spm_version']:
+            raise EnvironmentError("spm unable to start in vbm docker")
+
+        #Convert reorient params to mat file if they exist
+        convert_reorientparams_save_to_mat_script()
+
+        # Parse input data and run the code
+        return data_parser(args)
+    finally:
+        if spm_server is not None:
+            spm_server.stop()
+            template_dict['spm_worker_socket'] = None
+            import vbm_entities_layer
+            vbm_entities_layer.use_spm(template_dict['matlab_cmd'])
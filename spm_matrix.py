@@ -2,12 +2,6 @@ import numpy as np
 import scipy
 import matcompat
 
-# if available import pylab (from matlibplot)
-try:
-    import matplotlib.pylab as plt
-except ImportError:
-    pass
-
 
 def spm_matrix(P, order):
     # Local Variables: A, R1, R2, R3, q, P, S, R, T, Z, order
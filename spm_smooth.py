@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Python port of spm_smooth.m/spm_smoothkern.m used as smooth_backend='python' in place of spm.Smooth
+
+Each image is read once and smoothed by separable 1D convolutions along x, y, z with the kernel of spm_smooth:
+a Gaussian convolved with a first degree B-spline, sampled on round(6*sigma) voxels each side and normalised to sum 1.
+Kernels are given in mm and converted to voxels with the voxel sizes of the image affine, voxels outside
+the image count as zero (as spm_conv_vol) and outputs keep the header and data type of their input.
+With implicit masking the voxels that are zero (or NaN) in the input are NaN in the output, 0 for integer data types
+
+Equivalence with SPM outputs can be checked with:
+python3 spm_smooth.py compare <spm smoothed image> <python smoothed image> [tolerance]
+"""
+import os, sys
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import nibabel as nib
+from scipy.ndimage import convolve1d
+from scipy.special import erf
+
+# Largest difference to SPM outputs accepted by compare, relative to the largest absolute value of the SPM output
+TOLERANCE = 1e-3
+
+
+def spm_smoothkern(fwhm, x, t=1):
+    # % Generate a Gaussian smoothing kernel
+    # % FORMAT krn = spm_smoothkern(fwhm,x,t)
+    # % fwhm - full width at half maximum
+    # % x    - position
+    # % t    - either 0 (nearest neighbour) or 1 (linear)
+    # %        [Default: 1]
+    # %
+    # % krn  - value of kernel at position x
+    # %__________________________________________________________________________
+    # % Copyright (C) 2005-2011 Wellcome Trust Centre for Neuroimaging
+    # % John Ashburner
+    # % $Id: spm_smoothkern.m 4419 2011-08-03 18:42:35Z guillaume $
+    x = np.asarray(x, dtype=float)
+    s = (fwhm / np.sqrt(8 * np.log(2)))**2 + np.finfo(float).eps
+    if t == 0:
+        # Gaussian convolved with 0th degree B-spline
+        w1 = 1 / np.sqrt(2 * s)
+        krn = 0.5 * (erf(w1 * (x + 0.5)) - erf(w1 * (x - 0.5)))
+    else:
+        # Gaussian convolved with 1st degree B-spline
+        w1 = 0.5 * np.sqrt(2 / s)
+        w2 = -0.5 / s
+        w3 = np.sqrt(s / 2 / np.pi)
+        krn = 0.5 * (erf(w1 * (x + 1)) * (x + 1) + erf(w1 * (x - 1)) *
+                     (x - 1) - 2 * erf(w1 * x) * x) + w3 * (
+                         np.exp(w2 * (x + 1)**2) + np.exp(w2 * (x - 1)**2) -
+                         2 * np.exp(w2 * x**2))
+    krn[krn < 0] = 0
+    return krn
+
+
+def kernels(fwhm):
+    """Returns the 1D kernels of spm_smooth for a fwhm in voxels along x, y, z"""
+    result = list()
+    for each in fwhm:
+        half_width = int(np.round(6 * each / np.sqrt(8 * np.log(2))))
+        krn = spm_smoothkern(each, np.arange(-half_width, half_width + 1), 1)
+        result.append(krn / krn.sum())
+    return result
+
+
+def spm_smooth(data, fwhm):
+    """Smooths a 3D array by fwhm in voxels along x, y, z
+    Returns:
+        smoothed (array): float64 array of the shape of data
+    """
+    smoothed = np.asarray(data, dtype=np.float64)
+    for axis, krn in enumerate(kernels(fwhm)):
+        smoothed = convolve1d(smoothed, krn, axis=axis, mode='constant', cval=0.0)
+    return smoothed
+
+
+def voxel_sizes(affine):
+    return np.sqrt(np.sum(affine[:3, :3]**2, axis=0))
+
+
+def smooth_file(in_file, prefixes, implicit_masking=False):
+    """Smooths one image with each (prefix, fwhm in mm) of prefixes, writing prefix + file name next to in_file"""
+    img = nib.load(in_file)
+    data = np.asarray(img.dataobj, dtype=np.float64)
+    vox = voxel_sizes(img.affine)
+    dtype = img.get_data_dtype()
+    mask = np.logical_or(data == 0, np.isnan(data)) if implicit_masking else None
+
+    for prefix, fwhm in prefixes:
+        smoothed = spm_smooth(data, np.asarray(fwhm, dtype=float) / vox)
+        if mask is not None:
+            smoothed[mask] = np.nan if np.issubdtype(dtype, np.floating) else 0
+        header = img.header.copy()
+        header['descrip'] = 'spm - %gx%gx%g mm smoothed' % tuple(fwhm)
+        out_img = nib.Nifti1Image(smoothed, img.affine, header)
+        out_img.set_data_dtype(dtype)
+        nib.save(out_img,
+                 os.path.join(os.path.dirname(in_file), prefix + os.path.basename(in_file)))
+
+
+def smooth_files(files, prefixes, implicit_masking=False, max_threads=4):
+    """Smooths files in a pool of max_threads threads, numpy/scipy release the GIL while convolving
+    Returns:
+        errors (list): None for each file that was smoothed, otherwise its error text
+    """
+
+    def smooth(in_file):
+        try:
+            smooth_file(in_file, prefixes, implicit_masking)
+        except Exception as e:
+            return in_file + ': ' + str(e)
+
+    with ThreadPoolExecutor(max_workers=max(1, int(max_threads))) as executor:
+        return list(executor.map(smooth, files))
+
+
+def compare(reference_file, smoothed_file, tolerance=TOLERANCE):
+    """Compares an image smoothed here to the same image smoothed by spm
+    Returns:
+        (equivalent, difference): difference is the largest absolute difference relative to the largest absolute reference value
+    """
+    reference = np.nan_to_num(np.asarray(nib.load(reference_file).dataobj, dtype=np.float64))
+    smoothed = np.nan_to_num(np.asarray(nib.load(smoothed_file).dataobj, dtype=np.float64))
+    if reference.shape != smoothed.shape:
+        return False, np.inf
+    difference = np.abs(reference - smoothed).max() / max(np.abs(reference).max(), np.finfo(float).eps)
+    return difference <= tolerance, difference
+
+
+if __name__ == '__main__':
+    if sys.argv[1] == 'compare':
+        equivalent, difference = compare(
+            sys.argv[2], sys.argv[3],
+            float(sys.argv[4]) if len(sys.argv) > 4 else TOLERANCE)
+        print('%s relative difference %g' % ('equivalent' if equivalent else 'different', difference))
+        sys.exit(0 if equivalent else 1)
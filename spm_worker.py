@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This layer keeps SPM standalone (MATLAB Runtime) processes alive across pipeline nodes
+
+Every nipype SPMCommand normally launches "run_spm12.sh <mcr> script pyscript.m" and pays the MCR startup each time.
+Here a few long-lived MCR processes run WORKER_SCRIPT, a loop that picks up jobs from a spool directory,
+evaluates them and writes back their output and exit status.
+The SPMWorkerServer owns these processes and accepts jobs over a local unix socket.
+
+Nipype calls "<matlab_cmd> /path/to/pyscript.m" for MCR, the spm interfaces of vbm_entities_layer given the socket of the
+server (use_spm) run client_cmd instead, which sends every SPM job of the pipeline (version check, reorient, segmentation,
+smoothing) to the workers:
+
+python3 spm_worker.py submit <socket_path> /path/to/pyscript.m
+
+The server measures the resources of the worker process tree during each job (vbm_timing.process_usage) and submit
+appends them to the file of vbm_timing.WORKER_USAGE_ENV, so that they are charged to the stage that sent the job
+
+The mock worker (python3 spm_worker.py mock WORKER_SCRIPT) speaks the same spool protocol without MATLAB,
+its jobs write the synthetic outputs of mock_spm12.py
+"""
+import os, sys, re, time, shlex, shutil, socket, tempfile, threading, subprocess, queue
+import ujson as json
+
+# MATLAB loop run by each worker, all its variables are prefixed with spmworker_ so that jobs do not clobber them
+WORKER_SCRIPT = """
+%% Generated by spm_worker.py
+spmworker_spool = '%(spool_dir)s';
+spmworker_fid = fopen(fullfile(spmworker_spool, 'ready'), 'w'); fclose(spmworker_fid);
+while true
+    if exist(fullfile(spmworker_spool, 'stop'), 'file'), break; end
+    spmworker_jobs = dir(fullfile(spmworker_spool, '*.job'));
+    if isempty(spmworker_jobs), pause(0.05); continue; end
+    spmworker_job = fullfile(spmworker_spool, spmworker_jobs(1).name);
+    spmworker_lines = strsplit(fileread(spmworker_job), sprintf('\\n'));
+    delete(spmworker_job);
+    [spmworker_dir, spmworker_name] = fileparts(spmworker_job);
+    clearvars -except spmworker_*
+    spmworker_status = 0; spmworker_error = ''; spmworker_output = '';
+    try
+        cd(spmworker_lines{1});
+        spmworker_output = evalc(fileread(spmworker_lines{2}));
+        if exist('ME', 'var'), spmworker_status = 1; spmworker_error = ME.message; end
+    catch spmworker_exception
+        spmworker_status = 1; spmworker_error = spmworker_exception.message;
+    end
+    spmworker_fid = fopen(fullfile(spmworker_spool, [spmworker_name '.out']), 'w');
+    fprintf(spmworker_fid, '%%s', spmworker_output); fclose(spmworker_fid);
+    spmworker_fid = fopen(fullfile(spmworker_spool, [spmworker_name '.tmp']), 'w');
+    fprintf(spmworker_fid, '%%d\\n%%s', spmworker_status, spmworker_error); fclose(spmworker_fid);
+    movefile(fullfile(spmworker_spool, [spmworker_name '.tmp']), fullfile(spmworker_spool, [spmworker_name '.status']));
+end
+"""
+
+# Exit status reported for a job whose worker process died while running it
+CRASH_STATUS = 2
+
+# Seconds to wait for a worker to load the MATLAB Runtime
+START_TIMEOUT = 600
+
+
+class SPMWorker:
+    """One long-lived MCR process running WORKER_SCRIPT on its own spool directory"""
+
+    def __init__(self, matlab_cmd, spool_dir, mcr_cache_root=None):
+        self.matlab_cmd = matlab_cmd
+        self.spool_dir = spool_dir
+        self.mcr_cache_root = mcr_cache_root
+        self.process = None
+        self.job_count = 0
+        self.restarts = 0
+
+    def start(self):
+        """Starts the worker process and waits until it is ready to take jobs"""
+        shutil.rmtree(self.spool_dir, ignore_errors=True)
+        os.makedirs(self.spool_dir)
+        script_file = os.path.join(self.spool_dir, 'spm_worker_loop.m')
+        with open(script_file, 'w') as fp:
+            fp.write(WORKER_SCRIPT % {'spool_dir': self.spool_dir})
+        log = open(os.path.join(self.spool_dir, 'worker.log'), 'w')
+        env = dict(os.environ)
+        if self.mcr_cache_root:
+            env['MCR_CACHE_ROOT'] = self.mcr_cache_root
+        self.process = subprocess.Popen(
+            shlex.split(self.matlab_cmd) + [script_file],
+            env=env,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+            stdin=subprocess.DEVNULL)
+        log.close()
+
+        start = time.time()
+        while not os.path.isfile(os.path.join(self.spool_dir, 'ready')):
+            if not self.alive() or time.time() - start > START_TIMEOUT:
+                self.stop()
+                raise EnvironmentError(
+                    "SPM worker unable to start, see " +
+                    os.path.join(self.spool_dir, 'worker.log'))
+            time.sleep(0.1)
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def restart(self):
+        """Replaces a crashed worker process by a new one"""
+        self.stop()
+        self.restarts += 1
+        self.start()
+
+    def stop(self):
+        if self.process is None:
+            return
+        if self.alive():
+            open(os.path.join(self.spool_dir, 'stop'), 'w').close()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self.process = None
+
+    def run_job(self, script_file, cwd):
+        """Runs one nipype generated m-file on the worker
+        Returns:
+            (status, output, error, usage): exit status (0 ok, 1 job failed, CRASH_STATUS worker died), captured stdout,
+            error text and the peak RSS, cpu seconds and read/written bytes of the worker during the job (None if it died)
+        """
+        import vbm_timing
+        if not self.alive():
+            self.restart()
+        self.job_count += 1
+        name = 'job_%06d' % self.job_count
+
+        # MCR scripts end the process with exit, the worker must outlive the job
+        with open(script_file) as fp:
+            script = fp.read()
+        job_script = os.path.join(self.spool_dir, name + '.m')
+        with open(job_script, 'w') as fp:
+            fp.write(re.sub(r'(?m)^\s*exit\s*;?\s*$', '', script))
+
+        with open(os.path.join(self.spool_dir, name + '.tmp'), 'w') as fp:
+            fp.write(cwd + '\n' + job_script)
+        os.rename(
+            os.path.join(self.spool_dir, name + '.tmp'),
+            os.path.join(self.spool_dir, name + '.job'))
+
+        status_file = os.path.join(self.spool_dir, name + '.status')
+        before = vbm_timing.process_usage(self.process.pid)
+        peak_rss_kb, sampled = before['rss_kb'], time.time()
+        while not os.path.isfile(status_file):
+            if not self.alive():
+                self.restart()
+                return CRASH_STATUS, '', 'SPM worker crashed while running ' + script_file, None
+            time.sleep(0.05)
+            if time.time() - sampled > vbm_timing.CHILD_SAMPLE_SECONDS:
+                peak_rss_kb, sampled = max(peak_rss_kb, vbm_timing.process_usage(self.process.pid)['rss_kb']), time.time()
+        after = vbm_timing.process_usage(self.process.pid)
+        usage = {
+            'peak_rss_mb': round(max(peak_rss_kb, after['rss_kb']) / 1024., 1),
+            'user_s': round(max(after['user_s'] - before['user_s'], 0), 3),
+            'sys_s': round(max(after['sys_s'] - before['sys_s'], 0), 3),
+            'read_bytes': max(after['read_bytes'] - before['read_bytes'], 0),
+            'write_bytes': max(after['write_bytes'] - before['write_bytes'], 0)
+        }
+
+        with open(status_file) as fp:
+            status, _, error = fp.read().partition('\n')
+        output = ''
+        if os.path.isfile(os.path.join(self.spool_dir, name + '.out')):
+            with open(os.path.join(self.spool_dir, name + '.out')) as fp:
+                output = fp.read()
+        for ext in ('.m', '.out', '.status'):
+            if os.path.isfile(os.path.join(self.spool_dir, name + ext)):
+                os.remove(os.path.join(self.spool_dir, name + ext))
+        return int(status), output, error, usage
+
+
+class SPMWorkerServer:
+    """Pool of SPMWorker processes serving jobs from a local unix socket, one job per worker at a time"""
+
+    def __init__(self, matlab_cmd, slots=1, work_dir=None, mcr_cache_dir=None):
+        self.work_dir = tempfile.mkdtemp(prefix='spm_worker_', dir=work_dir)
+        self.socket_path = os.path.join(self.work_dir, 'spm_worker.sock')
+        self.client_cmd = client_cmd(self.socket_path)
+        self.workers = [
+            SPMWorker(matlab_cmd, os.path.join(self.work_dir, 'slot_%d' % slot),
+                      mcr_cache_dir and os.path.join(mcr_cache_dir, 'slot_%d' % slot))
+            for slot in range(slots)
+        ]
+        self.free_workers = queue.Queue()
+        self.job_log = list()
+        self.sock = None
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+            self.free_workers.put(worker)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.socket_path)
+        self.sock.listen(64)
+        threading.Thread(target=self._serve, args=(self.sock,), daemon=True).start()
+        return self
+
+    def _serve(self, sock):
+        while True:
+            try:
+                conn, _ = sock.accept()
+            except OSError:
+                # socket closed by stop()
+                return
+            threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    def _handle(self, conn):
+        with conn:
+            request = json.loads(_recv_all(conn))
+            worker = self.free_workers.get()
+            start = time.time()
+            try:
+                status, output, error, usage = worker.run_job(request['script'], request['cwd'])
+            except Exception as e:
+                status, output, error, usage = CRASH_STATUS, '', str(e), None
+            finally:
+                self.free_workers.put(worker)
+            self.job_log.append({
+                'script': request['script'],
+                'status': status,
+                'error': error,
+                'seconds': time.time() - start,
+                'usage': usage
+            })
+            conn.sendall(json.dumps({'status': status, 'output': output, 'error': error, 'usage': usage}).encode())
+
+    def stop(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        for worker in self.workers:
+            worker.stop()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+
+def client_cmd(socket_path):
+    """Returns the matlab_cmd that submits the m-file it is given to the server of socket_path"""
+    return '%s %s submit %s' % (sys.executable, os.path.abspath(__file__), socket_path)
+
+
+def start_server(matlab_cmd, slots=1, mock=False, mcr_cache_dir=None):
+    """Starts slots SPM workers, mock=True runs the MATLAB free mock worker instead of matlab_cmd
+    With mcr_cache_dir each worker uses its slot_<n> directory as MCR_CACHE_ROOT (vbm_cache.prepare_mcr_cache)
+    Returns:
+        server (SPMWorkerServer): server.socket_path is the worker socket of vbm_entities_layer.use_spm
+    """
+    if mock:
+        matlab_cmd = '%s %s mock' % (sys.executable, os.path.abspath(__file__))
+    return SPMWorkerServer(matlab_cmd, slots, mcr_cache_dir=mcr_cache_dir).start()
+
+
+def _recv_all(conn):
+    chunks = list()
+    while True:
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    return b''.join(chunks).decode()
+
+
+def submit(socket_path, script_file):
+    """Sends one m-file to the server, prints its output like the MCR would and returns its exit status
+    The resources of the job are appended to the file of vbm_timing.WORKER_USAGE_ENV when the stage that runs it set one
+    """
+    import vbm_timing
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.connect(socket_path)
+    conn.sendall(json.dumps({'script': os.path.abspath(script_file), 'cwd': os.getcwd()}).encode())
+    conn.shutdown(socket.SHUT_WR)
+    reply = json.loads(_recv_all(conn))
+    conn.close()
+    if reply.get('usage') and os.environ.get(vbm_timing.WORKER_USAGE_ENV):
+        with open(os.environ[vbm_timing.WORKER_USAGE_ENV], 'a') as fp:
+            fp.write(json.dumps(reply['usage']) + '\n')
+    sys.stdout.write(reply['output'])
+    if reply['error']:
+        sys.stderr.write(reply['error'] + '\n')
+    return reply['status']
+
+
+def mock_worker(script_file):
+    """Stand-in for the MCR running WORKER_SCRIPT, it runs the jobs with mock_spm12 instead of SPM
+    The SPM version probe gets the version of mock_spm12, the other jobs write the synthetic outputs of
+    mock_spm12.run_script in the job directory. A job containing "% mock:fail" fails and a job containing
+    "% mock:crash" kills the worker
+    """
+    import mock_spm12
+    with open(script_file) as fp:
+        spool_dir = re.search(r"spmworker_spool = '(.*)';", fp.read()).group(1)
+    open(os.path.join(spool_dir, 'ready'), 'w').close()
+    while not os.path.isfile(os.path.join(spool_dir, 'stop')):
+        jobs = sorted(f for f in os.listdir(spool_dir) if f.endswith('.job'))
+        if not jobs:
+            time.sleep(0.05)
+            continue
+        job = os.path.join(spool_dir, jobs[0])
+        with open(job) as fp:
+            cwd, job_script = fp.read().split('\n')[:2]
+        os.remove(job)
+        name = jobs[0][:-len('.job')]
+        with open(job_script) as fp:
+            script = fp.read()
+        if '% mock:crash' in script:
+            os._exit(1)
+
+        status, error, output = 0, '', 'Executing %s at mock worker:\n' % job_script
+        if 'NIPYPE path' in script:
+            output += 'NIPYPE path:/opt/spm12/fsroot/spm/spm12|name:%s|release:%s' % (
+                mock_spm12.SPM_NAME, mock_spm12.SPM_RELEASE)
+        elif '% mock:fail' in script:
+            status, error = 1, 'mock job failure'
+        else:
+            try:
+                os.chdir(cwd)
+                mock_spm12.run_script(script, 0)
+            except Exception as e:
+                status, error = 1, str(e)
+
+        with open(os.path.join(spool_dir, name + '.out'), 'w') as fp:
+            fp.write(output)
+        with open(os.path.join(spool_dir, name + '.tmp'), 'w') as fp:
+            fp.write('%d\n%s' % (status, error))
+        os.rename(
+            os.path.join(spool_dir, name + '.tmp'),
+            os.path.join(spool_dir, name + '.status'))
+
+
+if __name__ == '__main__':
+    if sys.argv[1] == 'submit':
+        sys.exit(submit(sys.argv[2], sys.argv[3]))
+    elif sys.argv[1] == 'mock':
+        mock_worker(sys.argv[2])
@@ -0,0 +1,4 @@
+# The tests import the pipeline modules from the top of the repository
+import os, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,11 @@
+"""
+Import time budget of run_vbm, paid by every coinstac call before any input is checked
+"""
+import vbm_microbenchmark
+
+
+def test_import_run_vbm_within_budget():
+    # the best of a few runs, a single run can be slowed down by a busy machine
+    seconds = min(vbm_microbenchmark.import_time('run_vbm') for n in range(3))
+    assert seconds <= vbm_microbenchmark.IMPORT_BUDGET_S, \
+        'import run_vbm took %.3f s, over the %.3f s budget' % (seconds, vbm_microbenchmark.IMPORT_BUDGET_S)
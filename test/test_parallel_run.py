@@ -0,0 +1,63 @@
+"""
+Tests of the pool of worker processes (options_max_workers), with mock_spm12.py in place of the MATLAB Runtime
+"""
+import os, sys, json, zipfile
+import numpy as np
+import scipy.io
+import pytest
+
+import run_vbm
+import vbm_benchmark
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def cohort(tmp_path, monkeypatch):
+    """Writes a synthetic cohort and points the template at mock_spm12, restores the template after the test"""
+    base_dir = str(tmp_path / 'input')
+    os.makedirs(base_dir)
+    covariates = vbm_benchmark.make_cohort(base_dir, 3)
+    vbm_benchmark.make_tpm(str(tmp_path / 'TPM.nii'))
+    scipy.io.savemat(str(tmp_path / 'transform.mat'), {'M': np.eye(4)})
+    for key, value in {
+            'matlab_cmd': '%s %s /opt/mcr script' % (sys.executable, os.path.join(REPO_DIR, 'mock_spm12.py')),
+            'spm_path': str(tmp_path),
+            'tpm_path': str(tmp_path / 'TPM.nii'),
+            'transf_mat_path': str(tmp_path / 'transform.mat')}.items():
+        monkeypatch.setitem(run_vbm.template_dict, key, value)
+    monkeypatch.chdir(tmp_path)
+    return base_dir, covariates
+
+
+def run(base_dir, covariates, output_dir, max_workers):
+    """Returns the output json of a standalone run, with output_dir in its paths replaced"""
+    os.makedirs(output_dir)
+    output = run_vbm.start({
+        'input': {
+            'covariates': covariates,
+            'standalone': True,
+            'options_max_workers': max_workers
+        },
+        'state': {
+            'baseDirectory': base_dir,
+            'outputDirectory': output_dir
+        }
+    })
+    return json.loads(json.dumps(output, default=str).replace(output_dir, '<outputDirectory>'))
+
+
+def test_pool_output_matches_serial(cohort, tmp_path):
+    base_dir, covariates = cohort
+
+    serial = run(base_dir, covariates, str(tmp_path / 'serial'), 1)
+    pool = run(base_dir, covariates, str(tmp_path / 'pool'), 2)
+
+    assert '3/3 subjects completed successfully' in serial['output']['message']
+    assert pool == serial
+    # Both zips hold the same files
+    names = list()
+    for output_dir in ('serial', 'pool'):
+        with zipfile.ZipFile(str(tmp_path / output_dir / 'vbm_outputs.zip')) as archived:
+            names.append(sorted(archived.namelist()))
+    assert names[0] == names[1]
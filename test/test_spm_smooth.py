@@ -0,0 +1,101 @@
+"""
+Tests of spm_smooth.py, the python port of spm_smooth.m used by smooth_backend='python'
+
+The references are fixed values: the taps of spm_smoothkern(fwhm, -x:x, 1)/sum for x = round(6*fwhm/sqrt(8*log(2)))
+(spm_smooth.m) at 0..x, evaluated from spm_smoothkern.m with the erf and exp of the C math library. The smoothing of a
+single voxel by spm_conv_vol is the outer product of the x, y, z taps
+"""
+import numpy as np
+import nibabel as nib
+import pytest
+
+import spm_smooth
+
+# Variance of the first degree B-spline convolved with the Gaussian of spm_smoothkern, in voxels^2
+BSPLINE_VARIANCE = 1 / 6.
+
+# Taps 0..x of the kernel of spm_smooth for a fwhm in voxels, ex: 6 mm on 1.5 mm voxels is 4 voxels
+SMOOTHKERN_TAPS = {
+    2.: [4.22137733e-01, 2.416771123e-01, 4.465247279e-02, 2.558083671e-03, 4.325822888e-05, 2.065109033e-07],
+    4.: [2.283043149e-01, 1.938334183e-01, 1.186117369e-01, 5.229733279e-02, 1.660626376e-02, 3.795085301e-03,
+         6.237154035e-04, 7.365123612e-05, 6.242880334e-06, 3.794610208e-07, 1.652294999e-08]
+}
+
+
+@pytest.mark.parametrize('fwhm', [1., 2.5, 4., 5.333, 8.])
+def test_kernel_sums_to_one(fwhm):
+    for krn in spm_smooth.kernels([fwhm] * 3):
+        assert krn.sum() == pytest.approx(1., abs=1e-12)
+        assert np.all(krn >= 0)
+        np.testing.assert_allclose(krn, krn[::-1], atol=1e-15)
+
+
+@pytest.mark.parametrize('fwhm', sorted(SMOOTHKERN_TAPS))
+def test_kernel_taps(fwhm):
+    taps = SMOOTHKERN_TAPS[fwhm]
+    np.testing.assert_allclose(spm_smooth.kernels([fwhm])[0], taps[:0:-1] + taps, rtol=1e-8, atol=1e-17)
+
+
+@pytest.mark.parametrize('fwhm', [2.5, 4., 5.333, 8.])
+def test_kernel_fwhm(fwhm):
+    krn = spm_smooth.kernels([fwhm])[0]
+    x = np.arange(len(krn)) - len(krn) // 2
+    variance = (krn * x**2).sum()
+    assert variance == pytest.approx(fwhm**2 / (8 * np.log(2)) + BSPLINE_VARIANCE, rel=1e-3)
+
+
+def impulse_reference(shape, centre, fwhm):
+    """Returns the smoothing of a unit voxel at centre by spm_conv_vol, the outer product of SMOOTHKERN_TAPS"""
+    reference = np.zeros(shape)
+    slices, values = list(), np.ones(1)
+    for axis, each in enumerate(fwhm):
+        taps = SMOOTHKERN_TAPS[each]
+        slices.append(slice(centre[axis] - len(taps) + 1, centre[axis] + len(taps)))
+        values = np.multiply.outer(values, taps[:0:-1] + taps)
+    reference[tuple(slices)] = values[0]
+    return reference
+
+
+def test_smooth_impulse():
+    shape, centre, fwhm = (40, 44, 36), (20, 21, 18), (2., 4., 4.)
+    data = np.zeros(shape)
+    data[centre] = 1.
+    smoothed = spm_smooth.spm_smooth(data, fwhm)
+    np.testing.assert_allclose(smoothed, impulse_reference(shape, centre, fwhm), rtol=1e-8, atol=1e-15)
+    assert smoothed[centre] == pytest.approx(0.422137733 * 0.2283043149**2, rel=1e-8)
+    assert smoothed.sum() == pytest.approx(1.)
+
+
+def test_smooth_file_matches_reference(tmp_path):
+    # 1.5 mm voxels smoothed by 6 mm: 4 voxels
+    shape, centre, voxel_size = (48, 48, 48), (24, 23, 25), 1.5
+    affine = np.diag([-voxel_size, voxel_size, voxel_size, 1.])
+    data = np.zeros(shape, dtype=np.float32)
+    data[centre] = 100.
+    nib.save(nib.Nifti1Image(data, affine), str(tmp_path / 'wc1Re.nii'))
+    nib.save(nib.Nifti1Image(100. * impulse_reference(shape, centre, [6. / voxel_size] * 3), affine),
+             str(tmp_path / 'reference.nii'))
+
+    spm_smooth.smooth_file(str(tmp_path / 'wc1Re.nii'), [('s', [6., 6., 6.])])
+
+    smoothed = nib.load(str(tmp_path / 'swc1Re.nii'))
+    assert smoothed.get_data_dtype() == np.float32
+    np.testing.assert_allclose(smoothed.affine, affine)
+    # Along x through the centre the profile is 100 times the taps of 4 voxels scaled by the centre taps of y and z
+    profile = np.asarray(smoothed.dataobj)[centre[0]:centre[0] + 11, centre[1], centre[2]]
+    np.testing.assert_allclose(profile, 100. * np.array(SMOOTHKERN_TAPS[4.]) * 0.2283043149**2, rtol=1e-6)
+    equivalent, difference = spm_smooth.compare(str(tmp_path / 'reference.nii'), str(tmp_path / 'swc1Re.nii'))
+    assert equivalent, difference
+    assert difference <= spm_smooth.TOLERANCE
+
+
+def test_implicit_masking(tmp_path):
+    data = np.zeros((16, 16, 16), dtype=np.float32)
+    data[4:12, 4:12, 4:12] = 1.
+    nib.save(nib.Nifti1Image(data, np.eye(4)), str(tmp_path / 'wc1Re.nii'))
+
+    spm_smooth.smooth_file(str(tmp_path / 'wc1Re.nii'), [('s', [2., 2., 2.])], implicit_masking=True)
+
+    smoothed = np.asarray(nib.load(str(tmp_path / 'swc1Re.nii')).dataobj)
+    assert np.all(np.isnan(smoothed[data == 0]))
+    assert np.all(np.isfinite(smoothed[data != 0]))
@@ -0,0 +1,84 @@
+"""
+Tests of spm_worker.py with the mock worker, which runs the spm jobs with mock_spm12 instead of the MATLAB Runtime
+"""
+import os
+import numpy as np
+import nibabel as nib
+import pytest
+
+import spm_worker
+import vbm_cache
+
+# MCR command of the spm interfaces, never started: their jobs go to the mock workers
+MATLAB_CMD = '/opt/spm12/run_spm12.sh /opt/mcr/v97 script'
+
+
+@pytest.fixture
+def server():
+    server = spm_worker.start_server(None, mock=True)
+    yield server
+    server.stop()
+
+
+def write_image(path):
+    nib.save(nib.Nifti1Image(np.ones((4, 4, 4), dtype=np.float32), np.eye(4)), str(path))
+    return str(path)
+
+
+def write_job(path, code):
+    """Writes an m-file ending with exit as nipype writes them for the MCR"""
+    path.write_text(code + '\nexit;\n')
+    return str(path)
+
+
+def smooth_job(path, image):
+    return write_job(path, "matlabbatch{1}.spm.spatial.smooth.data = {'%s,1'};\n"
+                           "matlabbatch{1}.spm.spatial.smooth.fwhm = [6 6 6];\n"
+                           "spm_jobman('run', matlabbatch);" % image)
+
+
+def test_job_exit_status(server, tmp_path):
+    image = write_image(tmp_path / 'wc1Re.nii')
+
+    assert spm_worker.submit(server.socket_path, smooth_job(tmp_path / 'smooth.m', image)) == 0
+    assert os.path.isfile(str(tmp_path / 'swc1Re.nii'))
+    assert spm_worker.submit(server.socket_path, write_job(tmp_path / 'fail.m', '% mock:fail')) == 1
+
+    assert [job['status'] for job in server.job_log] == [0, 1]
+    assert server.job_log[1]['error'] == 'mock job failure'
+    assert server.workers[0].restarts == 0
+
+
+def test_restart_after_crash(server, tmp_path):
+    image = write_image(tmp_path / 'wc1Re.nii')
+    worker = server.workers[0]
+    pid = worker.process.pid
+
+    assert spm_worker.submit(server.socket_path, write_job(tmp_path / 'crash.m', '% mock:crash')) == \
+        spm_worker.CRASH_STATUS
+    assert worker.restarts == 1
+    assert worker.alive() and worker.process.pid != pid
+
+    # The restarted worker runs the next jobs
+    assert spm_worker.submit(server.socket_path, smooth_job(tmp_path / 'smooth.m', image)) == 0
+    assert os.path.isfile(str(tmp_path / 'swc1Re.nii'))
+
+
+def test_interfaces_send_jobs_to_workers(server, tmp_path, monkeypatch):
+    import vbm_entities_layer
+    image = write_image(tmp_path / 'wc1Re.nii')
+    vbm_entities_layer.use_spm(MATLAB_CMD, server.socket_path)
+    try:
+        # The version probe goes to the workers too
+        vbm_cache.spm_info(MATLAB_CMD, probe_cmd=vbm_entities_layer.spm_cmd(MATLAB_CMD))
+        smooth = vbm_entities_layer.SPMSmooth(in_files=[image], fwhm=[6., 6., 6.])
+        assert smooth.inputs.matlab_cmd == MATLAB_CMD
+        assert smooth.version == '12.7771'
+
+        monkeypatch.chdir(tmp_path)
+        smooth.run()
+        assert os.path.isfile(str(tmp_path / 'swc1Re.nii'))
+        assert [job['status'] for job in server.job_log] == [0, 0]
+    finally:
+        vbm_entities_layer.use_spm(None)
+        vbm_cache.spm_infos.pop(MATLAB_CMD, None)
@@ -0,0 +1,106 @@
+"""
+Tests of vbm_archive.py, the zip of the vbm_outputs directory written while the subjects run
+"""
+import os, zipfile
+
+import vbm_archive
+
+
+def write_subject(root_dir, name, size=4096):
+    """Writes the vbm_spm12 outputs of a subject, a map and a compressed map, returns the map"""
+    out_dir = os.path.join(root_dir, name, 'anat', 'vbm_spm12')
+    os.makedirs(out_dir)
+    for file_name in ('wc1Re.nii', 'swc1Re.nii.gz'):
+        with open(os.path.join(out_dir, file_name), 'wb') as fp:
+            fp.write((name + file_name).encode() * (size // len(name + file_name)))
+    return os.path.join(out_dir, 'wc1Re.nii')
+
+
+def link_covariates(root_dir, maps):
+    """Links the maps into covariates/wc1Re, as covariates_layout='link'"""
+    cov_dir = os.path.join(root_dir, 'covariates', 'wc1Re')
+    os.makedirs(cov_dir)
+    for name, path in maps.items():
+        os.link(path, os.path.join(cov_dir, name + '-wc1Re.nii'))
+
+
+def test_linked_files_stored_once(tmp_path):
+    root_dir = str(tmp_path / 'vbm_outputs')
+    maps = {name: write_subject(root_dir, name) for name in ('a', 'b')}
+    link_covariates(root_dir, maps)
+
+    archive = vbm_archive.Archive(str(tmp_path / 'vbm_outputs'), root_dir)
+    archive.add([os.path.join(root_dir, 'a')])
+    zip_file, counts = archive.finish()
+
+    assert counts == {'copied': 0, 'compressed': 4, 'linked': 2}
+    with zipfile.ZipFile(zip_file) as archived:
+        assert archived.testzip() is None
+        for name, path in maps.items():
+            with open(path, 'rb') as fp:
+                data = fp.read()
+            assert archived.read(name + '/anat/vbm_spm12/wc1Re.nii') == data
+            assert archived.read('covariates/wc1Re/' + name + '-wc1Re.nii') == data
+
+
+def test_links_before_their_file(tmp_path):
+    # The files of a subject archived already come after their links, as in an os.walk of covariates first
+    root_dir = str(tmp_path / 'vbm_outputs')
+    maps = {name: write_subject(root_dir, name) for name in ('a', 'b')}
+    link_covariates(root_dir, maps)
+
+    archive = vbm_archive.Archive(str(tmp_path / 'vbm_outputs'), root_dir)
+    archive.append(vbm_archive.archive_files(root_dir, os.path.join(root_dir, 'a')))
+    archive.append(vbm_archive.archive_files(root_dir, os.path.join(root_dir, 'covariates')) +
+                   vbm_archive.archive_files(root_dir, os.path.join(root_dir, 'b')) +
+                   vbm_archive.archive_files(root_dir, os.path.join(root_dir, 'a')))
+
+    assert archive.counts == {'copied': 0, 'compressed': 4, 'linked': 2}
+
+
+def test_streamed_subjects(tmp_path):
+    root_dir = str(tmp_path / 'vbm_outputs')
+    for name in ('a', 'b'):
+        write_subject(root_dir, name)
+    with open(os.path.join(root_dir, 'vbm_log.txt'), 'w') as fp:
+        fp.write('log')
+
+    archive = vbm_archive.Archive(str(tmp_path / 'vbm_outputs'), root_dir, threads=2)
+    archive.add([os.path.join(root_dir, 'a')])
+    archive.add([os.path.join(root_dir, 'b')])
+    zip_file, counts = archive.finish()
+
+    assert counts == {'copied': 0, 'compressed': 5, 'linked': 0}
+    assert not os.path.exists(archive.partial_file)
+    with zipfile.ZipFile(zip_file) as archived:
+        assert archived.testzip() is None
+        names = sorted(name for name in archived.namelist() if not name.endswith('/'))
+        # The stamps of the members are kept beside the zip, not in their comments
+        assert all(info.comment == b'' for info in archived.infolist())
+    assert names == [
+        'a/anat/vbm_spm12/swc1Re.nii.gz', 'a/anat/vbm_spm12/wc1Re.nii',
+        'b/anat/vbm_spm12/swc1Re.nii.gz', 'b/anat/vbm_spm12/wc1Re.nii', 'vbm_log.txt']
+    assert sorted(vbm_archive.read_stamps(archive.stamps_file)) == names
+
+
+def test_finish_unchanged_tree(tmp_path):
+    root_dir = str(tmp_path / 'vbm_outputs')
+    for name in ('a', 'b'):
+        write_subject(root_dir, name)
+    zip_file = vbm_archive.update_archive(str(tmp_path / 'vbm_outputs'), root_dir)[0]
+    stat = os.stat(zip_file)
+
+    # Nothing changed, the zip is left as it is
+    assert vbm_archive.update_archive(str(tmp_path / 'vbm_outputs'), root_dir) == (
+        zip_file, {'copied': 0, 'compressed': 0, 'linked': 0})
+    assert (os.stat(zip_file).st_ino, os.stat(zip_file).st_mtime_ns) == (stat.st_ino, stat.st_mtime_ns)
+    assert not os.path.exists(zip_file + '.partial')
+
+    # A changed file is compressed again, the other members are copied still compressed
+    with open(os.path.join(root_dir, 'b', 'anat', 'vbm_spm12', 'wc1Re.nii'), 'ab') as fp:
+        fp.write(b'changed')
+    assert vbm_archive.update_archive(str(tmp_path / 'vbm_outputs'), root_dir)[1] == {
+        'copied': 3, 'compressed': 1, 'linked': 0}
+    with zipfile.ZipFile(zip_file) as archived:
+        assert archived.testzip() is None
+        assert archived.read('b/anat/vbm_spm12/wc1Re.nii').endswith(b'changed')
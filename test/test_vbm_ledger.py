@@ -0,0 +1,63 @@
+"""
+Tests of vbm_ledger.py, the state of the subjects of a run kept across runs of an output directory
+"""
+import os
+
+import run_vbm
+import vbm_cache
+import vbm_ledger
+import vbm_subjects_layer
+
+
+def done_result(sub_id, vbm_out, stages):
+    result = vbm_subjects_layer.new_result(sub_id)
+    result.update(vbm_out=vbm_out, covalue=0.9, cache='miss', stages=stages, regression_file='unused')
+    return result
+
+
+def test_resume_after_interrupt(tmp_path):
+    ledger_file = str(tmp_path / 'vbm_ledger.db')
+    write_dir = str(tmp_path / 'vbm_outputs')
+    template_dict = dict(run_vbm.template_dict, ledger_file=ledger_file, tpm_path=str(tmp_path / 'TPM.nii'),
+                         transf_mat_path=str(tmp_path / 'transform.mat'))
+    (tmp_path / 'TPM.nii').write_bytes(b'tpm')
+    subjects = list()
+    for sub_id in ('a', 'b', 'c'):
+        (tmp_path / (sub_id + '.nii')).write_bytes(sub_id.encode())
+        subjects.append((sub_id, str(tmp_path / (sub_id + '.nii'))))
+
+    vbm_ledger.begin(ledger_file, subjects)
+    assert vbm_ledger.counts(ledger_file) == {vbm_ledger.QUEUED: 3}
+
+    # a is done with its outputs, b is killed in spm, c never starts
+    out_dir = os.path.join(write_dir, 'a', 'anat', template_dict['vbm_output_dirname'])
+    os.makedirs(out_dir)
+    open(os.path.join(out_dir, 'wc1Re.nii'), 'w').close()
+    stages = dict(vbm_cache.stage_keys(subjects[0][1], 'a', **template_dict), covalue=0.9, files=['wc1Re.nii'])
+    a = done_result('a', os.path.join(write_dir, 'a', 'anat'), stages)
+    vbm_ledger.record(ledger_file, a, vbm_ledger.RUNNING, 'spm')
+    vbm_ledger.record(ledger_file, a, vbm_ledger.DONE)
+    b = vbm_subjects_layer.new_result('b')
+    vbm_ledger.record(ledger_file, b, vbm_ledger.RUNNING, 'spm')
+    vbm_ledger.interrupt(ledger_file, 'interrupted')
+
+    assert vbm_ledger.counts(ledger_file) == {vbm_ledger.DONE: 1, vbm_ledger.FAILED: 1, vbm_ledger.QUEUED: 1}
+    assert vbm_ledger.errors(ledger_file) == {'b': 'interrupted'}
+    rows = vbm_ledger.results(ledger_file)
+    assert [(row['sub_id'], row['state'], row['stage']) for row in rows] == [
+        ('a', vbm_ledger.DONE, 'spm'), ('b', vbm_ledger.FAILED, 'spm'), ('c', vbm_ledger.QUEUED, None)]
+    assert rows[0]['regression_file'] == 'unused' and rows[0]['wall_s'] >= 0
+
+    # The next run skips a, whose stage keys did not change and whose outputs exist, and queues b and c again
+    done = vbm_subjects_layer.resume_subjects(write_dir, subjects, dict(), **template_dict)
+    assert list(done) == [subjects[0][1]]
+    vbm_ledger.begin(ledger_file, subjects, done=done.values())
+    rows = vbm_ledger.results(ledger_file)
+    assert [(row['sub_id'], row['state']) for row in rows] == [
+        ('a', vbm_ledger.DONE), ('b', vbm_ledger.QUEUED), ('c', vbm_ledger.QUEUED)]
+    assert rows[0]['covalue'] == 0.9 and rows[0]['stages'] == stages
+    assert rows[1]['error'] is None
+
+    # A changed input is run again
+    (tmp_path / 'a.nii').write_bytes(b'changed a')
+    assert vbm_subjects_layer.resume_subjects(write_dir, subjects, dict(), **template_dict) == dict()
@@ -0,0 +1,58 @@
+"""
+Tests of vbm_storage.py, the form of the vbm_spm12 outputs written by output_storage
+"""
+import os
+import numpy as np
+import nibabel as nib
+
+import vbm_storage
+
+
+def write_map(path, value):
+    nib.save(nib.Nifti1Image(np.full((8, 8, 8), value, dtype=np.float32), np.eye(4)), path)
+    return path
+
+
+def compress_copy(path):
+    """Writes path.gz beside path, as a storage interrupted before removing path leaves it"""
+    with open(path, 'rb') as fp:
+        vbm_storage.write_gzip(path + '.gz', fp.read(), 1)
+
+
+def store(out_dir, storage):
+    return vbm_storage.store_outputs(str(out_dir), output_storage=storage, storage_threads=2)
+
+
+def test_image_file_form_of_storage(tmp_path):
+    path = write_map(str(tmp_path / 'wc1Re.nii'), 1.)
+    assert vbm_storage.image_file(path) == path
+    assert vbm_storage.image_file(path, 'nii.gz') == path + '.gz'
+
+    store(tmp_path, 'nii.gz')
+    assert vbm_storage.image_file(path) == path + '.gz'
+    assert vbm_storage.image_files(str(tmp_path / 'wc*.nii'), 'nii') == [path]
+
+
+def test_interrupted_storage_keeps_verified_form(tmp_path):
+    path = write_map(str(tmp_path / 'wc1Re.nii'), 2.)
+    compress_copy(path)
+
+    store(tmp_path, 'nii.gz')
+
+    assert os.listdir(str(tmp_path)) == ['wc1Re.nii.gz']
+    assert np.all(np.asarray(nib.load(path + '.gz').dataobj) == 2.)
+
+
+def test_unverified_form_written_again(tmp_path):
+    # The compressed form is truncated, it is written again from the .nii form before that is removed
+    path = write_map(str(tmp_path / 'wc1Re.nii'), 3.)
+    compress_copy(path)
+    with open(path + '.gz', 'r+b') as fp:
+        fp.truncate(os.path.getsize(path + '.gz') // 2)
+    assert not vbm_storage.verify_image(path + '.gz')
+
+    store(tmp_path, 'nii.gz')
+
+    assert os.listdir(str(tmp_path)) == ['wc1Re.nii.gz']
+    assert vbm_storage.verify_image(path + '.gz')
+    assert np.all(np.asarray(nib.load(path + '.gz').dataobj) == 3.)
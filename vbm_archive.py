@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This layer writes the zip of the vbm_outputs directory that run_pipeline returns to coinstac (download_outputs)
+
+Archive streams the zip while the subjects run: run_pipeline adds the directory of each subject once the ledger records
+it done and a background thread appends its files to base_name.zip.partial, compressed by threads threads. Files
+already compressed (STORED_EXTENSIONS: .nii.gz, .png) are stored as they are. finish appends the files written at the
+end of the run (covariates, readme files) and renames the partial zip to base_name.zip, it only rewrites the zip
+when files archived during the run changed or were removed since. Files written after finish (ex: the log with the
+timings of finish) are left out of it and appended to base_name.zip by add_last. zipfile writes Zip64 records for
+members and offsets over 4 GiB and for more than 65535 members.
+
+The size and mtime of the file of each member when it was archived (file_stamp) are kept in the comment of the member
+in the partial zip, finish removes the comments from base_name.zip and keeps them in base_name.zip.stamps. Members of
+the partial zip whose file did not change are kept, so that a run restarted after a failure resumes the zip of the
+previous attempt, and members of the previous base_name.zip whose file did not change are copied still compressed.
+Adding subjects to a cohort then does not compress the outputs of the subjects already archived again, and finish
+leaves base_name.zip as it is when no file changed. update_archive writes the zip of a directory in one call
+"""
+import os, copy, zlib, struct, zipfile
+import ujson as json
+import vbm_timing
+
+# Bytes copied at once from the previous zip
+COPY_BLOCK = 1 << 20
+
+# Local header flag of members whose sizes follow their data, they are written before it by copy_member
+DATA_DESCRIPTOR = 0x08
+
+# Files already compressed, stored in the zip without compressing them again
+STORED_EXTENSIONS = ('.gz', '.png', '.zip')
+
+# zlib compression level of the deflated members, the default level of zipfile
+DEFLATE_LEVEL = 6
+
+# Extra field of the 64-bit sizes and offset of a member, FileHeader and the central directory write their own
+ZIP64_EXTRA = 0x0001
+
+
+def file_stamp(path, stat=None):
+    """Returns the size and mtime of a file (of its stat when given), the comment of its member in the partial zip"""
+    stat = stat or os.stat(path)
+    return ('%d:%d' % (stat.st_size, stat.st_mtime_ns)).encode()
+
+
+def read_stamps(stamps_file):
+    """Returns the file_stamp of each member of a zip kept by finish in stamps_file, empty if there are none"""
+    try:
+        with open(stamps_file) as fp:
+            return {arcname: stamp.encode() for arcname, stamp in json.load(fp).items()}
+    except (OSError, ValueError):
+        return dict()
+
+
+def archive_files(root_dir, sub_dir=None):
+    """Returns the (path, arcname) of the directories and files under root_dir, in the order of shutil.make_archive
+    With sub_dir, a directory of root_dir, only sub_dir and the directories and files under it
+    """
+    files = list()
+    if sub_dir is not None:
+        files.append((sub_dir, os.path.normpath(os.path.relpath(sub_dir, root_dir))))
+    for dirpath, dirnames, filenames in os.walk(sub_dir or root_dir):
+        arcdirpath = os.path.normpath(os.path.relpath(dirpath, root_dir))
+        for name in sorted(dirnames):
+            files.append((os.path.join(dirpath, name), os.path.normpath(os.path.join(arcdirpath, name))))
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if os.path.isfile(path):
+                files.append((path, os.path.normpath(os.path.join(arcdirpath, name))))
+    return files
+
+
+def strip_zip64(extra):
+    """Returns the extra field of a member without its zip64 record"""
+    stripped, i = b'', 0
+    while i + 4 <= len(extra):
+        field, size = struct.unpack('<HH', extra[i:i + 4])
+        if field != ZIP64_EXTRA:
+            stripped += extra[i:i + 4 + size]
+        i += 4 + size
+    return stripped
+
+
+def copy_member(src, dst, info, arcname=None):
+    """Copies member info of the zip src to the zip dst being written, without decompressing it
+    With arcname the copy is named arcname, src may then be dst (a file linked to the file of member info)
+    """
+    if src is dst:
+        dst.fp.flush()
+        src_fp = open(dst.filename, 'rb')
+    else:
+        src_fp = src.fp
+    try:
+        src_fp.seek(info.header_offset)
+        header = struct.unpack(zipfile.structFileHeader, src_fp.read(zipfile.sizeFileHeader))
+        src_fp.seek(header[zipfile._FH_FILENAME_LENGTH] + header[zipfile._FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+
+        member = copy.copy(info)
+        if arcname is not None:
+            member.filename = member.orig_filename = arcname
+        member.flag_bits &= ~DATA_DESCRIPTOR
+        member.extra = strip_zip64(info.extra)
+        dst.fp.seek(dst.start_dir)
+        member.header_offset = dst.start_dir
+        dst.fp.write(member.FileHeader())
+        remaining = info.compress_size
+        while remaining:
+            block = src_fp.read(min(COPY_BLOCK, remaining))
+            if not block:
+                raise zipfile.BadZipFile('truncated member ' + info.filename)
+            dst.fp.write(block)
+            remaining -= len(block)
+    finally:
+        if src is dst:
+            src_fp.close()
+    dst.filelist.append(member)
+    dst.NameToInfo[member.filename] = member
+    dst.start_dir = dst.fp.tell()
+    dst._didModify = True
+
+
+def compress_member(path, arcname):
+    """Returns the zip member of the file path with its data, deflated unless the file is already compressed"""
+    stamp = file_stamp(path)
+    info = zipfile.ZipInfo.from_file(path, arcname)
+    with open(path, 'rb') as fp:
+        data = fp.read()
+    info.file_size = len(data)
+    info.CRC = zlib.crc32(data)
+    info.comment = stamp
+    if arcname.endswith(STORED_EXTENSIONS):
+        info.compress_type = zipfile.ZIP_STORED
+    else:
+        info.compress_type = zipfile.ZIP_DEFLATED
+        compressor = zlib.compressobj(DEFLATE_LEVEL, zlib.DEFLATED, -15)
+        data = compressor.compress(data) + compressor.flush()
+    info.compress_size = len(data)
+    return info, data
+
+
+def write_member(dst, info, data):
+    """Writes member info with its compressed data to the end of the zip dst being written"""
+    dst.fp.seek(dst.start_dir)
+    info.header_offset = dst.start_dir
+    dst.fp.write(info.FileHeader())
+    dst.fp.write(data)
+    dst.filelist.append(info)
+    dst.NameToInfo[info.filename] = info
+    dst.start_dir = dst.fp.tell()
+    dst._didModify = True
+
+
+def read_zip(zip_file):
+    """Returns the zip zip_file open for reading, None if it does not exist or is not a zip"""
+    try:
+        return zipfile.ZipFile(zip_file)
+    except (OSError, zipfile.BadZipFile):
+        return None
+
+
+class Archive:
+    """Zip of root_dir written while the subjects run, see the module docstring"""
+
+    def __init__(self, base_name, root_dir, threads=1):
+        from concurrent.futures import ThreadPoolExecutor
+        self.zip_file = base_name + '.zip'
+        self.partial_file = self.zip_file + '.partial'
+        self.stamps_file = self.zip_file + '.stamps'
+        # Stamps of the members of the previous base_name.zip
+        self.stamps = read_stamps(self.stamps_file)
+        self.root_dir = root_dir
+        self.threads = threads
+        self.counts = {'copied': 0, 'compressed': 0, 'linked': 0}
+        # Directories added, the background thread appending them and its pending appends
+        self.added = set()
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='vbm_archive')
+        self.pending = list()
+
+        self.open_partial()
+
+    def open_partial(self):
+        """Keeps the partial zip of a previous attempt, or starts an empty one"""
+        partial = read_zip(self.partial_file)
+        if partial is None:
+            # No previous attempt, or a partial zip left unreadable by a run killed while appending
+            zipfile.ZipFile(self.partial_file, 'w').close()
+        else:
+            partial.close()
+
+    def add(self, dirs):
+        """Appends the files of the directories dirs of root_dir not added yet in the background thread"""
+        dirs = [path for path in dirs if path not in self.added and os.path.isdir(path)]
+        if dirs:
+            self.added.update(dirs)
+            self.pending.append(self.writer.submit(self.stream, dirs))
+
+    def stream(self, dirs):
+        """Appends the files of the directories dirs, in the background thread"""
+        with vbm_timing.stage('archive_stream', [os.path.basename(sub_dir) for sub_dir in dirs]):
+            self.append([file for sub_dir in dirs for file in archive_files(self.root_dir, sub_dir)])
+
+    def append(self, files):
+        """Appends the (path, arcname) files to the partial zip, the zip is complete again once it returns"""
+        previous = read_zip(self.zip_file)
+        try:
+            with zipfile.ZipFile(self.partial_file, 'a', zipfile.ZIP_DEFLATED) as archive:
+                self.write_files(archive, previous, files)
+        finally:
+            if previous is not None:
+                previous.close()
+
+    def write_files(self, archive, previous, files):
+        """Writes the files that have no member of the same size and mtime in archive, from previous when it has one
+        Files linked to each other (hard links, symbolic links, ex: covariates_layout='link') are compressed once,
+        the members of the others are copies of its compressed data
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        # Member in archive of each file (device, inode) of files, registered for all the files before any is
+        # compressed so that a link is not compressed when it comes before the file archived already (os.walk order)
+        members, missing = dict(), list()
+        for path, arcname in files:
+            if os.path.isdir(path):
+                if arcname + '/' not in archive.NameToInfo:
+                    archive.write(path, arcname)
+                continue
+            stat = os.stat(path)
+            stamp = file_stamp(path, stat)
+            inode = (stat.st_dev, stat.st_ino)
+            info = archive.NameToInfo.get(arcname)
+            if info is not None and info.comment == stamp:
+                members.setdefault(inode, info)
+                continue
+            info = previous.NameToInfo.get(arcname) if previous is not None else None
+            if info is not None and self.stamps.get(arcname) == stamp:
+                copy_member(previous, archive, info)
+                archive.NameToInfo[arcname].comment = stamp
+                members.setdefault(inode, archive.NameToInfo[arcname])
+                self.counts['copied'] += 1
+            else:
+                missing.append((path, arcname, inode))
+        # Files to compress, one of each (device, inode) without a member, and links of the others
+        compress, linked, compressed = list(), list(), set()
+        for path, arcname, inode in missing:
+            if inode in members or inode in compressed:
+                linked.append((arcname, inode))
+            else:
+                compressed.add(inode)
+                compress.append((path, arcname, inode))
+        with ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='vbm_zip') as pool:
+            for (path, arcname, inode), (info, data) in zip(
+                    compress, pool.map(lambda file: compress_member(*file[:2]), compress)):
+                write_member(archive, info, data)
+                members[inode] = info
+                self.counts['compressed'] += 1
+        for arcname, inode in linked:
+            copy_member(archive, archive, members[inode], arcname)
+            self.counts['linked'] += 1
+
+    def finish(self, last=()):
+        """This function appends the files of root_dir not archived yet and writes the partial zip as base_name.zip
+        The files last are left out, add_last appends them once they are written
+        Returns:
+            (zip_file, counts): the zip and the number of members copied from the previous zip, compressed and linked
+        """
+        for future in self.pending:
+            try:
+                future.result()
+            except Exception:
+                # The files of a failed append are appended below with the others
+                pass
+        self.writer.shutdown()
+        self.open_partial()
+        files = [(path, arcname) for path, arcname in archive_files(self.root_dir) if path not in last]
+        names = set(arcname + '/' if os.path.isdir(path) else arcname for path, arcname in files)
+        if self.unchanged(files, names):
+            os.remove(self.partial_file)
+            return self.zip_file, self.counts
+        self.append(files)
+
+        with zipfile.ZipFile(self.partial_file) as partial:
+            # Members of files changed during the run were appended again, of files removed are left over
+            stale = len(partial.filelist) != len(names) or any(
+                info.filename not in names for info in partial.filelist)
+            stamps = {info.filename: info.comment.decode() for info in partial.filelist
+                      if info.filename in names and not info.is_dir()}
+            if stale:
+                tmp_file = self.zip_file + '.tmp'
+                with zipfile.ZipFile(tmp_file, 'w', zipfile.ZIP_DEFLATED) as archive:
+                    for path, arcname in files:
+                        if os.path.isdir(path):
+                            archive.write(path, arcname)
+                        else:
+                            copy_member(partial, archive, partial.NameToInfo[arcname])
+                            archive.NameToInfo[arcname].comment = b''
+        if not stale:
+            # The central directory is written again without the comments
+            with zipfile.ZipFile(self.partial_file, 'a') as partial:
+                for info in partial.filelist:
+                    info.comment = b''
+                partial._didModify = True
+            tmp_file = self.partial_file
+        # A run killed before the stamps of the new zip are written finds none, not those of the previous zip
+        if os.path.isfile(self.stamps_file):
+            os.remove(self.stamps_file)
+        os.replace(tmp_file, self.zip_file)
+        if stale:
+            os.remove(self.partial_file)
+        with open(self.stamps_file + '.tmp', 'w') as fp:
+            json.dump(stamps, fp)
+        os.replace(self.stamps_file + '.tmp', self.stamps_file)
+        self.stamps = {arcname: stamp.encode() for arcname, stamp in stamps.items()}
+        return self.zip_file, self.counts
+
+    def unchanged(self, files, names):
+        """Returns True if the previous base_name.zip has the members of files and none of them changed"""
+        previous = read_zip(self.zip_file)
+        if previous is None:
+            return False
+        with previous:
+            if set(previous.NameToInfo) != names:
+                return False
+        return all(os.path.isdir(path) or self.stamps.get(arcname) == file_stamp(path) for path, arcname in files)
+
+    def add_last(self, paths):
+        """This function appends the files paths of root_dir, left out by finish, to base_name.zip"""
+        with zipfile.ZipFile(self.zip_file, 'a') as archive:
+            for path in paths:
+                info, data = compress_member(path, os.path.normpath(os.path.relpath(path, self.root_dir)))
+                info.comment = b''
+                write_member(archive, info, data)
+                self.counts['compressed'] += 1
+
+
+def update_archive(base_name, root_dir, threads=1):
+    """This function writes base_name.zip with the files under root_dir, reusing the members of the previous base_name.zip
+    whose file did not change
+    Returns:
+        (zip_file, counts): the zip and the number of members copied from the previous zip, compressed and linked
+    """
+    return Archive(base_name, root_dir, threads).finish()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Orchestration scaling benchmark: runs run_vbm.start on synthetic cohorts with mock_spm12.py in place of the MATLAB Runtime
+
+python3 vbm_benchmark.py [--subjects 10 100 1000] [--startup 0] [--delay 0] [--max-workers 1] [--spm-batch node] [--json]
+
+Each cohort size runs in its own process so that its peak memory is its own, and reports:
+subjects/hour, overhead per subject (worker seconds spent outside the mock spm sleeps, per subject),
+peak RSS of the python process and of its largest child process
+"""
+import os, sys, time, shutil, argparse, resource, tempfile, subprocess
+import ujson as json
+import numpy as np
+import nibabel as nib
+import scipy.io
+
+# Shape of the synthetic T1 scans and of the synthetic TPM (a real TPM.nii is 121x145x121)
+SCAN_SHAPE = (32, 32, 32)
+TPM_SHAPE = (40, 48, 40)
+
+
+def make_tpm(tpm_file):
+    """Writes a 6 tissue TPM whose grey matter volume correlates with the mock wc1 images"""
+    grid = np.stack(np.meshgrid(*[np.linspace(-1, 1, n) for n in TPM_SHAPE], indexing='ij'))
+    radius = np.sqrt((grid**2).sum(axis=0))
+    tissues = [np.exp(-((radius - centre) / 0.15)**2) for centre in (0.5, 0.3, 0.7, 0.9, 1.1, 1.3)]
+    data = np.stack(tissues, axis=-1).astype(np.float32)
+    data /= data.sum(axis=-1, keepdims=True)
+    nib.save(nib.Nifti1Image(data, np.diag([1.5, 1.5, 1.5, 1])), tpm_file)
+
+
+def make_cohort(base_dir, subjects):
+    """Writes synthetic T1 scans and returns their covariates"""
+    rng = np.random.default_rng(0)
+    covariates = dict()
+    for n in range(subjects):
+        file_name = 'sub%05d_T1w.nii' % n
+        nib.save(
+            nib.Nifti1Image(rng.random(SCAN_SHAPE, dtype=np.float32), np.eye(4)),
+            os.path.join(base_dir, file_name))
+        covariates[file_name] = {'isControl': bool(n % 2), 'age': 20 + n % 50}
+    return covariates
+
+
+def run_cohort(subjects, startup, delay, max_workers, spm_batch):
+    """Runs run_vbm.start on a synthetic cohort in a temporary directory
+    Returns:
+        result (dict): benchmark measures of the run
+    """
+    import run_vbm
+    work_dir = tempfile.mkdtemp(prefix='vbm_benchmark_')
+    try:
+        base_dir, output_dir = os.path.join(work_dir, 'input'), os.path.join(work_dir, 'output')
+        os.makedirs(base_dir)
+        os.makedirs(output_dir)
+        covariates = make_cohort(base_dir, subjects)
+        make_tpm(os.path.join(work_dir, 'TPM.nii'))
+        scipy.io.savemat(os.path.join(work_dir, 'transform.mat'), {'M': np.eye(4)})
+        spm_ledger = os.path.join(work_dir, 'mock_spm12_ledger.txt')
+        os.environ['MOCK_SPM12_LEDGER'] = spm_ledger
+
+        run_vbm.template_dict.update({
+            'matlab_cmd': '%s %s --startup %g --delay %g /opt/mcr script' % (
+                sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mock_spm12.py'),
+                startup, delay),
+            'spm_path': work_dir,
+            'tpm_path': os.path.join(work_dir, 'TPM.nii'),
+            'transf_mat_path': os.path.join(work_dir, 'transform.mat')
+        })
+        args = {
+            'input': {
+                'covariates': covariates,
+                'standalone': True,
+                'options_max_workers': max_workers,
+                'options_spm_batch': spm_batch
+            },
+            'state': {
+                'baseDirectory': base_dir,
+                'outputDirectory': output_dir
+            }
+        }
+
+        start = time.time()
+        output = run_vbm.start(args)
+        wall = time.time() - start
+
+        spm_seconds = 0.
+        if os.path.isfile(spm_ledger):
+            with open(spm_ledger) as fp:
+                spm_seconds = sum(float(line) for line in fp if line.strip())
+        return {
+            'subjects': subjects,
+            'max_workers': max_workers,
+            'spm_batch': spm_batch,
+            'wall_s': round(wall, 3),
+            'subjects_per_hour': round(subjects / wall * 3600, 1),
+            'overhead_per_subject_s': round((wall * min(max_workers, subjects) - spm_seconds) / subjects, 4),
+            'mock_spm_s': round(spm_seconds, 3),
+            'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024., 1),
+            'peak_child_rss_mb': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024., 1),
+            'message': output['output'].get('message', '')[:120]
+        }
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='VBM orchestration scaling benchmark with mock spm')
+    parser.add_argument('--subjects', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--startup', type=float, default=0, help='mock MATLAB Runtime startup seconds per spm call')
+    parser.add_argument('--delay', type=float, default=0, help='mock segmentation seconds per subject')
+    parser.add_argument('--max-workers', type=int, default=1)
+    parser.add_argument('--spm-batch', default='node', choices=['node', 'subject', 'cohort'])
+    parser.add_argument('--json', action='store_true', help='print one json line per cohort size')
+    parser.add_argument('--run', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run:
+        # One cohort size in this process
+        result = run_cohort(args.subjects[0], args.startup, args.delay, args.max_workers, args.spm_batch)
+        sys.stdout.write('\n' + json.dumps(result) + '\n')
+        return 0
+
+    if not args.json:
+        print('%8s %8s %10s %14s %14s %12s %16s' % ('subjects', 'workers', 'wall_s', 'subjects/hour',
+                                                    'overhead/subj_s', 'peak_rss_mb', 'peak_child_rss_mb'))
+    for subjects in args.subjects:
+        run = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--run', '--subjects', str(subjects),
+             '--startup', str(args.startup), '--delay', str(args.delay),
+             '--max-workers', str(args.max_workers), '--spm-batch', args.spm_batch],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+        if run.returncode != 0:
+            print('%8d benchmark run failed' % subjects)
+            continue
+        result = json.loads(run.stdout.strip().splitlines()[-1])
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print('%8d %8d %10.1f %14.1f %14.3f %12.1f %16.1f' % (
+                subjects, result['max_workers'], result['wall_s'], result['subjects_per_hour'],
+                result['overhead_per_subject_s'], result['peak_rss_mb'], result['peak_child_rss_mb']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,443 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This layer keeps a persistent on-disk cache of pre-processed subjects so that re-runs of a site do not call SPM again
+
+Each entry is a directory named after the key of the subject, which hashes:
+1) the content of the input scan (nifti file or dicom directory)
+2) the content of the TPM and the matrix of the reorientation transform.mat (transform_key)
+3) the spm version found for matlab_cmd (run_version) and the template_dict parameters that change the outputs (CACHE_PARAMS)
+An entry holds the vbm_spm12 outputs of the subject and entry.json with its correlation value.
+Entries are evicted least recently used first once the cache grows over its size limit
+
+stage_keys chains the same hashes per pipeline stage (STAGE_PARAMS) so that a re-run only recomputes
+the stages whose inputs or parameters changed, ex: a new FWHM_SMOOTH only re-runs smoothing and QC, a new output_storage
+only writes the outputs in the new form (storage has no downstream stage), smoothing too when it changes the integer type
+the smoothed maps are written in
+
+coinstac_record is the compact record of a run returned in the coinstac cache field: the key of its parameters and the
+fingerprint of the input of each subject done, so that the next run with new covariate entries only hashes and runs
+the new or changed scans
+
+spm_info keeps the spm version found by nipype in a small json file keyed by the size/mtime of run_spm12.sh,
+the MCR root and the spm CTF (install_key), so that runs do not start the MATLAB Runtime only to read it
+
+prepare_mcr_cache keeps one MATLAB Runtime component cache (MCR_CACHE_ROOT) per worker slot, on /dev/shm when it has room,
+so that concurrent spm processes do not share one cache and launches do not extract components on the overlay filesystem
+"""
+import os, glob, shutil, hashlib, tempfile
+import ujson as json
+import vbm_storage
+
+# Bump when the layout of the outputs changes so that old entries are not restored
+CACHE_VERSION = 1
+
+# template_dict keys that change the vbm_spm12 outputs of a subject
+CACHE_PARAMS = [
+    'FWHM_SMOOTH', 'implicit_masking', 'smooth_backend', 'BIAS_REGULARISATION',
+    'FWHM_GAUSSIAN_SMOOTH_BIAS', 'affine_regularization',
+    'warping_regularization', 'sampling_distance', 'mrf_weighting', 'cleanup',
+    'options_reorient_params_x_mm', 'options_reorient_params_y_mm',
+    'options_reorient_params_z_mm', 'options_reorient_params_pitch',
+    'options_reorient_params_roll', 'options_reorient_params_yaw',
+    'options_reorient_params_x_scaling', 'options_reorient_params_y_scaling',
+    'options_reorient_params_z_scaling', 'options_reorient_params_x_affine',
+    'options_reorient_params_y_affine', 'options_reorient_params_z_affine',
+    'qc_nifti', 'vbm_qc_filename', 'output_profile', 'output_storage'
+]
+
+# template_dict keys each stage depends on, a stage also depends on the key of its upstream stage
+STAGE_PARAMS = {
+    'reorient': [
+        'options_reorient_params_x_mm', 'options_reorient_params_y_mm',
+        'options_reorient_params_z_mm', 'options_reorient_params_pitch',
+        'options_reorient_params_roll', 'options_reorient_params_yaw',
+        'options_reorient_params_x_scaling', 'options_reorient_params_y_scaling',
+        'options_reorient_params_z_scaling', 'options_reorient_params_x_affine',
+        'options_reorient_params_y_affine', 'options_reorient_params_z_affine'
+    ],
+    'segment': [
+        'spm_version', 'BIAS_REGULARISATION', 'FWHM_GAUSSIAN_SMOOTH_BIAS',
+        'affine_regularization', 'warping_regularization', 'sampling_distance',
+        'mrf_weighting', 'cleanup', 'output_profile'
+    ],
+    'smooth': ['spm_version', 'FWHM_SMOOTH', 'implicit_masking', 'smooth_backend'],
+    'storage': ['output_storage'],
+    'qc': ['qc_nifti', 'vbm_qc_filename'],
+    'render': ['display_nifti', 'display_image_name', 'display_pngimage_name']
+}
+
+# Upstream stage of each stage
+STAGE_INPUTS = {
+    'reorient': None,
+    'segment': 'reorient',
+    'smooth': 'segment',
+    'storage': 'smooth',
+    'qc': 'smooth',
+    'render': 'segment'
+}
+
+# Hashes of files already read by this process, by (path, size, mtime)
+file_hashes = dict()
+
+# spm name, path and release of each matlab_cmd of this process (spm_info), the version of the spm interfaces of
+# vbm_entities_layer (SPMVersion)
+spm_infos = dict()
+
+# tmpfs holding the MATLAB Runtime component cache of each worker slot when it has room for them
+MCR_CACHE_SHM = '/dev/shm'
+# Room left on MCR_CACHE_SHM besides the slot caches, in bytes
+MCR_CACHE_MARGIN = 256 * 1024**2
+
+
+def file_hash(path):
+    """This function returns the sha256 of a file, or of all files of a directory"""
+    if os.path.isdir(path):
+        digest = hashlib.sha256()
+        for file in sorted(glob.glob(os.path.join(path, '*'))):
+            digest.update(file_hash(file).encode())
+        return digest.hexdigest()
+
+    stat = os.stat(path)
+    if (path, stat.st_size, stat.st_mtime) not in file_hashes:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as fp:
+            for block in iter(lambda: fp.read(1 << 20), b''):
+                digest.update(block)
+        file_hashes[(path, stat.st_size, stat.st_mtime)] = digest.hexdigest()
+    return file_hashes[(path, stat.st_size, stat.st_mtime)]
+
+
+def transform_key(path):
+    """This function returns the sha256 of the matrix M of the reorientation transform.mat, None if there is none
+    The file itself is rewritten at every start (savemat writes its creation time in the header), its matrix only
+    changes with the reorientation parameters
+    """
+    if not os.path.isfile(path):
+        return None
+    stat = os.stat(path)
+    if (path, stat.st_size, stat.st_mtime, 'M') not in file_hashes:
+        import numpy as np, scipy.io
+        matrix = np.ascontiguousarray(scipy.io.loadmat(path)['M'], dtype=np.float64)
+        digest = hashlib.sha256(str(matrix.shape).encode())
+        digest.update(matrix.tobytes())
+        file_hashes[(path, stat.st_size, stat.st_mtime, 'M')] = digest.hexdigest()
+    return file_hashes[(path, stat.st_size, stat.st_mtime, 'M')]
+
+
+def run_version(**template_dict):
+    """Returns the spm version of the run, found for matlab_cmd by spm_info (spm_version), template_dict['spm_version']
+    before spm was probed
+    """
+    return spm_version(template_dict['matlab_cmd']) or template_dict['spm_version']
+
+
+def param_values(params, **template_dict):
+    """Returns the values of the template_dict keys params, the spm version found for matlab_cmd for spm_version"""
+    return [run_version(**template_dict) if param == 'spm_version' else template_dict[param] for param in params]
+
+
+def stage_keys(each_sub, sub_id, **template_dict):
+    """This function returns the key of each stage of a subject, the key changes when the stage or any upstream stage has to be recomputed"""
+    inputs = {
+        'reorient': [file_hash(each_sub)],
+        'segment': [file_hash(template_dict['tpm_path'])],
+        # Smooth writes the smoothed maps in the integer type of output_storage (vbm_storage.spm_data_type)
+        'smooth': [vbm_storage.spm_data_type(template_dict['output_storage'])],
+        'storage': [],
+        'qc': [file_hash(template_dict['tpm_path'])],
+        'render': [sub_id]
+    }
+    if os.path.isfile(template_dict['transf_mat_path']):
+        inputs['reorient'].append(transform_key(template_dict['transf_mat_path']))
+
+    keys = dict()
+    for stage in STAGE_PARAMS:
+        content = {
+            'version': CACHE_VERSION,
+            'upstream': keys.get(STAGE_INPUTS[stage]),
+            'inputs': inputs[stage],
+            'params': param_values(STAGE_PARAMS[stage], **template_dict)
+        }
+        keys[stage] = hashlib.sha256(
+            json.dumps(content, sort_keys=True).encode()).hexdigest()
+    return keys
+
+
+def params_key(**template_dict):
+    """This function returns the key of the TPM, reorientation matrix and parameters of all stages of a run"""
+    return hashlib.sha256(
+        json.dumps({
+            'version': CACHE_VERSION,
+            'tpm': file_hash(template_dict['tpm_path']),
+            'transform': transform_key(template_dict['transf_mat_path']),
+            'params': {
+                stage: param_values(STAGE_PARAMS[stage], **template_dict)
+                for stage in STAGE_PARAMS
+            }
+        }, sort_keys=True).encode()).hexdigest()
+
+
+def fingerprint(path):
+    """This function returns the size, mtime (ns) and sha256 of an input scan"""
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns, file_hash(path)]
+
+
+def coinstac_record(subjects, **template_dict):
+    """This function returns the record of a run kept in the coinstac cache, subjects is the list of (sub_id, input) done
+    It holds the key of the parameters of the run (params_key) and the input and its fingerprint of each subject
+    """
+    return {
+        'params': params_key(**template_dict),
+        'subjects': {
+            sub_id: {'input': each_sub, 'fingerprint': fingerprint(each_sub)}
+            for sub_id, each_sub in subjects
+        }
+    }
+
+
+def read_coinstac_record(record, **template_dict):
+    """This function returns the subjects of the record of a previous run (coinstac_record) if its parameters did not change
+    The hashes of the inputs whose size and mtime did not change are added to file_hashes so that they are not read again
+    """
+    if not record or record.get('params') != params_key(**template_dict):
+        return dict()
+    for entry in record['subjects'].values():
+        size, mtime_ns, digest = entry['fingerprint']
+        try:
+            stat = os.stat(entry['input'])
+        except OSError:
+            continue
+        if os.path.isfile(entry['input']) and (stat.st_size, stat.st_mtime_ns) == (size, mtime_ns):
+            file_hashes[(entry['input'], stat.st_size, stat.st_mtime)] = digest
+    return record['subjects']
+
+
+def read_manifest(manifest_file):
+    """Returns the stage keys recorded by write_manifest, empty if there are none"""
+    try:
+        with open(manifest_file) as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return dict()
+
+
+def write_manifest(manifest_file, manifest):
+    with open(manifest_file + '.tmp', 'w') as fp:
+        json.dump(manifest, fp, sort_keys=True)
+    os.replace(manifest_file + '.tmp', manifest_file)
+
+
+class ResultCache:
+    """Size-bounded LRU cache of subject outputs in cache_dir"""
+
+    def __init__(self, cache_dir, max_gb=20):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(float(max_gb) * 1024**3)
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, each_sub, **template_dict):
+        """Returns the key of an input scan run with template_dict"""
+        content = {
+            'version': CACHE_VERSION,
+            'input': file_hash(each_sub),
+            'tpm': file_hash(template_dict['tpm_path']),
+            'spm_version': run_version(**template_dict),
+            'params': [template_dict[param] for param in CACHE_PARAMS]
+        }
+        if os.path.isfile(template_dict['transf_mat_path']):
+            content['transform'] = transform_key(template_dict['transf_mat_path'])
+        return hashlib.sha256(
+            json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+    def restore(self, key, out_dir):
+        """Copies the files of an entry to out_dir
+        Returns:
+            covalue (float): correlation value of the entry, None on a miss
+        """
+        entry = os.path.join(self.cache_dir, key)
+        try:
+            with open(os.path.join(entry, 'entry.json')) as fp:
+                meta = json.load(fp)
+            for file in meta['files']:
+                shutil.copy(os.path.join(entry, file), out_dir)
+        except (OSError, ValueError):
+            # missing, partly evicted or corrupt entry
+            self.misses += 1
+            return None
+
+        # Mark the entry as recently used
+        os.utime(entry)
+        self.hits += 1
+        return meta['covalue']
+
+    def store(self, key, out_dir, covalue, exclude=()):
+        """Copies the files of out_dir into a new entry, the entry appears atomically for concurrent workers"""
+        entry = os.path.join(self.cache_dir, key)
+        if os.path.isdir(entry):
+            return
+        tmp_entry = tempfile.mkdtemp(prefix='.tmp_', dir=self.cache_dir)
+        try:
+            files = sorted(
+                file for file in os.listdir(out_dir)
+                if file not in exclude and os.path.isfile(os.path.join(out_dir, file)))
+            size = 0
+            for file in files:
+                shutil.copy(os.path.join(out_dir, file), tmp_entry)
+                size += os.path.getsize(os.path.join(tmp_entry, file))
+            with open(os.path.join(tmp_entry, 'entry.json'), 'w') as fp:
+                json.dump({'covalue': covalue, 'files': files, 'bytes': size}, fp)
+            os.rename(tmp_entry, entry)
+        except OSError:
+            # another worker stored the same entry first or the disk is full
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+
+    def evict(self):
+        """Removes least recently used entries until the cache fits in max_bytes"""
+        entries = list()
+        for key in os.listdir(self.cache_dir):
+            entry = os.path.join(self.cache_dir, key)
+            if key.startswith('.'):
+                continue
+            try:
+                with open(os.path.join(entry, 'entry.json')) as fp:
+                    size = json.load(fp)['bytes']
+                entries.append((os.path.getmtime(entry), size, entry))
+            except (OSError, ValueError, KeyError):
+                shutil.rmtree(entry, ignore_errors=True)
+
+        total = sum(size for mtime, size, entry in entries)
+        for mtime, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+
+def get_cache(**template_dict):
+    """Returns the ResultCache of the run, None if result_cache_dir is not set"""
+    if not template_dict.get('result_cache_dir'):
+        return None
+    return ResultCache(template_dict['result_cache_dir'],
+                       template_dict['result_cache_max_gb'])
+
+
+def install_key(matlab_cmd):
+    """Returns the (path, size, mtime) of the files and directories of matlab_cmd (run_spm12.sh, MCR root)
+    and of the SPM CTF archives next to its script, they change when spm or the MATLAB Runtime is reinstalled
+    """
+    paths = [token for token in matlab_cmd.split() if os.path.exists(token)]
+    if paths:
+        paths += sorted(glob.glob(os.path.join(os.path.dirname(paths[0]), '*.ctf')))
+    key = [matlab_cmd]
+    for path in paths:
+        stat = os.stat(path)
+        key.append([path, stat.st_size, stat.st_mtime])
+    return key
+
+
+def spm_info(matlab_cmd, cache_file=None, probe_cmd=None, refresh=False):
+    """Returns the name, path and release of the spm of matlab_cmd (spm.Info.getinfo) and keeps them in spm_infos.
+    They are read from cache_file when the install_key of matlab_cmd did not change, so that no MATLAB Runtime starts
+    to probe them, refresh=True probes spm again. spm is probed with probe_cmd (default matlab_cmd), ex: the client of
+    the persistent spm workers. The spm interfaces of vbm_entities_layer answer their version checks from spm_infos,
+    so that they do not start MATLAB either
+    """
+    key = install_key(matlab_cmd)
+    cached = read_manifest(cache_file) if cache_file and not refresh else dict()
+    info = cached.get('info') if cached.get('key') == key else None
+    if not info:
+        from nipype.interfaces import spm
+        spm_infos.pop(matlab_cmd, None)
+        info = spm.Info.getinfo(matlab_cmd=probe_cmd or matlab_cmd, paths=None, use_mcr=True)
+        if not info:
+            return None
+        if cache_file:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            write_manifest(cache_file, {'key': key, 'info': info})
+
+    spm_infos[matlab_cmd] = dict(info)
+    return info
+
+
+def spm_version(matlab_cmd):
+    """Returns the spm version of matlab_cmd kept by spm_info as SPMCommand().version gives it, ex: 12.7771, None if unknown"""
+    info = spm_infos.get(matlab_cmd)
+    if info is None:
+        return None
+    return '%s.%s' % (info['name'].split('SPM')[-1], info['release'])
+
+
+def mcr_cache_templates():
+    """Returns the MCR component caches (.mcrCache<version>) extracted when the image was built,
+    under MCR_CACHE_ROOT if it is set else under the home directory as the MATLAB Runtime does
+    """
+    root = os.environ.get('MCR_CACHE_ROOT') or os.path.expanduser('~')
+    return sorted(glob.glob(os.path.join(root, '.mcrCache*')))
+
+
+def dir_size(path):
+    size = 0
+    for pth, dirs, files in os.walk(path):
+        size += sum(os.path.getsize(os.path.join(pth, file)) for file in files
+                    if not os.path.islink(os.path.join(pth, file)))
+    return size
+
+
+def prepare_mcr_cache(slots):
+    """Creates one MATLAB Runtime component cache per worker slot on MCR_CACHE_SHM, copied from mcr_cache_templates
+    so that the first launch of each slot is warm, and kept across runs of the container.
+    Nothing is copied when the image has no extracted cache or MCR_CACHE_SHM has no room for the missing slot caches,
+    the MATLAB Runtime then uses its default location
+    Returns:
+        mcr_cache_dir (str): directory of the slot_<n> caches, each one is the MCR_CACHE_ROOT of its slot, None if not created
+    """
+    templates = mcr_cache_templates()
+    if not templates or not os.path.isdir(MCR_CACHE_SHM):
+        return None
+    mcr_cache_dir = os.path.join(MCR_CACHE_SHM, 'vbm_mcr_cache')
+    missing = [(os.path.join(mcr_cache_dir, 'slot_%d' % slot, os.path.basename(template)), template)
+               for slot in range(slots) for template in templates
+               if not os.path.isdir(os.path.join(mcr_cache_dir, 'slot_%d' % slot, os.path.basename(template)))]
+    needed = sum(dir_size(template) for cache, template in missing) + MCR_CACHE_MARGIN
+    if missing and shutil.disk_usage(MCR_CACHE_SHM).free <= needed:
+        return None
+
+    for cache, template in missing:
+        try:
+            shutil.copytree(template, cache, symlinks=True)
+        except OSError:
+            # MCR_CACHE_SHM filled up meanwhile, a partial cache would be taken as warm
+            shutil.rmtree(cache, ignore_errors=True)
+            return None
+    return mcr_cache_dir
+
+
+def use_mcr_cache(mcr_cache_dir, slot):
+    """Sets the cache of slot as MCR_CACHE_ROOT of the spm processes started by this process"""
+    if mcr_cache_dir:
+        os.environ['MCR_CACHE_ROOT'] = os.path.join(mcr_cache_dir, 'slot_%d' % slot)
+
+
+def claim_mcr_slot(lock_dir, slots):
+    """Returns the first slot of slots not claimed yet by another worker process of lock_dir"""
+    for slot in range(slots):
+        try:
+            os.close(os.open(os.path.join(lock_dir, 'mcr_slot_%d' % slot), os.O_CREAT | os.O_EXCL))
+            return slot
+        except FileExistsError:
+            continue
+    return os.getpid() % slots
+
+
+def mcr_cache_state():
+    """Returns 'warm' when MCR_CACHE_ROOT already holds an extracted component cache, 'cold' when the next MATLAB
+    Runtime launch extracts it, None when the pipeline does not manage MCR_CACHE_ROOT
+    """
+    root = os.environ.get('MCR_CACHE_ROOT')
+    if not root:
+        return None
+    return 'warm' if glob.glob(os.path.join(root, '.mcrCache*', '*')) else 'cold'
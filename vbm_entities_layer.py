@@ -4,21 +4,98 @@
 This layer defines the nodes of pre-processing pipeline and correlation computation function
 """
 
+import os, tempfile
+import numpy as np
+import vbm_cache
+import vbm_storage
 import nipype.pipeline.engine as pe
 import nipype.interfaces.spm as spm
 spm.terminal_output = 'file'
+from nipype.interfaces.base import isdefined
 from nipype.interfaces.io import DataSink
 from nipype.interfaces.utility import Function
+from nipype.utils.filemanip import split_filename
 
 #Stop printing nipype.workflow info to stdout
 from nipype import logging
 logging.getLogger('nipype.workflow').setLevel('CRITICAL')
 
 
+## spm interfaces of the pipeline ##
+class SPMVersion:
+    """Mixin of the spm interfaces of the pipeline: they run the MCR command of use_spm, or send their jobs to the
+    persistent spm workers of its worker socket (spm_cmd), and answer their version checks (at init and at every run)
+    with vbm_cache.spm_version. nipype's spm.Info.getinfo keeps a single memo, which the checks made before the
+    matlab_cmd input of an interface is set overwrite, so MATLAB would start at every check
+    """
+    _matlab_cmd = None
+    _use_mcr = None
+    # Socket of the spm_worker.SPMWorkerServer running the jobs, None starts the MCR for each job
+    _worker_socket = None
+
+    @property
+    def version(self):
+        matlab_cmd = self.inputs.matlab_cmd if isdefined(self.inputs.matlab_cmd) else self._matlab_cmd
+        return vbm_cache.spm_version(matlab_cmd) or super().version
+
+    def _matlab_cmd_update(self):
+        super()._matlab_cmd_update()
+        if isdefined(self.inputs.matlab_cmd):
+            self.mlab._cmd = spm_cmd(self.inputs.matlab_cmd)
+
+    def _run_interface(self, runtime):
+        # The command is chosen again when the job runs, interfaces created before use_spm set the worker socket use it too
+        self._matlab_cmd_update()
+        return super()._run_interface(runtime)
+
+
+def use_spm(matlab_cmd, worker_socket=None):
+    """Sets matlab_cmd as the MCR command of the spm interfaces of the pipeline, as SPMCommand.set_mlab_paths does for nipype's
+    With the worker_socket of a spm_worker.SPMWorkerServer their jobs are sent to its persistent workers instead
+    """
+    SPMVersion._matlab_cmd = matlab_cmd
+    SPMVersion._use_mcr = True
+    SPMVersion._worker_socket = worker_socket
+
+
+def spm_cmd(matlab_cmd):
+    """Returns the command that runs the spm jobs of matlab_cmd: the client of the persistent spm workers
+    (spm_worker.client_cmd) when use_spm set their socket, matlab_cmd otherwise
+    """
+    if SPMVersion._worker_socket is None:
+        return matlab_cmd
+    import spm_worker
+    return spm_worker.client_cmd(SPMVersion._worker_socket)
+
+
+class SPMCommand(SPMVersion, spm.SPMCommand):
+    pass
+
+
+class ApplyTransform(SPMVersion, spm.ApplyTransform):
+    pass
+
+
+class NewSegment(SPMVersion, spm.NewSegment):
+
+    def __init__(self, **inputs):
+        # spm.NewSegment.__init__ asks the version of a new spm.SPMCommand
+        version = SPMCommand().version
+        if version and '12.' in version:
+            self._jobtype, self._jobname = 'spatial', 'preproc'
+        else:
+            self._jobtype, self._jobname = 'tools', 'preproc8'
+        spm.SPMCommand.__init__(self, **inputs)
+
+
+class SPMSmooth(SPMVersion, spm.Smooth):
+    pass
+
+
 ## Reorientation node & settings ##
 class Reorient:
     def __init__(self, **template_dict):
-        self.node = pe.Node(interface=spm.ApplyTransform(), name='reorient')
+        self.node = pe.Node(interface=ApplyTransform(), name='reorient')
         self.node.inputs.mat = template_dict['transf_mat_path']
         self.node.inputs.paths = template_dict['spm_path']
 
@@ -35,7 +112,7 @@ class Segment:
          - which maps to save (Corrected, Field) - a tuple of two boolean
         values
         """
-        self.node = pe.Node(interface=spm.NewSegment(), name='segmentation')
+        self.node = pe.Node(interface=NewSegment(), name='segmentation')
         self.node.inputs.paths = template_dict['spm_path']
         self.node.inputs.channel_info = (
             template_dict['BIAS_REGULARISATION'],
@@ -48,7 +125,8 @@ class Segment:
 
 
 def transform_list(normalized_class_images):
-    return [each[0] for each in normalized_class_images]
+    # Tissues whose normalized maps are not written have no images (output profile)
+    return [each[0] for each in normalized_class_images if each]
 
 
 class List_Normalized_Images:
@@ -69,13 +147,393 @@ class Smooth:
                 3-list of fwhm for each dimension
                 This is the size of the Gaussian (in mm) for smoothing the preprocessed data by. This is typically between about 4mm and 12mm.
         """
-        self.node = pe.Node(interface=spm.Smooth(), name='smoothing')
+        self.node = pe.Node(interface=SPMSmooth(), name='smoothing')
         self.node.inputs.paths = template_dict['spm_path']
-        self.node.inputs.fwhm = template_dict['FWHM_SMOOTH']
+        self.node.inputs.fwhm = smooth_kernels(template_dict['FWHM_SMOOTH'])[0]
         self.node.inputs.implicit_masking=template_dict['implicit_masking']
+        # Integer output storage has spm write the smoothed maps in its type (vbm_storage.spm_data_type)
+        data_type = vbm_storage.spm_data_type(template_dict['output_storage'])
+        if data_type is not None:
+            self.node.inputs.data_type = data_type
 
 
 ## Datsink Node that collects segmented, smoothed files and writes to temp_write_dir ##
 class Datasink:
     def __init__(self):
         self.node = pe.Node(interface=DataSink(), name='sinker')
+
+
+def smooth_kernels(fwhm):
+    """This function returns FWHM_SMOOTH as a list of [x, y, z] kernels in mm, FWHM_SMOOTH is one kernel or a list of kernels"""
+    if isinstance(fwhm[0], (list, tuple)):
+        return [[float(each) for each in kernel] for kernel in fwhm]
+    return [[float(each) for each in fwhm]]
+
+
+def smooth_prefixes(fwhm):
+    """This function returns (prefix, kernel) of each smoothing kernel
+    The first kernel keeps the prefix s of spm.Smooth, the others of a sweep are named after their size, ex: s8wc1Re.nii, s6x6x8wc1Re.nii
+    """
+    prefixes = list()
+    for count, kernel in enumerate(smooth_kernels(fwhm)):
+        if count == 0:
+            prefixes.append(('s', kernel))
+        elif kernel[0] == kernel[1] == kernel[2]:
+            prefixes.append(('s%g' % kernel[0], kernel))
+        else:
+            prefixes.append(('s%gx%gx%g' % tuple(kernel), kernel))
+    return prefixes
+
+
+# Maps written by the segmentation for each tissue of an output profile, (native, unmodulated, modulated)
+# All six tissues are still segmented, the maps of the tissues not listed are not written (nor smoothed)
+# minimal keeps the unmodulated grey matter map besides c1, c2, smwc1, smwc2 for the QC (swc1) and the display image (wc1)
+OUTPUT_PROFILES = {
+    'minimal': {
+        1: (True, True, True),
+        2: (True, False, True)
+    },
+    'standard': {tissue_id: (True, True, True) for tissue_id in (1, 2, 3)},
+    'full': {tissue_id: (True, True, True) for tissue_id in range(1, 7)}
+}
+
+
+def profile_maps(profile, tissue_id):
+    """This function returns the (native, unmodulated, modulated) maps of tissue_id written with the output profile"""
+    return OUTPUT_PROFILES[profile].get(tissue_id, (False, False, False))
+
+
+def output_types(profile, fwhm):
+    """This function returns the spm12 outputs (file names without .nii) of the output profile, ex: c1Re, smwc1Re
+    with the extra kernels of a smoothing sweep, ex: s8wc1Re
+    """
+    types = ['Re']
+    for tissue_id in sorted(OUTPUT_PROFILES[profile]):
+        native, unmodulated, modulated = profile_maps(profile, tissue_id)
+        types.extend(
+            [map_type % tissue_id for write, map_type in ((native, 'c%dRe'), (unmodulated, 'wc%dRe'),
+                                                          (unmodulated, 'swc%dRe'), (modulated, 'mwc%dRe'),
+                                                          (modulated, 'smwc%dRe')) if write])
+    types = sorted(types)
+    return types + [
+        prefix + type for prefix, kernel in smooth_prefixes(fwhm)[1:]
+        for type in types if type.startswith(('wc', 'mwc'))]
+
+
+def run_matlab_script(script, name):
+    """This function runs a matlab script with the matlab command of the spm nodes"""
+    work_dir = tempfile.mkdtemp(dir=os.getcwd())
+    mlab = SPMCommand().mlab
+    mlab.inputs.script_file = os.path.join(work_dir, 'pyscript_%s.m' % name)
+    mlab.inputs.script = script
+    result = mlab.run(cwd=work_dir)
+    if 'MATLAB code threw an exception' in result.runtime.stderr:
+        raise RuntimeError(result.runtime.stderr)
+
+
+## Smoothing sweep: every kernel of FWHM_SMOOTH from one read of each image ##
+class SmoothSweep:
+    def __init__(self, **template_dict):
+        """
+        smooth_sweep.run(files) smooths each file with all kernels of FWHM_SMOOTH, the image is read once and
+        smoothed in memory with spm_smooth for each kernel. Kernels are converted from mm to voxels with the image affine
+        and implicit_masking masks the voxels that are zero in the input, as spm.Smooth does
+        """
+        self.prefixes = smooth_prefixes(template_dict['FWHM_SMOOTH'])
+        self.implicit_masking = template_dict['implicit_masking']
+
+    def setup(self):
+        """Returns the matlab code defining the kernels of the sweep"""
+        return """
+vbm_sweep_fwhm = [%s];
+vbm_sweep_prefix = {%s};
+""" % ('; '.join('%g %g %g' % tuple(kernel) for prefix, kernel in self.prefixes),
+        '; '.join("'%s'" % prefix for prefix, kernel in self.prefixes))
+
+    def code(self, files):
+        """Returns the matlab code smoothing the files of the matlab cell array expression files"""
+        return """
+vbm_sweep_files = %s;
+for vbm_f = 1:numel(vbm_sweep_files)
+    vbm_V = spm_vol(vbm_sweep_files{vbm_f});
+    vbm_Y = spm_read_vols(vbm_V);
+    vbm_vx = sqrt(sum(vbm_V.mat(1:3,1:3).^2));
+    [vbm_pth, vbm_nam, vbm_ext] = spm_fileparts(vbm_V.fname);
+    for vbm_k = 1:size(vbm_sweep_fwhm, 1)
+        vbm_Q = zeros(size(vbm_Y));
+        spm_smooth(vbm_Y, vbm_Q, vbm_sweep_fwhm(vbm_k,:) ./ vbm_vx);
+        if %d, vbm_Q(vbm_Y == 0) = NaN; end
+        vbm_Vo = vbm_V;
+        vbm_Vo.fname = fullfile(vbm_pth, [vbm_sweep_prefix{vbm_k} vbm_nam vbm_ext]);
+        vbm_Vo.descrip = sprintf('spm - %%gx%%gx%%g mm smoothed', vbm_sweep_fwhm(vbm_k,:));
+        spm_write_vol(vbm_Vo, vbm_Q);
+    end
+end
+""" % (files, int(bool(self.implicit_masking)))
+
+    def outputs(self, files):
+        """Returns the smoothed files of files"""
+        return [
+            os.path.join(os.path.dirname(file), prefix + os.path.basename(file))
+            for file in files for prefix, kernel in self.prefixes
+        ]
+
+    def run(self, files):
+        script = """
+%% Generated by vbm_entities_layer.SmoothSweep
+spm('Defaults','fMRI');
+%s%s""" % (self.setup(), self.code(cell_array(files)))
+        run_matlab_script(script, 'smoothsweep')
+        missing = [f for f in self.outputs(files) if not os.path.isfile(f)]
+        if missing:
+            raise RuntimeError('smoothing sweep did not write ' + ', '.join(missing))
+
+
+def cell_array(files):
+    """This function returns a matlab cell array of file names"""
+    return '{%s}' % ';'.join("'%s'" % file for file in files)
+
+
+## Single spm batch per subject: reorientation, segmentation and smoothing of wc*, mwc* ##
+class SubjectBatch:
+    def __init__(self, reorient, segment, smooth, sweep=None):
+        """
+        subject_batch.script(in_file, out_file) chains the settings of the reorient, segment and smooth nodes into one matlab script.
+        Reorientation runs the code of spm.ApplyTransform, then one matlabbatch segments out_file and smooths its wc* and mwc* images,
+        which the smooth job takes from the segmentation as batch dependencies (cfg_dep).
+        With a SmoothSweep (several FWHM_SMOOTH kernels) the sweep smooths the images after the segmentation instead of the smooth job,
+        without smooth node and sweep (smooth_backend='python') the script does not smooth.
+        All outputs are written next to out_file with the same names as the nipype workflow and smooth_images
+        """
+        self.reorient = reorient.interface
+        self.segment = segment.interface
+        self.smooth = smooth.interface if smooth is not None else None
+        self.sweep = sweep
+
+    def reorient_script(self, in_file, out_file):
+        return """
+infile = '%s';
+outfile = '%s';
+transform = load('%s');
+V = spm_vol(infile);
+X = spm_read_vols(V);
+V.mat = transform.M * V.mat;
+V.fname = fullfile(outfile);
+spm_write_vol(V,X);
+""" % (in_file, out_file, self.reorient.inputs.mat)
+
+    def segment_job(self, index, out_file):
+        """Returns the NewSegment job of out_file as matlabbatch{index}"""
+        contents = self.segment._parse_inputs(
+            skip=('channel_files', 'channel_info'))[0]
+        channel = {'vols': np.array(['%s,1' % out_file], dtype=object)}
+        if isdefined(self.segment.inputs.channel_info):
+            info = self.segment.inputs.channel_info
+            channel['biasreg'] = info[0]
+            channel['biasfwhm'] = info[1]
+            channel['write'] = [int(info[2][0]), int(info[2][1])]
+        contents['channel'] = [channel]
+        return self.segment._generate_job(
+            'matlabbatch{%d}.spm.%s.%s' % (index, self.segment.jobtype,
+                                           self.segment.jobname), contents)
+
+    def smooth_job(self, index):
+        """Returns the Smooth job settings as matlabbatch{index}, without its data"""
+        return self.smooth._generate_job(
+            'matlabbatch{%d}.spm.spatial.smooth' % index,
+            self.smooth._parse_inputs(skip=('in_files', ))[0])
+
+    def smoothed_maps(self):
+        """Returns (map_type, tissue number) of the wc*, mwc* images written by the segmentation, in smoothing order"""
+        return [(map_type, i + 1)
+                for map_index, map_type in ((0, 'wc'), (1, 'mwc'))
+                for i, tissue in enumerate(self.segment.inputs.tissues)
+                if tissue[3][map_index]]
+
+    def smoothed_files(self, out_file):
+        """Returns the wc*, mwc* images of out_file, in smoothing order"""
+        pth, base, ext = split_filename(out_file)
+        return [
+            os.path.join(pth, '%s%d%s.nii' % (map_type, tissue, base))
+            for map_type, tissue in self.smoothed_maps()
+        ]
+
+    def smooth_setup(self):
+        """Returns the matlab code setting up the smoothing of smooth_code"""
+        if self.sweep is not None:
+            return self.sweep.setup()
+        if self.smooth is None:
+            return ''
+        return 'clear matlabbatch;\n' + self.smooth_job(1)
+
+    def smooth_code(self, files):
+        """Returns the matlab code smoothing the files of the matlab cell array expression files"""
+        if self.sweep is not None:
+            return self.sweep.code(files)
+        if self.smooth is None:
+            return ''
+        return """
+matlabbatch{1}.spm.spatial.smooth.data = %s;
+spm_jobman('run', matlabbatch);
+""" % files
+
+    def script(self, in_file, out_file):
+        if self.smooth is None:
+            return """
+%% Generated by vbm_entities_layer.SubjectBatch
+[name, version] = spm('ver');
+fprintf('SPM version: %%s Release: %%s\\n',name, version);
+spm('Defaults','fMRI');
+spm_jobman('initcfg');
+spm_get_defaults('cmdline', 1);
+%s
+%s
+spm_jobman('run', matlabbatch);
+%s%s
+close('all', 'force');
+""" % (self.reorient_script(in_file, out_file), self.segment_job(1, out_file),
+            self.smooth_setup(), self.smooth_code(cell_array(self.smoothed_files(out_file))))
+
+        dependencies = ''
+        for count, (map_type, tissue) in enumerate(self.smoothed_maps(), start=1):
+            dependencies += (
+                "matlabbatch{2}.spm.spatial.smooth.data(%d) = cfg_dep('Segment: %s%d Images', "
+                "substruct('.','val', '{}',{1}, '.','val', '{}',{1}, '.','val', '{}',{1}), "
+                "substruct('.','tiss', '()',{%d}, '.','%s', '()',{':'}));\n"
+                % (count, map_type, tissue, tissue, map_type))
+
+        return """
+%% Generated by vbm_entities_layer.SubjectBatch
+[name, version] = spm('ver');
+fprintf('SPM version: %%s Release: %%s\\n',name, version);
+spm('Defaults','fMRI');
+spm_jobman('initcfg');
+spm_get_defaults('cmdline', 1);
+%s
+%s%s%s
+spm_jobman('run', matlabbatch);
+close('all', 'force');
+""" % (self.reorient_script(in_file, out_file), self.segment_job(1, out_file),
+        dependencies, self.smooth_job(2))
+
+    def outputs(self, out_file):
+        """Returns the files the script writes for out_file"""
+        pth, base, ext = split_filename(out_file)
+        outputs = [out_file, os.path.join(pth, '%s_seg8.mat' % base)]
+        for i, tissue in enumerate(self.segment.inputs.tissues):
+            if tissue[2][0]:
+                outputs.append(os.path.join(pth, 'c%d%s.nii' % (i + 1, base)))
+        smoothed_files = self.smoothed_files(out_file)
+        outputs.extend(smoothed_files)
+        if self.sweep is not None:
+            outputs.extend(self.sweep.outputs(smoothed_files))
+        elif self.smooth is not None:
+            outputs.extend(
+                os.path.join(pth, self.smooth.inputs.out_prefix + os.path.basename(file))
+                for file in smoothed_files)
+        return outputs
+
+    def run_script(self, script):
+        """Runs a matlab script with the matlab command of the spm nodes"""
+        run_matlab_script(script, self.__class__.__name__.lower())
+
+    def run(self, in_file, out_file):
+        """Runs the script of one subject"""
+        self.run_script(self.script(in_file, out_file))
+        missing = [f for f in self.outputs(out_file) if not os.path.isfile(f)]
+        if missing:
+            raise RuntimeError('spm batch did not write ' + ', '.join(missing))
+
+
+## Stage-major spm batch of several subjects: all reorientations, then all segmentations, then smoothing ##
+class CohortBatch(SubjectBatch):
+    """
+    cohort_batch.run(files) runs reorientation, segmentation and smoothing of a list of (in_file, out_file) subjects in one matlab run.
+    Every subject runs its own spm jobs inside try/catch so that one bad scan only fails that subject.
+    Smoothing of all subjects is one spm job (or one SmoothSweep), if it fails each subject is smoothed separately
+    """
+
+    def script(self, files, status_file):
+        script = """
+%% Generated by vbm_entities_layer.CohortBatch
+[name, version] = spm('ver');
+fprintf('SPM version: %%s Release: %%s\\n',name, version);
+spm('Defaults','fMRI');
+spm_jobman('initcfg');
+spm_get_defaults('cmdline', 1);
+vbm_failed = false(1, %d);
+vbm_errors = repmat({''}, 1, %d);
+vbm_smooth_files = cell(1, %d);
+""" % (len(files), len(files), len(files))
+
+        for n, (in_file, out_file) in enumerate(files, start=1):
+            script += """
+try
+%s
+catch vbm_err
+    vbm_failed(%d) = true; vbm_errors{%d} = vbm_err.message;
+end
+""" % (self.reorient_script(in_file, out_file), n, n)
+
+        for n, (in_file, out_file) in enumerate(files, start=1):
+            pth, base, ext = split_filename(out_file)
+            script += """
+if ~vbm_failed(%d)
+    try
+        clear matlabbatch;
+%s        spm_jobman('run', matlabbatch);
+    catch vbm_err
+        vbm_failed(%d) = true; vbm_errors{%d} = vbm_err.message;
+    end
+end
+vbm_smooth_files{%d} = {%s};
+""" % (n, self.segment_job(1, out_file), n, n, n, ';'.join(
+                "'%s,1'" % os.path.join(pth, '%s%d%s.nii' % (map_type, tissue, base))
+                for map_type, tissue in self.smoothed_maps()))
+
+        script += """
+%s
+try
+    if any(~vbm_failed)
+%s
+    end
+catch
+    for vbm_n = find(~vbm_failed)
+        try
+%s
+        catch vbm_err
+            vbm_failed(vbm_n) = true; vbm_errors{vbm_n} = vbm_err.message;
+        end
+    end
+end
+
+vbm_fid = fopen('%s', 'w');
+for vbm_n = 1:numel(vbm_failed)
+    fprintf(vbm_fid, '%%d\\t%%s\\n', vbm_failed(vbm_n), strrep(vbm_errors{vbm_n}, sprintf('\\n'), ' '));
+end
+fclose(vbm_fid);
+close('all', 'force');
+""" % (self.smooth_setup(),
+       self.smooth_code('vertcat(vbm_smooth_files{~vbm_failed})'),
+       self.smooth_code('vbm_smooth_files{vbm_n}'), status_file)
+        return script
+
+    def run(self, files):
+        """Runs the script of the subjects
+        Returns:
+            errors (list): None for each subject that completed, otherwise its error text
+        """
+        status_file = os.path.join(tempfile.mkdtemp(dir=os.getcwd()), 'vbm_batch_status.txt')
+        self.run_script(self.script(files, status_file))
+        if not os.path.isfile(status_file):
+            raise RuntimeError('spm batch did not complete')
+        with open(status_file) as fp:
+            status = [line.rstrip('\n').split('\t', 1) for line in fp]
+
+        errors = list()
+        for (failed, error), (in_file, out_file) in zip(status, files):
+            if failed == '0':
+                missing = [f for f in self.outputs(out_file) if not os.path.isfile(f)]
+                error = 'spm batch did not write ' + ', '.join(missing) if missing else None
+            errors.append(error)
+        return errors
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This layer keeps the state of every subject of a run in an SQLite ledger in the output directory (ledger_filename)
+
+Each subject is one row of the subjects table: its input, state (queued, running, done, failed), the last stage it
+reached, correlation value, error text, result cache hit/miss, wall time and output directory, with its stage keys
+(vbm_cache.stage_keys) and other outputs (ex: regression input file) as json.
+The process running a subject writes each change of its row in its own transaction, so that a run killed at any
+point leaves every subject either done with all its outputs or to be run again.
+run_pipeline queues the subjects of a run with begin, skips the ones already done with the same stage keys and
+builds the final message, QA flagged list and covariates output from the rows of the run (results)
+"""
+import os, time, sqlite3, contextlib
+import ujson as json
+
+# States of a subject
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+# Seconds a process waits for another one to release the ledger
+BUSY_TIMEOUT = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS subjects (
+    sub_id TEXT PRIMARY KEY,
+    input TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    in_run INTEGER NOT NULL DEFAULT 0,
+    state TEXT NOT NULL,
+    stage TEXT,
+    covalue REAL,
+    error TEXT,
+    cache TEXT,
+    vbm_out TEXT,
+    stages TEXT,
+    outputs TEXT,
+    started REAL,
+    finished REAL,
+    wall_s REAL,
+    updated REAL
+)
+"""
+
+# Keys of a subject result kept in their own column, the others are kept in outputs
+RESULT_COLUMNS = ('sub_id', 'covalue', 'error', 'cache', 'vbm_out', 'stages')
+
+# Keys added to the subject results by results, not kept in outputs
+ROW_KEYS = ('input', 'state', 'stage', 'wall_s')
+
+
+@contextlib.contextmanager
+def transaction(ledger_file):
+    """Opens the ledger and runs the block in one transaction, committed at the end or rolled back on error"""
+    conn = sqlite3.connect(ledger_file, timeout=BUSY_TIMEOUT, isolation_level=None)
+    try:
+        conn.row_factory = sqlite3.Row
+        conn.execute(SCHEMA)
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
+
+
+def write_result(conn, result, state, stage, now):
+    """Writes the result of a subject in its row, the wall time runs from its first running state to done/failed"""
+    outputs = {key: value for key, value in result.items() if key not in RESULT_COLUMNS + ROW_KEYS}
+    conn.execute(
+        'UPDATE subjects SET state = ?, stage = COALESCE(?, stage), covalue = ?, error = ?, cache = ?, '
+        'vbm_out = ?, stages = ?, outputs = ?, updated = ?, '
+        'started = CASE WHEN ? = ? THEN COALESCE(started, ?) ELSE started END, '
+        'finished = CASE WHEN ? IN (?, ?) THEN ? ELSE NULL END, '
+        'wall_s = CASE WHEN ? IN (?, ?) THEN ? - COALESCE(started, ?) ELSE NULL END '
+        'WHERE sub_id = ?',
+        (state, stage, result['covalue'], result['error'], result['cache'], result['vbm_out'],
+         json.dumps(result['stages']) if result['stages'] is not None else None, json.dumps(outputs), now,
+         state, RUNNING, now,
+         state, DONE, FAILED, now,
+         state, DONE, FAILED, now, now,
+         result['sub_id']))
+
+
+def begin(ledger_file, subjects, done=()):
+    """Marks subjects, a list of (sub_id, input), as the subjects of the run in their order
+    done are the results of the subjects skipped by the run, the others are queued
+    """
+    now = time.time()
+    done = {result['sub_id']: result for result in done}
+    with transaction(ledger_file) as conn:
+        conn.execute('UPDATE subjects SET in_run = 0')
+        for position, (sub_id, each_sub) in enumerate(subjects, start=1):
+            state = conn.execute('SELECT state FROM subjects WHERE sub_id = ?', (sub_id, )).fetchone()
+            conn.execute(
+                'INSERT INTO subjects (sub_id, input, position, in_run, state, updated) VALUES (?, ?, ?, 1, ?, ?) '
+                'ON CONFLICT(sub_id) DO UPDATE SET input = excluded.input, position = excluded.position, in_run = 1',
+                (sub_id, each_sub, position, QUEUED, now))
+            if sub_id not in done:
+                conn.execute(
+                    'UPDATE subjects SET state = ?, stage = NULL, covalue = NULL, error = NULL, cache = NULL, '
+                    'stages = NULL, outputs = NULL, started = NULL, finished = NULL, wall_s = NULL, updated = ? '
+                    'WHERE sub_id = ?', (QUEUED, now, sub_id))
+            elif state is None or state[0] != DONE:
+                # Done by a previous run without a ledger row (coinstac record)
+                write_result(conn, done[sub_id], DONE, None, now)
+
+
+def record(ledger_file, result, state, stage=None):
+    """Writes the result of a subject in state, stage is the stage it starts (None keeps the last one)"""
+    with transaction(ledger_file) as conn:
+        write_result(conn, result, state, stage, time.time())
+
+
+def results(ledger_file, in_run=True):
+    """Returns the rows of the subjects of the run (all rows with in_run=False) in their order, as subject results
+    with their input, state, stage and wall time
+    """
+    if not os.path.isfile(ledger_file):
+        return list()
+    with transaction(ledger_file) as conn:
+        rows = conn.execute(
+            'SELECT * FROM subjects' + (' WHERE in_run = 1' if in_run else '') + ' ORDER BY in_run DESC, position'
+        ).fetchall()
+
+    subject_results = list()
+    for row in rows:
+        result = json.loads(row['outputs']) if row['outputs'] else dict()
+        result.update({column: row[column] for column in RESULT_COLUMNS})
+        result['stages'] = json.loads(row['stages']) if row['stages'] else None
+        result.update({
+            'input': row['input'],
+            'state': row['state'],
+            'stage': row['stage'],
+            'wall_s': row['wall_s']
+        })
+        subject_results.append(result)
+    return subject_results
+
+
+def counts(ledger_file):
+    """Returns the number of subjects of the run in each state"""
+    with transaction(ledger_file) as conn:
+        return dict(conn.execute('SELECT state, COUNT(*) FROM subjects WHERE in_run = 1 GROUP BY state').fetchall())
+
+
+def errors(ledger_file):
+    """Returns the error text of each failed subject of the run, in their order"""
+    with transaction(ledger_file) as conn:
+        return dict(
+            conn.execute('SELECT sub_id, error FROM subjects WHERE in_run = 1 AND state = ? ORDER BY position',
+                         (FAILED, )).fetchall())
+
+
+def flagged(ledger_file, correlation_value):
+    """Returns the sub-ids of the done subjects of the run whose correlation value rounds below correlation_value"""
+    with transaction(ledger_file) as conn:
+        rows = conn.execute(
+            'SELECT sub_id, covalue FROM subjects WHERE in_run = 1 AND state = ? AND covalue IS NOT NULL '
+            'ORDER BY position', (DONE, )).fetchall()
+    return [sub_id for sub_id, covalue in rows if round(covalue, 2) < correlation_value]
+
+
+def interrupt(ledger_file, error):
+    """Marks the subjects of the run still running as failed with error, ex: their worker process died before their
+    outputs were stored
+    """
+    now = time.time()
+    with transaction(ledger_file) as conn:
+        conn.execute(
+            'UPDATE subjects SET state = ?, error = ?, finished = ?, wall_s = ? - COALESCE(started, ?), updated = ? '
+            'WHERE in_run = 1 AND state = ?', (FAILED, error, now, now, now, now, RUNNING))
@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Microbenchmarks of the python hot paths of the pipeline with regression thresholds:
+get_corr (QC correlation), nii_to_image_converter (display image), make_file_output (covariates layout),
+resample_nifti_images (regression inputs, needs AFNI), spm_matrix.spm_matrix (reorientation matrix), the
+zip archive of the outputs and the import of run_vbm
+
+python3 vbm_microbenchmark.py [--save baseline.json] [--compare baseline.json] [--threshold 20] [--repeat 3]
+                              [--cohorts 10 100 1000] [--cohort-resolution small] [--only get_corr ...]
+
+Volume benchmarks run on generated MNI sized volumes at 1.5 mm (121x145x121, the TPM grid) and 1 mm (182x218x182).
+Cohort benchmarks (make_file_output, archive) run on cohorts of --cohorts subjects, with images on the
+--cohort-resolution grid: small (32x32x32, the cost per file) by default, 1.5mm or 1mm for the cost per byte.
+Each case reports the median and min seconds of --repeat runs after one warm-up run.
+--save writes the results as a JSON baseline, --compare exits 1 when the median of a case is more than
+--threshold percent slower than in the baseline.
+import_run_vbm is the import time of run_vbm reported by python -X importtime in a new interpreter,
+it also exits 1 when over IMPORT_BUDGET_S whatever the baseline
+"""
+import os, re, sys, time, shutil, argparse, platform, tempfile, subprocess
+import ujson as json
+import numpy as np
+import nibabel as nib
+
+# Grids of the generated volumes: shape and voxel size in mm
+RESOLUTIONS = {
+    'small': ((32, 32, 32), 1.5),
+    '1.5mm': ((121, 145, 121), 1.5),
+    '1mm': ((182, 218, 182), 1.)
+}
+VOLUME_RESOLUTIONS = ('1.5mm', '1mm')
+
+# Calls of spm_matrix per timed run, a single call is too short to time
+SPM_MATRIX_CALLS = 10000
+
+# Default percentage a case may be slower than its baseline before --compare fails
+THRESHOLD = 20.
+
+# Largest import time of run_vbm in seconds, paid by every coinstac call before any input is checked
+IMPORT_BUDGET_S = 0.25
+
+
+def mni_affine(voxel_size, shape):
+    """Returns an MNI affine with the origin at the centre of the grid (as spm templates, x flipped)"""
+    affine = np.diag([-voxel_size, voxel_size, voxel_size, 1.])
+    affine[:3, 3] = -affine[:3, :3].dot((np.array(shape) - 1) / 2.)
+    return affine
+
+
+def make_volume(file_name, resolution, volumes=1, seed=0):
+    """Writes a float32 volume of the resolution grid, a smooth blob of grey matter like values"""
+    shape, voxel_size = RESOLUTIONS[resolution]
+    grid = np.stack(np.meshgrid(*[np.linspace(-1, 1, n, dtype=np.float32) for n in shape], indexing='ij'))
+    radius = np.sqrt((grid**2).sum(axis=0))
+    rng = np.random.default_rng(seed)
+    data = np.stack([
+        np.exp(-((radius - centre) / 0.15)**2) + 0.05 * rng.random(shape, dtype=np.float32)
+        for centre in np.linspace(0.5, 1.3, volumes)
+    ], axis=-1).astype(np.float32)
+    if volumes == 1:
+        data = data[..., 0]
+    nib.save(nib.Nifti1Image(data, mni_affine(voxel_size, shape)), file_name)
+
+
+def make_cohort(write_dir, subjects, resolution, link=True):
+    """Writes the spm12 outputs of a cohort as the pipeline leaves them in write_dir (one directory per subject)
+    The outputs of a subject are hard links of one volume, so that large cohorts fit on disk, or copies of it (link=False)
+    Returns:
+        covariates (dict): covariates of the subjects keyed by input file name
+    """
+    volume = os.path.join(os.path.dirname(write_dir), 'volume.nii')
+    make_volume(volume, resolution)
+    covariates = dict()
+    for n in range(subjects):
+        sub_id = 'sub%05d_T1w' % n
+        subject_dir = os.path.join(write_dir, sub_id, 'anat', 'vbm_spm12')
+        os.makedirs(subject_dir)
+        for type in spm12_types():
+            (os.link if link else shutil.copy)(volume, os.path.join(subject_dir, type + '.nii'))
+        covariates[sub_id + '.nii'] = {'isControl': bool(n % 2), 'age': 20 + n % 50}
+    return covariates
+
+
+def spm12_types():
+    import run_vbm, vbm_entities_layer
+    return vbm_entities_layer.output_types(run_vbm.template_dict['output_profile'],
+                                           run_vbm.template_dict['FWHM_SMOOTH'])
+
+
+def timed(run, repeat, setup=None):
+    """Returns the median and min seconds of repeat runs of run after a warm-up run, setup runs untimed before each"""
+    seconds = list()
+    for n in range(repeat + 1):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        run()
+        if n:
+            seconds.append(time.perf_counter() - start)
+    return {'median_s': float(np.median(seconds)), 'min_s': float(np.min(seconds)), 'repeat': repeat}
+
+
+def bench_get_corr(work_dir, resolution, repeat):
+    import run_vbm, vbm_subjects_layer
+    template_dict = dict(run_vbm.template_dict, tpm_path=os.path.join(work_dir, 'TPM.nii'))
+    make_volume(template_dict['tpm_path'], resolution, volumes=6)
+    segmented_file = os.path.join(work_dir, 'swc1Re.nii')
+    make_volume(segmented_file, resolution, seed=1)
+    # the TPM is read once per process, the warm-up run reads it
+    return timed(lambda: vbm_subjects_layer.get_corr(segmented_file, **template_dict), repeat)
+
+
+def bench_nii_to_image_converter(work_dir, resolution, repeat):
+    import run_vbm, vbm_subjects_layer
+    make_volume(os.path.join(work_dir, run_vbm.template_dict['display_nifti']), resolution)
+    return timed(
+        lambda: vbm_subjects_layer.nii_to_image_converter(work_dir, 'sub00000', **run_vbm.template_dict),
+        repeat)
+
+
+def bench_resample_nifti_images(work_dir, resolution, repeat):
+    import run_vbm, vbm_subjects_layer
+    if not shutil.which('3dresample'):
+        return {'skipped': 'AFNI 3dresample not found'}
+    image_file = os.path.join(work_dir, run_vbm.template_dict['regression_file'])
+    # resample_nifti_images removes its input, it is written again before each run
+    return timed(
+        lambda: vbm_subjects_layer.resample_nifti_images(
+            image_file, (2., 2., 2.), run_vbm.template_dict['regression_resample_method']),
+        repeat,
+        setup=lambda: make_volume(image_file, resolution))
+
+
+def bench_compress_image(work_dir, resolution, repeat):
+    import run_vbm, vbm_storage
+    image_file = os.path.join(work_dir, 'wc1Re.nii')
+    # compress_image removes its input, it is written again before each run
+    result = timed(
+        lambda: vbm_storage.compress_image(image_file, 'int16', run_vbm.template_dict['storage_threads']),
+        repeat,
+        setup=lambda: make_volume(image_file, resolution))
+    result['ratio'] = round(os.path.getsize(image_file + '.gz') / (np.prod(RESOLUTIONS[resolution][0]) * 4), 3)
+    return result
+
+
+def bench_spm_matrix(work_dir, resolution, repeat):
+    import spm_matrix
+    params = [1., 2., 3., 0.1, 0.2, 0.3, 1., 1., 1., 0., 0., 0.]
+
+    def run():
+        for n in range(SPM_MATRIX_CALLS):
+            spm_matrix.spm_matrix(params, 'T*R*Z*S')
+
+    result = timed(run, repeat)
+    result['calls'] = SPM_MATRIX_CALLS
+    return result
+
+
+def import_time(module):
+    """Returns the cumulative import time in seconds of module in a new interpreter, from python -X importtime"""
+    run = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    # import time: self [us] | cumulative | imported package
+    for line in run.stderr.splitlines():
+        fields = [field.strip() for field in line.split('|')]
+        if len(fields) == 3 and fields[2] == module:
+            return int(re.sub(r'\D', '', fields[1])) / 1e6
+    raise ValueError('no import time of ' + module)
+
+
+def bench_import_run_vbm(work_dir, resolution, repeat):
+    seconds = [import_time('run_vbm') for n in range(repeat)]
+    return {
+        'median_s': float(np.median(seconds)),
+        'min_s': float(np.min(seconds)),
+        'repeat': repeat,
+        'budget_s': IMPORT_BUDGET_S
+    }
+
+
+def bench_make_file_output(work_dir, subjects, resolution, repeat, covariates_layout='copy'):
+    import run_vbm, vbm_spm12_file_output
+    write_dir = os.path.join(work_dir, 'vbm_outputs')
+    covariates = make_cohort(write_dir, subjects, resolution)
+    covariates_dir = os.path.join(work_dir, 'vbm_outputs', 'covariates')
+    template_dict = dict(run_vbm.template_dict, covariates_layout=covariates_layout)
+    # a first file output of the cohort, the covariates of the previous run are removed before each run
+    return timed(
+        lambda: vbm_spm12_file_output.make_file_output(write_dir, template_dict, covariates),
+        repeat,
+        setup=lambda: shutil.rmtree(covariates_dir, ignore_errors=True))
+
+
+def bench_make_file_output_link(work_dir, subjects, resolution, repeat):
+    return bench_make_file_output(work_dir, subjects, resolution, repeat, 'link')
+
+
+def bench_archive(work_dir, subjects, resolution, repeat):
+    import run_vbm, vbm_archive
+    write_dir = os.path.join(work_dir, 'vbm_outputs')
+    # the archive compresses linked files once, each output is a file of its own
+    make_cohort(write_dir, subjects, resolution, link=False)
+    base_name = os.path.join(work_dir, run_vbm.template_dict['output_zip_dir'])
+
+    def run():
+        # the subjects added one after the other as run_pipeline does, without a previous zip to reuse members from
+        archive = vbm_archive.Archive(base_name, write_dir, run_vbm.template_dict['storage_threads'])
+        for sub_id in sorted(os.listdir(write_dir)):
+            archive.add([os.path.join(write_dir, sub_id)])
+        archive.finish()
+
+    return timed(run, repeat, setup=lambda: os.path.isfile(base_name + '.zip') and os.remove(base_name + '.zip'))
+
+
+# Benchmarks of one volume run per VOLUME_RESOLUTIONS, cohort benchmarks per cohort size
+VOLUME_BENCHMARKS = {
+    'get_corr': bench_get_corr,
+    'nii_to_image_converter': bench_nii_to_image_converter,
+    'resample_nifti_images': bench_resample_nifti_images,
+    'compress_image': bench_compress_image
+}
+COHORT_BENCHMARKS = {
+    'make_file_output': bench_make_file_output,
+    'make_file_output_link': bench_make_file_output_link,
+    'archive': bench_archive
+}
+OTHER_BENCHMARKS = {'spm_matrix': bench_spm_matrix, 'import_run_vbm': bench_import_run_vbm}
+
+
+def run_benchmarks(names, cohorts, cohort_resolution, repeat):
+    """Runs the benchmarks of names, each case in a new temporary directory
+    Returns:
+        results (dict): results keyed by case name, <benchmark>[<resolution>] or <benchmark>[<subjects>x<resolution>]
+    """
+    cases = list()
+    for name in names:
+        if name in VOLUME_BENCHMARKS:
+            cases.extend(('%s[%s]' % (name, resolution), VOLUME_BENCHMARKS[name], (resolution,))
+                         for resolution in VOLUME_RESOLUTIONS)
+        elif name in COHORT_BENCHMARKS:
+            cases.extend(('%s[%dx%s]' % (name, subjects, cohort_resolution), COHORT_BENCHMARKS[name],
+                          (subjects, cohort_resolution)) for subjects in cohorts)
+        else:
+            cases.append((name, OTHER_BENCHMARKS[name], (None,)))
+
+    results = dict()
+    for case, bench, args in cases:
+        work_dir = tempfile.mkdtemp(prefix='vbm_microbenchmark_')
+        try:
+            results[case] = bench(work_dir, *(args + (repeat,)))
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        sys.stderr.write('%-48s %s\n' % (case, format_result(results[case])))
+    return results
+
+
+def format_result(result):
+    if 'skipped' in result:
+        return 'skipped: ' + result['skipped']
+    return 'median %10.4f s  min %10.4f s' % (result['median_s'], result['min_s'])
+
+
+def compare(results, baseline, threshold):
+    """Returns the lines of the cases whose median is more than threshold percent slower than in the baseline"""
+    regressions = list()
+    for case, result in sorted(results.items()):
+        reference = baseline.get(case)
+        if 'median_s' not in result or not reference or 'median_s' not in reference:
+            continue
+        change = (result['median_s'] / max(reference['median_s'], 1e-9) - 1) * 100
+        print('%-48s %10.4f s  baseline %10.4f s  %+7.1f%%' % (case, result['median_s'], reference['median_s'],
+                                                               change))
+        if change > threshold:
+            regressions.append('%s is %.1f%% slower than its baseline (threshold %g%%)' % (case, change, threshold))
+    return regressions
+
+
+def main(argv):
+    names = list(VOLUME_BENCHMARKS) + list(COHORT_BENCHMARKS) + list(OTHER_BENCHMARKS)
+    parser = argparse.ArgumentParser(description='VBM python hot path microbenchmarks')
+    parser.add_argument('--only', nargs='+', choices=names, default=names)
+    parser.add_argument('--cohorts', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--cohort-resolution', choices=list(RESOLUTIONS), default='small')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--save', help='write the results to this JSON baseline')
+    parser.add_argument('--compare', help='JSON baseline to compare the results to')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help='percentage slower than the baseline that fails --compare')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.only, args.cohorts, args.cohort_resolution, args.repeat)
+
+    if args.save:
+        with open(args.save, 'w') as fp:
+            json.dump({
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'processor': platform.processor(),
+                'cpus': os.cpu_count(),
+                'results': results
+            }, fp, indent=2)
+
+    regressions = list()
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)['results']
+        regressions = compare(results, baseline, args.threshold)
+    for case, result in sorted(results.items()):
+        if 'budget_s' in result and result['median_s'] > result['budget_s']:
+            regressions.append('%s takes %.3f s, over its budget of %g s' % (case, result['median_s'],
+                                                                             result['budget_s']))
+    for regression in regressions:
+        print('REGRESSION: ' + regression)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
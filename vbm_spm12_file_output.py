@@ -1,76 +1,145 @@
 import contextlib,traceback,re,os,shutil
+import vbm_cache
+import vbm_entities_layer
+import vbm_storage
+import vbm_timing
+
+# Subject name of a covariates entry (input file name without directory and extension), .nii.gz or .nii
+SUBJECT_GZ = re.compile(r".*[\\\/]{1}([\w]*).{1}[a-z]*.{1}[a-z]*$", re.DOTALL)
+SUBJECT_GZ_NO_DIR = re.compile(r"([\w]*).{1}[a-z]*.{1}[a-z]*", re.DOTALL)
+SUBJECT_NII = re.compile(r".*[\\\/]{1}([\w]*).{1}[a-z]*$", re.DOTALL)
+SUBJECT_NII_NO_DIR = re.compile(r"([\w]*).{1}[a-z]*", re.DOTALL)
+
+
+def subject_name(subj):
+    """Returns the subject name of the covariates entry subj, the name of its output directory"""
+    file_ext = re.search(r".[0-9a-z]+$", subj, re.MULTILINE).group()
+
+    if file_ext == '.gz':
+        if "/" in subj or "\\" in subj:
+            #If subject file strings have forward or back slashes
+            return SUBJECT_GZ.sub(r"\1", subj, 0).strip()
+        #Otherwise
+        return SUBJECT_GZ_NO_DIR.sub(r"\1", subj, 0).strip()
+
+    if file_ext == '.nii':
+        if "/" in subj or "\\" in subj:
+            #If subject file strings have forward or back slashes
+            return SUBJECT_NII.sub(r"\1", subj, 0).strip()
+        #Otherwise
+        return SUBJECT_NII_NO_DIR.sub(r"\1", subj, 0).strip()
+
+
+def link_file(src, dst):
+    """This function links dst to src: a hard link, a reflink when the filesystem does not allow hard links
+    or a relative symbolic link when dst is on another filesystem
+    """
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+    try:
+        vbm_storage.reflink_file(src, dst)
+        return
+    except (OSError, ImportError):
+        if os.path.isfile(dst):
+            os.remove(dst)
+    os.symlink(os.path.relpath(src, os.path.dirname(dst)), dst)
 
-@contextlib.contextmanager
-
-def make_file_output(write_dir, template_dict, covariates):
-
-    spm12_types = ['Re','c1Re','c2Re','c3Re','c4Re','c5Re','c6Re','mwc1Re','mwc2Re',
-    'mwc3Re','mwc4Re','mwc5Re','mwc6Re','smwc1Re','smwc2Re','smwc3Re','smwc4Re',
-    'smwc5Re','smwc6Re','swc1Re','swc2Re','swc3Re','swc4Re','swc5Re','swc6Re','wc1Re',
-    'wc2Re','wc3Re','wc4Re','wc5Re','wc6Re']
-
-    for type in spm12_types:
-
-
-        basepath = os.path.join(os.path.dirname(write_dir),"vbm_outputs")
-
-        covpath = os.path.join(basepath,'covariates')
-        if os.path.isdir(covpath) == False:
-            os.makedirs(covpath)
-
-        path = os.path.join(basepath,'covariates',type)
-        if os.path.isdir(path) == False:
-            os.makedirs(path)
-
-        fpath = os.path.join(path,"covariates-"+type+".txt")
-        if os.path.isfile(fpath) == False:
-            file = open(fpath,"a+")
-        else:
-            continue
-
-        for i, subj in enumerate(covariates, start=0):
 
-          file_ext = re.search(r".[0-9a-z]+$", subj, re.MULTILINE).group()
-
-          if file_ext == '.gz':
-              if "/" in subj or "\\" in subj:
-                  #If subject file strings have forward or back slashes
-                  subject_str = re.sub(r".*[\\\/]{1}([\w]*).{1}[a-z]*.{1}[a-z]*$", r"\1", subj, 0, re.DOTALL).strip()
-              else:
-                  #Otherwise
-                  subject_str = re.sub(r"([\w]*).{1}[a-z]*.{1}[a-z]*", r"\1", subj, 0, re.DOTALL).strip()
-
-          if file_ext == '.nii':
-              if "/" in subj or "\\" in subj:
-                  #If subject file strings have forward or back slashes
-                  subject_str = re.sub(r".*[\\\/]{1}([\w]*).{1}[a-z]*$", r"\1", subj, 0, re.DOTALL).strip()
-              else:
-                  #Otherwise
-                  subject_str = re.sub(r"([\w]*).{1}[a-z]*", r"\1", subj, 0, re.DOTALL).strip()
-
-          #get src file
-          src = os.path.join(basepath,subject_str,'anat','vbm_spm12',type+'.nii')
-          #Copy src to dst. (cp src dst)
-          filestr = subject_str+'-'+type+'.nii'
-          newfile = os.path.join(path,subject_str+'-'+type+'.nii')
-          shutil.copy(src, newfile)
-
-          values = []
-          row = covariates[subj]
-
-          keys = list(row.keys())
-          keys.insert(0, "filename")
-
-          header = ', '.join(map(str, keys))
-
-          if i == 0:
-              file.write(header+"\r\n")
-
-          for count, key in enumerate(row):
-              values.insert(count, row[key])
-
-          values.insert(0, filestr)
-          values = ', '.join(map(str, values))
-          file.write(values+"\r\n")
+@contextlib.contextmanager
 
-        file.close()
+def make_file_output(write_dir, template_dict, covariates, unchanged=()):
+    """This function writes the covariates file of each spm12 type with a copy of the image of each subject
+    The images of the subjects of unchanged that are already in place are not copied again, the images of subjects
+    and types that are no longer in the output are removed. Images are copied as stored, .nii or .nii.gz (output_storage)
+    With covariates_layout='link' the images are links of the subject outputs (link_file) instead of copies,
+    the archive stores the linked files once (vbm_archive.write_files)
+    """
+    unchanged = set(unchanged)
+    link = template_dict['covariates_layout'] == 'link'
+
+    # Outputs of the output profile with the extra kernels of a smoothing sweep, ex: s8wc1Re
+    spm12_types = vbm_entities_layer.output_types(template_dict['output_profile'],
+                                                  template_dict['FWHM_SMOOTH'])
+
+    basepath = os.path.join(os.path.dirname(write_dir),"vbm_outputs")
+
+    covpath = os.path.join(basepath,'covariates')
+    if os.path.isdir(covpath) == False:
+        os.makedirs(covpath)
+
+    # Subject name and covariate values of each subject, the same in the covariates file of every type
+    index = list()
+    header = None
+    for subj in covariates:
+        row = covariates[subj]
+        if header is None:
+            header = ', '.join(map(str, ["filename"] + list(row.keys())))+"\r\n"
+        name = subject_name(subj)
+        # Form of the images of the subject, the output_storage recorded in its stage manifest
+        storage = vbm_cache.read_manifest(
+            os.path.join(basepath, name, 'anat', template_dict['stage_manifest_name'])).get('output_storage')
+        index.append((subj, name, storage, list(map(str, row.values()))))
+
+    # The images are copied (or linked) first, then the covariates files are written, each phase is timed as its stage
+    outputs = dict()
+    with vbm_timing.stage('file_output_copy') as event:
+        event['copied'] = 0
+        for type in spm12_types:
+
+            path = os.path.join(basepath,'covariates',type)
+            if os.path.isdir(path) == False:
+                os.makedirs(path)
+
+            lines = [header] if header is not None else []
+            written = set()
+
+            for subj, subject_str, storage, values in index:
+
+              #get src file, .nii or .nii.gz (output_storage)
+              src = vbm_storage.image_file(os.path.join(basepath,subject_str,'anat','vbm_spm12',type+'.nii'), storage)
+              image_ext = '.nii.gz' if src.endswith('.gz') else '.nii'
+              #Copy src to dst. (cp src dst), or link it
+              filestr = subject_str+'-'+type+image_ext
+              newfile = os.path.join(path,filestr)
+              if link:
+                  if not (os.path.isfile(newfile) and os.path.samefile(src, newfile)):
+                      if os.path.lexists(newfile):
+                          os.remove(newfile)
+                      link_file(src, newfile)
+                      event['copied'] += 1
+              elif subj not in unchanged or os.path.isfile(newfile) == False or os.path.islink(newfile):
+                  if os.path.lexists(newfile):
+                      # The link of a previous covariates_layout='link' output is replaced, not written through
+                      os.remove(newfile)
+                  shutil.copy(src, newfile)
+                  event['copied'] += 1
+              written.add(filestr)
+
+              lines.append(', '.join([filestr] + values)+"\r\n")
+            outputs[type] = (path, lines, written)
+
+    with vbm_timing.stage('file_output_covariates'):
+        for type, (path, lines, written) in outputs.items():
+
+            # An unchanged covariates file keeps its mtime, the archive reuses its member
+            fpath = os.path.join(path,"covariates-"+type+".txt")
+            content = ''.join(lines)
+            previous = None
+            if os.path.isfile(fpath):
+                with open(fpath, newline='') as file:
+                    previous = file.read()
+            if previous != content:
+                with open(fpath, "w", newline='') as file:
+                    file.write(content)
+
+            for filestr in os.listdir(path):
+                if filestr.endswith(('.nii', '.nii.gz')) and filestr not in written:
+                    os.remove(os.path.join(path, filestr))
+
+        # Types of a previous output, ex: kernels of a previous smoothing sweep
+        for type in os.listdir(covpath):
+            if type not in spm12_types:
+                shutil.rmtree(os.path.join(covpath, type), ignore_errors=True)
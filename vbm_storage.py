@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This layer writes the vbm_spm12 outputs of a subject in the form of output_storage
+
+'nii' keeps the .nii files written by spm. 'nii.gz' compresses them without loss, 'int16.nii.gz' and 'uint8.nii.gz'
+also store the tissue maps (c*, wc*, mwc* and their smoothed s* images, TISSUE_MAP) as 16/8 bit integers with the
+scale factor of the NIfTI header before compressing them. The reoriented scan and other images are only compressed.
+
+The .nii.gz files are written by a block-parallel gzip writer: the image is cut in GZIP_BLOCK blocks that storage_threads
+threads compress (zlib releases the GIL) into one gzip member each. The members are concatenated in order, gzip readers
+(nibabel, python gzip, gunzip) read them as one stream.
+submit runs the storage of a subject in a background thread of the process while the next subject is in spm, wait
+returns once all of them are written. Worker processes of a pool wait at the end of each chunk, so the storage events
+are returned with the chunk, and call wait_at_exit for a chunk that failed. The sizes and wall time of the storage of each subject are kept in its ledger row (storage)
+
+Readers find the outputs of a subject with image_file and image_files: the form of the output_storage recorded in the
+stage manifest of the subject, or the form that exists. store_outputs removes the other form of an image written as
+x.nii and x.nii.gz (ex: by a storage interrupted between the two) only once the form it keeps is verified (verify_image)
+
+stage_input writes the input scan of a subject to its output directory as spm reads it: a reflink (copy on write clone)
+or copy of a .nii input and a .nii.gz input decompressed with its reads and writes overlapped (inflate_file), the image
+is not decoded. The staged scan is never a hard link of the input, so no output shares the inode of a user's scan
+"""
+import os, re, glob, gzip, time, zlib, shutil
+
+# Tissue maps of spm12 outputs, with the smoothing prefix of each kernel of a sweep, ex: c1Re, mwc2Re, s8wc1Re
+TISSUE_MAP = re.compile(r'^(s[\d.x]*)?m?w?c[1-6]')
+
+# Integer type of the tissue maps of each output storage, None keeps the type written by spm
+STORAGE_TYPES = {'nii': None, 'nii.gz': None, 'int16.nii.gz': 'int16', 'uint8.nii.gz': 'uint8'}
+
+# spm data type (spm_type) of the integer types, Smooth writes the smoothed maps in it directly
+SPM_TYPES = {'int16': 4, 'uint8': 2}
+
+# ioctl of Linux that clones a file on copy on write filesystems (reflink), ex: btrfs, xfs
+FICLONE = 0x40049409
+
+# Bytes compressed as one gzip member
+GZIP_BLOCK = 1 << 20
+
+# zlib compression level of the members
+GZIP_LEVEL = 6
+
+# Thread pools of this process by (name, threads): storage of the subjects one after the other (vbm_storage) and
+# compression of the gzip blocks (vbm_gzip). A forked worker process starts its own (pools_pid)
+thread_pools = dict()
+pools_pid = None
+
+# Storage of the subjects submitted and not waited for
+pending = list()
+
+
+def compressed(storage):
+    """Returns True if output_storage writes .nii.gz files"""
+    return storage != 'nii'
+
+
+def spm_data_type(storage):
+    """Returns the spm data type of the smoothed maps of output_storage, None for float32"""
+    return SPM_TYPES.get(STORAGE_TYPES[storage])
+
+
+def thread_pool(name, threads):
+    """Returns the thread pool name of this process with threads threads"""
+    global pools_pid
+    if pools_pid != os.getpid():
+        thread_pools.clear()
+        del pending[:]
+        pools_pid = os.getpid()
+    if (name, threads) not in thread_pools:
+        from concurrent.futures import ThreadPoolExecutor
+        thread_pools[(name, threads)] = ThreadPoolExecutor(max_workers=threads, thread_name_prefix=name)
+    return thread_pools[(name, threads)]
+
+
+def image_file(path, storage=None):
+    """Returns the form of path (x.nii) written by output_storage storage, path.gz when it is compressed
+    Without storage the form that exists, path (written by spm) if both or neither exist
+    """
+    if storage is not None:
+        return path + '.gz' if compressed(storage) else path
+    if not os.path.isfile(path) and os.path.isfile(path + '.gz'):
+        return path + '.gz'
+    return path
+
+
+def image_files(pattern, storage=None):
+    """Returns the images matching pattern (ex: swc1*nii) in the form of image_file, sorted by name"""
+    names = set(glob.glob(pattern)) | set(file[:-3] for file in glob.glob(pattern + '.gz'))
+    return [image_file(path, storage) for path in sorted(names)]
+
+
+def verify_image(path):
+    """Returns True if the image path (x.nii or x.nii.gz) holds the data its header describes
+    A .nii.gz file is read to its end, gzip checks the CRC and size of each member
+    """
+    import numpy as np
+    import nibabel as nib
+    try:
+        header = nib.load(path).header
+        if path.endswith('.gz'):
+            size = 0
+            with gzip.open(path, 'rb') as fp:
+                for block in iter(lambda: fp.read(GZIP_BLOCK), b''):
+                    size += len(block)
+        else:
+            size = os.path.getsize(path)
+    except Exception:
+        return False
+    return size >= int(header['vox_offset']) + header.get_data_dtype().itemsize * int(
+        np.prod(header.get_data_shape()))
+
+
+def write_gzip(path, data, threads):
+    """Writes data to path as gzip members of GZIP_BLOCK bytes compressed by threads threads, path appears atomically"""
+    view = memoryview(data)
+    blocks = [view[start:start + GZIP_BLOCK] for start in range(0, len(view), GZIP_BLOCK)] or [b'']
+    tmp_file = path + '.tmp'
+    with open(tmp_file, 'wb') as fp:
+        for member in thread_pool('vbm_gzip', threads).map(lambda block: gzip.compress(block, GZIP_LEVEL, mtime=0), blocks):
+            fp.write(member)
+    os.replace(tmp_file, path)
+
+
+def compress_image(path, int_type, threads):
+    """This function writes the .nii file path as path.gz and removes it
+    Tissue maps stored as float are stored as int_type first (None keeps their type)
+    """
+    data = None
+    if int_type is not None and TISSUE_MAP.match(os.path.basename(path)):
+        import numpy as np
+        import nibabel as nib
+        img = nib.load(path)
+        if img.get_data_dtype().kind == 'f':
+            scaled = nib.Nifti1Image(np.asarray(img.dataobj, dtype=np.float32), img.affine, img.header)
+            # nibabel sets the scale factor of the header from the range of the map
+            scaled.set_data_dtype(int_type)
+            data = scaled.to_bytes()
+    if data is None:
+        with open(path, 'rb') as fp:
+            data = fp.read()
+    write_gzip(path + '.gz', data, threads)
+    os.remove(path)
+
+
+def expand_image(path):
+    """This function writes the .nii.gz file path as .nii, removes it and returns the .nii file"""
+    nii_file = path[:-3]
+    with gzip.open(path, 'rb') as src, open(nii_file + '.tmp', 'wb') as dst:
+        shutil.copyfileobj(src, dst, GZIP_BLOCK)
+    os.replace(nii_file + '.tmp', nii_file)
+    os.remove(path)
+    return nii_file
+
+
+def expand_images(files):
+    """This function returns files as .nii files, expanding the .nii.gz ones (spm reads .nii files only)"""
+    return [expand_image(file) if file.endswith('.gz') else file for file in files]
+
+
+def copy_image(src, dst):
+    """This function copies the image src (x.nii or x.nii.gz) to the .nii file dst"""
+    if src.endswith('.gz'):
+        with gzip.open(src, 'rb') as src_fp, open(dst, 'wb') as dst_fp:
+            shutil.copyfileobj(src_fp, dst_fp, GZIP_BLOCK)
+    else:
+        shutil.copy(src, dst)
+
+
+def inflate_file(src, dst):
+    """This function writes the gzip file src decompressed to dst
+    The next block of src is read and the last inflated block written in the threads of vbm_stage while zlib (which
+    releases the GIL) inflates the current one. The members of a multi-member file (write_gzip) are inflated one after
+    the other, zlib checks the CRC and size of each
+    """
+    pool = thread_pool('vbm_stage', 2)
+    inflater = zlib.decompressobj(31)
+    with open(src, 'rb') as src_fp, open(dst, 'wb') as dst_fp:
+        read, write = pool.submit(src_fp.read, GZIP_BLOCK), None
+        while True:
+            block = read.result()
+            if not block:
+                break
+            read = pool.submit(src_fp.read, GZIP_BLOCK)
+            data = inflater.decompress(block)
+            while inflater.eof and inflater.unused_data.strip(b'\0'):
+                block, inflater = inflater.unused_data, zlib.decompressobj(31)
+                data += inflater.decompress(block)
+            if write is not None:
+                write.result()
+            write = pool.submit(dst_fp.write, data)
+        if write is not None:
+            write.result()
+    if not inflater.eof:
+        raise EOFError('compressed file ended before the end-of-stream marker was reached: ' + src)
+
+
+def reflink_file(src, dst):
+    """This function clones src as dst (FICLONE), they share their blocks until one of them is written.
+    Raises OSError when the filesystem cannot clone files or dst is on another filesystem
+    """
+    import fcntl
+    with open(src, 'rb') as src_fp, open(dst, 'wb') as dst_fp:
+        fcntl.ioctl(dst_fp.fileno(), FICLONE, src_fp.fileno())
+
+
+def stage_input(src, dst):
+    """This function writes the input scan src (x.nii or x.nii.gz) as the .nii file dst for spm, without decoding it
+    dst is a file of its own, spm and the storage of the outputs write it without touching src
+    Returns:
+        staging (string): 'reflink' for a clone of src (reflink_file), 'copy' for a copy when the filesystem
+        cannot clone it, 'inflate' for a .nii.gz file decompressed (inflate_file)
+    """
+    tmp_file = dst + '.tmp'
+    if os.path.lexists(tmp_file):
+        os.remove(tmp_file)
+    try:
+        if src.endswith('.gz'):
+            inflate_file(src, tmp_file)
+            staging = 'inflate'
+        else:
+            try:
+                reflink_file(src, tmp_file)
+                staging = 'reflink'
+            except (OSError, ImportError):
+                shutil.copyfile(src, tmp_file)
+                staging = 'copy'
+    except Exception:
+        if os.path.lexists(tmp_file):
+            os.remove(tmp_file)
+        raise
+    # A dst staged by an earlier version may be a hard link to src, it is replaced and not written through
+    os.replace(tmp_file, dst)
+    return staging
+
+
+def store_outputs(out_dir, **template_dict):
+    """This function writes the images of out_dir in the form of output_storage
+    Of an image written as x.nii and x.nii.gz the form of output_storage is kept if verify_image verifies it,
+    else it is written again from the other form
+    Returns:
+        storage (dict): sizes of the images before (bytes_in) and after (bytes_out) and wall time of the storage
+    """
+    start = time.perf_counter()
+    storage = template_dict['output_storage']
+    int_type = STORAGE_TYPES[storage]
+    names = set(file[:-3] if file.endswith('.gz') else file
+                for file in os.listdir(out_dir) if file.endswith(('.nii', '.nii.gz')))
+    bytes_in, bytes_out = 0, 0
+    for name in sorted(names):
+        path = os.path.join(out_dir, name)
+        kept = image_file(path, storage)
+        other = path if kept != path else path + '.gz'
+        if os.path.isfile(kept) and os.path.isfile(other):
+            os.remove(other if verify_image(kept) else kept)
+        kept = image_file(path)
+        bytes_in += os.path.getsize(kept)
+        if compressed(storage) and kept == path:
+            compress_image(path, int_type, int(template_dict['storage_threads']))
+            kept = path + '.gz'
+        elif not compressed(storage) and kept != path:
+            kept = expand_image(kept)
+        bytes_out += os.path.getsize(kept)
+    return {'bytes_in': bytes_in, 'bytes_out': bytes_out, 'wall_s': round(time.perf_counter() - start, 3)}
+
+
+def submit(function, *args):
+    """Runs function(*args) in the background thread of this process, after the functions submitted before"""
+    pending.append(thread_pool('vbm_storage', 1).submit(function, *args))
+
+
+def wait():
+    """Returns once the functions submitted by this process are done"""
+    while pending:
+        pending.pop(0).result()
+
+
+def wait_at_exit():
+    """This function has the worker process wait for the functions it submitted when it exits
+    multiprocessing runs it before the interpreter shuts its thread pools down
+    """
+    import multiprocessing.util
+    multiprocessing.util.Finalize(None, wait, exitpriority=10)
@@ -0,0 +1,1144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This layer runs the subjects of the pre-processing VBM pipeline for the use case layers (vbm_standalone_use_cases_layer
+for the pre-processing computation, vbm_use_cases_layer for the regression one)
+
+Each use case layer builds the pipeline nodes (create_pipeline_nodes) and the list of (sub_id, input) of its subjects,
+then run_subjects runs them serially or in a pool of worker processes, one subject or one cohort batch at a time, and
+records them in the ledger of the run. The use case layer builds its outputs from the ledger.
+With regression_input_dir the regression input file of each subject done is copied to it (copy_regression_file).
+remove_tmp is the function of the use case layer that cleans its temporary files after each subject, it also runs in the
+worker processes of the pool
+"""
+import contextlib
+
+
+@contextlib.contextmanager
+def stdchannel_redirected(stdchannel, dest_filename):
+    """
+    A context manager to temporarily redirect stdout or stderr
+
+    e.g.:
+
+
+    with stdchannel_redirected(sys.stderr, os.devnull):
+        if compiler.has_function('clock_gettime', libraries=['rt']):
+            libraries.append('rt')
+    """
+
+    try:
+        oldstdchannel = os.dup(stdchannel.fileno())
+        dest_file = open(dest_filename, 'w')
+        os.dup2(dest_file.fileno(), stdchannel.fileno())
+
+        yield
+    finally:
+        if oldstdchannel is not None:
+            os.dup2(oldstdchannel, stdchannel.fileno())
+        if dest_file is not None:
+            dest_file.close()
+
+
+import sys, os, glob, shutil, math, warnings, time, traceback
+with warnings.catch_warnings():
+    warnings.filterwarnings("ignore")
+
+import nibabel as nib
+import nipype.pipeline.engine as pe
+import numpy as np
+
+import vbm_entities_layer
+import vbm_cache
+import vbm_ledger
+import vbm_storage
+import vbm_timing
+
+# Number of slices read at once by corr_value
+CORR_SLAB_SLICES = 16
+
+# Grey matter volume and nonzero mask of each TPM file read by this process, by (path, size, mtime)
+tpm_volumes = dict()
+
+#Stop printing nipype.workflow info to stdout
+from nipype import logging
+logging.getLogger('nipype.workflow').setLevel('CRITICAL')
+
+
+def remove_tmp_files():
+    """this function removes the nipype tmp directories of the working directory, the default remove_tmp"""
+
+    for c in glob.glob(os.getcwd() + '/tmp*'):
+        shutil.rmtree(c, ignore_errors=True)
+
+
+def nii_to_image_converter(write_dir, label, **template_dict):
+    """This function converts nifti to png image for displaying on coinstac web gui
+    in this case : wc1*.nii
+    """
+    # nilearn.plotting imports matplotlib and scikit-learn, only needed here
+    from nilearn import plotting
+    file = vbm_storage.image_file(os.path.join(write_dir, template_dict['display_nifti']))
+
+    mask = nib.load(file)
+    new_data = mask.get_fdata()
+    clipped_img = nib.Nifti1Image(new_data, mask.affine, mask.header)
+
+    plotting.plot_anat(
+        clipped_img,
+        cut_coords=(0, 0, 0),
+        annotate=False,
+        draw_cross=False,
+        output_file=os.path.join(write_dir,
+                                 template_dict['display_image_name']),
+        display_mode='ortho',
+        title=label + ' ' + template_dict['display_pngimage_name'],
+        colorbar=False)
+
+
+def tpm_grey_matter(tpm_path):
+    """This function returns the grey matter (first) volume of the TPM file as float32 and its nonzero mask
+    They are read once per process and kept in tpm_volumes
+    """
+    stat = os.stat(tpm_path)
+    key = (tpm_path, stat.st_size, stat.st_mtime)
+    if key not in tpm_volumes:
+        tpm = nib.load(tpm_path)
+        # Slicing dataobj only reads the first volume of the 4D TPM
+        data = tpm.dataobj[..., 0] if len(tpm.shape) == 4 else tpm.dataobj[...]
+        data = np.nan_to_num(np.asarray(data, dtype=np.float32))
+        tpm_volumes[key] = (data, data != 0)
+    return tpm_volumes[key]
+
+
+def corr_value(segmented_file, **template_dict):
+    """This function computes correlation value of the swc1*nii file with spm12/tpm/TPM.nii file from SPM12 toolbox
+    The sums of the correlation are accumulated over slabs of CORR_SLAB_SLICES slices so that the image is never fully loaded
+    """
+    tpm, tpm_mask = tpm_grey_matter(template_dict['tpm_path'])
+    img = nib.load(segmented_file)
+    if img.shape[:3] != tpm.shape:
+        raise ValueError("%s shape %s does not match TPM shape %s" %
+                         (segmented_file, str(img.shape[:3]), str(tpm.shape)))
+
+    # n, sum(a), sum(b), sum(a*a), sum(b*b), sum(a*b) over voxels nonzero in both images
+    n, sums = 0, np.zeros(5)
+    for z in range(0, tpm.shape[2], CORR_SLAB_SLICES):
+        slab = slice(z, z + CORR_SLAB_SLICES)
+        if len(img.shape) == 4:
+            data = img.dataobj[:, :, slab, 0]
+        else:
+            data = img.dataobj[:, :, slab]
+        data = np.nan_to_num(np.asarray(data, dtype=np.float32))
+        indices = np.logical_and(tpm_mask[:, :, slab], data != 0)
+        a = tpm[:, :, slab][indices].astype(np.float64)
+        b = data[indices].astype(np.float64)
+        n += a.size
+        sums += (a.sum(), b.sum(), a.dot(a), b.dot(b), a.dot(b))
+
+    sum_a, sum_b, sum_aa, sum_bb, sum_ab = sums
+    covalue = (sum_ab - sum_a * sum_b / n) / math.sqrt(
+        (sum_aa - sum_a * sum_a / n) * (sum_bb - sum_b * sum_b / n))
+    return covalue
+
+
+def get_corr(segmented_file, **template_dict):
+    """This function writes the correlation value of the swc1*nii file to vbm_qc_filename"""
+    covalue = corr_value(segmented_file, **template_dict)
+    write_path = os.path.dirname(segmented_file)
+
+    with open(os.path.join(write_path, template_dict['vbm_qc_filename']),
+              'w') as fp:
+        fp.write("%3.2f\n" % (covalue))
+        fp.close()
+
+    return covalue
+
+
+def qc_subject(out_dir, **template_dict):
+    """This function computes the correlation value of the subject from its smoothed grey matter (qc_nifti)
+    With a smoothing sweep the correlation value of each extra kernel is appended to vbm_qc_filename after its prefix
+    """
+    segmented_file = vbm_storage.image_files(os.path.join(out_dir, template_dict['qc_nifti']))
+    covalue = get_corr(segmented_file[0], **template_dict)
+
+    for prefix, kernel in vbm_entities_layer.smooth_prefixes(
+            template_dict['FWHM_SMOOTH'])[1:]:
+        # qc_nifti starts with the prefix s of the first kernel
+        segmented_file = vbm_storage.image_files(
+            os.path.join(out_dir, prefix + template_dict['qc_nifti'][1:]))
+        with open(os.path.join(out_dir, template_dict['vbm_qc_filename']),
+                  'a') as fp:
+            fp.write("%s %3.2f\n" % (prefix, corr_value(segmented_file[0], **template_dict)))
+    return covalue
+
+
+def segmented_images(out_dir):
+    """This function returns the wc*, mwc* images of a segmented subject, .nii or .nii.gz (output_storage)"""
+    return vbm_storage.image_files(os.path.join(out_dir, 'wc*.nii')) + vbm_storage.image_files(
+        os.path.join(out_dir, 'mwc*.nii'))
+
+
+def smooth_subject(out_dir, **template_dict):
+    """This function smooths the wc*, mwc* images of a segmented subject with every kernel of FWHM_SMOOTH"""
+    sweep = smooth_sweep(**template_dict)
+    if template_dict['smooth_backend'] == 'python':
+        errors = [
+            error for error in python_smooth(segmented_images(out_dir), **template_dict)
+            if error is not None
+        ]
+        if errors:
+            raise RuntimeError('; '.join(errors))
+    elif sweep is None:
+        smooth_images(out_dir, 'wc*.nii', **template_dict)
+        smooth_images(out_dir, 'mwc*.nii', **template_dict)
+    else:
+        with stdchannel_redirected(sys.stderr, os.devnull):
+            sweep.run(segmented_images(out_dir))
+
+
+def python_smooth(files, **template_dict):
+    """This function smooths files with every kernel of FWHM_SMOOTH with the numpy/scipy port of spm_smooth
+    Returns:
+        errors (list): None for each file that was smoothed, otherwise its error text
+    """
+    import spm_smooth
+    return spm_smooth.smooth_files(
+        files, vbm_entities_layer.smooth_prefixes(template_dict['FWHM_SMOOTH']),
+        template_dict['implicit_masking'], template_dict['smooth_threads'])
+
+
+def smooth_sweep(**template_dict):
+    """This function returns the SmoothSweep of FWHM_SMOOTH, None for a single kernel or for smooth_backend='python'"""
+    if len(vbm_entities_layer.smooth_kernels(template_dict['FWHM_SMOOTH'])) == 1 \
+            or template_dict['smooth_backend'] == 'python':
+        return None
+    return vbm_entities_layer.SmoothSweep(**template_dict)
+
+
+def smooth_cohort(results, errors, **template_dict):
+    """This function smooths the wc*, mwc* images of the subjects of a cohort batch without error in python
+    Returns:
+        errors (list): errors of the batch with the smoothing errors of each subject added
+    """
+    subject_images = [
+        segmented_images(
+            os.path.join(result['vbm_out'], template_dict['vbm_output_dirname']))
+        if error is None else [] for result, error in zip(results, errors)
+    ]
+    smooth_errors = iter(
+        python_smooth(sum(subject_images, []), **template_dict))
+    errors = list(errors)
+    for index, images in enumerate(subject_images):
+        image_errors = [
+            error for error in (next(smooth_errors) for image in images)
+            if error is not None
+        ]
+        if image_errors:
+            errors[index] = '; '.join(image_errors)
+    return errors
+
+
+def smooth_in_workflow(**template_dict):
+    """This function returns True when the spm.Smooth node of the workflow smooths the mwc* images"""
+    return len(vbm_entities_layer.smooth_kernels(template_dict['FWHM_SMOOTH'])) == 1 \
+        and template_dict['smooth_backend'] == 'spm'
+
+
+def flag_subjects(write_dir, sub_ids, **template_dict):
+    """This function writes the subjects with <0.90 correlation value (vbm_ledger.flagged) in the qa_flagged_filename
+    It is called from run_pipeline with the subjects of the run in input order so that serial and parallel runs write the same file
+    """
+    flagged_file = os.path.join(write_dir, template_dict['qa_flagged_filename'])
+    if not sub_ids:
+        # A resumed run does not keep the flags of a previous run
+        if os.path.isfile(flagged_file):
+            os.remove(flagged_file)
+        return
+    with open(flagged_file, 'w') as fp:
+        for sub_id in sub_ids:
+            fp.write("%s\n" % (sub_id))
+
+
+def resample_nifti_images(image_file, voxel_dimensions, resample_method):
+    """Resample the NIfTI images in a folder and put them in a new folder
+    Args:
+        images_location: Path where the images are stored
+        voxel_dimension: tuple (dx, dy, dz)
+        resample_method: NN - Nearest neighbor
+                         Li - Linear interpolation
+    Returns:
+        None:
+    """
+    #Import afni interface to perform resampling
+    from nipype.interfaces import afni
+    try:
+        voxel_size_str = '_{:.0f}mm'.format(float(voxel_dimensions[0]))
+        (file_name, file_ext) = os.path.splitext(image_file)
+        new_file_name = ''.join([file_name, voxel_size_str, file_ext])
+
+        resample = afni.Resample()
+        resample.inputs.environ = {'AFNI_NIFTI_TYPE_WARN': 'NO'}
+        resample.inputs.in_file = image_file
+        resample.inputs.out_file = os.path.join(os.path.dirname(image_file), new_file_name)
+        resample.inputs.voxel_size = voxel_dimensions
+        resample.inputs.outputtype = 'NIFTI'
+        resample.inputs.resample_mode = resample_method
+        resample.run()
+
+        #Delete the image_file as we only use the resampled image
+        if os.path.exists(image_file):os.remove(image_file)
+
+    except Exception as e:
+        sys.stderr.write('Unable to resample regression input file Error_log:' + str(e)+str(traceback.format_exc()))
+
+    return os.path.join(os.path.dirname(image_file), new_file_name)
+
+
+def create_pipeline_nodes(**template_dict):
+    """This function creates and modifies nodes of the pipeline from entities layer with nipype
+    """
+
+    #  Reorientation node and settings #
+    reorient = vbm_entities_layer.Reorient(**template_dict)
+
+    #  Segementation Node and settings #
+    segment = vbm_entities_layer.Segment(**template_dict)
+
+    def create_tissue(tpm_path,
+                      tissue_id,
+                      write_native_maps,
+                      write_dartel_maps,
+                      write_unmodulated_maps,
+                      write_modulated_maps,
+                      num_gaussians=None):
+        """
+        tissue_id is tissue probability image for this class
+        1-grey matter
+        2-white matter
+        3-CSF
+        4-bone
+        5-soft tissues
+        6-air (background)
+
+        write_native_maps,write_dartel_maps- which maps to save [Native, DARTEL] - a tuple of two boolean
+        values
+        write_unmodulated_maps,z-which maps to save [Unmodulated, Modulated] - a tuple of two
+        boolean values
+
+        num_gaussians is the number of Gaussians used to represent the intensity distribution for each type of tissue and can be greater than one.
+        In other words, a tissue probability map may be shared by several clusters. The assumption of
+        a single Gaussian distribution for each class does not hold for a number of reasons.
+        Typical numbers of Gaussians could be 1 for grey matter, 1 for white matter, two for CSF, three for bone, four for other soft tissues and two for air (background).
+        """
+
+        NUM_gaussians = 1
+
+        if num_gaussians is not None:
+            num_gaussians = num_gaussians
+        else:
+            num_gaussians = NUM_gaussians
+        tissue_type = (tpm_path, tissue_id)
+        return (tissue_type, num_gaussians, (write_native_maps,
+                                             write_dartel_maps),
+                (write_unmodulated_maps, write_modulated_maps))
+
+    # Maps of each tissue written with the output profile
+    maps = [
+        vbm_entities_layer.profile_maps(template_dict['output_profile'], tissue_id)
+        for tissue_id in range(1, 7)
+    ]
+
+    Tis1 = create_tissue(
+        tpm_path=template_dict['tpm_path'],
+        tissue_id=1,
+        num_gaussians=1,
+        write_native_maps=maps[0][0],
+        write_dartel_maps=False,
+        write_unmodulated_maps=maps[0][1],
+        write_modulated_maps=maps[0][2],
+    )
+
+    Tis2 = create_tissue(
+        tpm_path=template_dict['tpm_path'],
+        tissue_id=2,
+        num_gaussians=1,
+        write_native_maps=maps[1][0],
+        write_dartel_maps=False,
+        write_unmodulated_maps=maps[1][1],
+        write_modulated_maps=maps[1][2],
+    )
+
+    Tis3 = create_tissue(
+        tpm_path=template_dict['tpm_path'],
+        tissue_id=3,
+        num_gaussians=2,
+        write_native_maps=maps[2][0],
+        write_dartel_maps=False,
+        write_unmodulated_maps=maps[2][1],
+        write_modulated_maps=maps[2][2],
+    )
+
+    Tis4 = create_tissue(
+        tpm_path=template_dict['tpm_path'],
+        tissue_id=4,
+        num_gaussians=3,
+        write_native_maps=maps[3][0],
+        write_dartel_maps=False,
+        write_unmodulated_maps=maps[3][1],
+        write_modulated_maps=maps[3][2],
+    )
+
+    Tis5 = create_tissue(
+        tpm_path=template_dict['tpm_path'],
+        tissue_id=5,
+        num_gaussians=4,
+        write_native_maps=maps[4][0],
+        write_dartel_maps=False,
+        write_unmodulated_maps=maps[4][1],
+        write_modulated_maps=maps[4][2],
+    )
+
+    Tis6 = create_tissue(
+        tpm_path=template_dict['tpm_path'],
+        tissue_id=6,
+        num_gaussians=2,
+        write_native_maps=maps[5][0],
+        write_dartel_maps=False,
+        write_unmodulated_maps=maps[5][1],
+        write_modulated_maps=maps[5][2],
+    )
+    segment.node.inputs.tissues = [Tis1, Tis2, Tis3, Tis4, Tis5, Tis6]
+
+    # Lists normalized images
+    list_norm_images = vbm_entities_layer.List_Normalized_Images()
+
+    #  Smoothing Node & Settings #
+    smooth = vbm_entities_layer.Smooth(**template_dict)
+
+    #  Datsink Node that collects segmented, smoothed files and writes to temp_write_dir #
+    datasink = vbm_entities_layer.Datasink()
+
+    # Create the pipeline/workflow and connect the nodes created above #
+    vbm_preprocess = pe.Workflow(name="vbm_preprocess")
+
+    vbm_preprocess.connect([
+        create_workflow_input(
+            source=reorient.node,
+            target=segment.node,
+            source_output='out_file',
+            target_input='channel_files'),
+        create_workflow_input(
+            source=segment.node,
+            target=datasink.node,
+            source_output='modulated_class_images',
+            target_input=template_dict['vbm_output_dirname']),
+        create_workflow_input(
+            source=segment.node,
+            target=datasink.node,
+            source_output='native_class_images',
+            target_input=template_dict['vbm_output_dirname'] + '.@1'),
+        create_workflow_input(
+            source=segment.node,
+            target=datasink.node,
+            source_output='normalized_class_images',
+            target_input=template_dict['vbm_output_dirname'] + '.@2'),
+        create_workflow_input(
+            source=segment.node,
+            target=datasink.node,
+            source_output='transformation_mat',
+            target_input=template_dict['vbm_output_dirname'] + '.@3')
+    ])
+
+    # A smoothing sweep (several FWHM_SMOOTH kernels) or smooth_backend='python' runs after the workflow, see smooth_subject
+    if smooth_in_workflow(**template_dict):
+        vbm_preprocess.connect([
+            create_workflow_input(
+                source=segment.node,
+                target=list_norm_images.node,
+                source_output='normalized_class_images',
+                target_input='normalized_class_images'),
+            create_workflow_input(
+                source=list_norm_images.node,
+                target=smooth.node,
+                source_output='list_norm_images',
+                target_input='in_files'),
+            create_workflow_input(
+                source=smooth.node,
+                target=datasink.node,
+                source_output='smoothed_files',
+                target_input=template_dict['vbm_output_dirname'] + '.@4')
+        ])
+    return [reorient, datasink, vbm_preprocess]
+
+
+def create_workflow_input(source, target, source_output, target_input):
+    """This function collects pipeline nodes and their connections
+    and returns them in appropriate format for nipype pipeline workflow
+    """
+    return (source, target, [(source_output, target_input)])
+
+
+def smooth_images(write_dir, pattern='mwc*.nii', **template_dict):
+    """This function runs smoothing on input images matching pattern. Ex: modulated images"""
+    from nipype.interfaces.io import DataSink
+    smooth = pe.Node(interface=vbm_entities_layer.SPMSmooth(), name='smooth')
+    smooth.inputs.paths = template_dict['spm_path']
+    smooth.inputs.implicit_masking = template_dict['implicit_masking']
+    smooth.inputs.in_files = glob.glob(os.path.join(write_dir, pattern))
+    smooth.inputs.fwhm = vbm_entities_layer.smooth_kernels(template_dict['FWHM_SMOOTH'])[0]
+    if vbm_storage.spm_data_type(template_dict['output_storage']) is not None:
+        smooth.inputs.data_type = vbm_storage.spm_data_type(template_dict['output_storage'])
+    vbm_smooth_modulated_images = pe.Workflow(
+        name="vbm_smooth_modulated_images")
+    datasink = pe.Node(interface=DataSink(), name='datasink')
+    datasink.inputs.base_directory = write_dir
+    vbm_smooth_modulated_images.connect([(smooth, datasink, [('smoothed_files',
+                                                              write_dir)])])
+    with stdchannel_redirected(sys.stderr, os.devnull):
+        vbm_smooth_modulated_images.run()
+
+
+def stage_input(each_sub, n1_img, nii_file):
+    """This function writes the input scan each_sub (loaded as n1_img) to nii_file, the .nii file spm reads
+    Single file NIfTI inputs are cloned, copied or decompressed as they are (vbm_storage.stage_input), other images are saved by nibabel
+    Returns:
+        staged (dict): input_staging, how the input was written, and volume_copies, the full copies of the image written
+    """
+    if each_sub.endswith(('.nii', '.nii.gz')) and isinstance(n1_img, nib.Nifti1Image):
+        staging = vbm_storage.stage_input(each_sub, nii_file)
+    else:
+        nib.save(n1_img, nii_file)
+        staging = 'nibabel'
+    return {'input_staging': staging, 'volume_copies': int(staging != 'reflink')}
+
+
+def prepare_subject(each_sub, write_dir, result, data_type=None, **template_dict):
+    """This function writes the input scan of one subject to its output directory
+    Returns:
+        nifti_file (string): scan to be reoriented, segmented and smoothed
+    """
+    sub_id = result['sub_id']
+
+    # Assign subject,session id and input nifti file for reorienation node
+
+    if data_type == 'nifti':
+        session = ''
+        # The input file name, as .nii, other formats are saved as <sub_id>.nii
+        nii_output = ((each_sub).split('/')[-1]).split('.gz')[0]
+        if not nii_output.endswith('.nii'):
+            nii_output = sub_id + '.nii'
+        n1_img = nib.load(each_sub)
+
+    if data_type == 'dicoms':
+        session = ''
+        vbm_out = os.path.join(write_dir, sub_id, session, 'anat')
+        os.makedirs(vbm_out, exist_ok=True)
+
+        ## This code runs the dicom to nifti conversion here
+        from nipype.interfaces.spm.utils import DicomImport
+        import nipype.pipeline.engine as pe
+        dcm_nii_convert = pe.Node(
+            interface=DicomImport(), name='converter')
+        dcm_nii_convert.inputs.in_files = glob.glob(
+            os.path.join(each_sub, '*'))
+        dcm_nii_convert.inputs.output_dir = vbm_out
+        with stdchannel_redirected(sys.stderr, os.devnull):
+            dcm_nii_convert.run()
+        n1_img = nib.load(glob.glob(os.path.join(vbm_out, '*.nii'))[0])
+
+    # Directory in which vbm outputs will be written
+    vbm_out = os.path.join(write_dir, sub_id, session, 'anat')
+    result['vbm_out'] = vbm_out
+
+    # Create output dir for sub_id
+    os.makedirs(vbm_out, exist_ok=True)
+
+    if n1_img:
+        """
+        Save nifti file from input data into output directory only if data_type !=dicoms because the dcm_nii_convert in the previous
+        step saves the nifti file to output directory
+         """
+        if data_type != 'dicoms':
+            with vbm_timing.stage('stage_input', sub_id) as staged:
+                staged.update(stage_input(each_sub, n1_img, os.path.join(vbm_out, nii_output)))
+
+        # Create vbm_spm12 dir under the specific sub-id/anat
+        os.makedirs(
+            os.path.join(vbm_out, template_dict['vbm_output_dirname']),
+            exist_ok=True)
+
+        return glob.glob(os.path.join(vbm_out, '*.nii'))[0]
+
+
+def finish_subject(result, **template_dict):
+    """This function computes the correlation value and the display image of a pre-processed subject"""
+    vbm_out = result['vbm_out']
+
+    # Calculate correlation coefficient of swc1*nii to SPM12 TPM.nii
+    with vbm_timing.stage('qc', result['sub_id']):
+        result['covalue'] = qc_subject(
+            os.path.join(vbm_out, template_dict['vbm_output_dirname']),
+            **template_dict)
+
+    # Convert wc1*.nii to wc1*.png
+    label = result['sub_id']
+    with vbm_timing.stage('render', label):
+        nii_to_image_converter(
+            os.path.join(vbm_out, template_dict['vbm_output_dirname']),
+            label, **template_dict)
+
+
+def new_result(sub_id):
+    """This function returns the empty result of the subject sub_id"""
+    return {
+        'sub_id': sub_id,
+        'vbm_out': None,
+        'covalue': None,
+        'error': None,
+        'cache': None,
+        'stages': None
+    }
+
+
+def copy_regression_file(result, regression_input_dir, **template_dict):
+    """This function copies the regression input file of a pre-processed subject to regression_input_dir"""
+    vbm_out = result['vbm_out']
+    sub_id = result['sub_id']
+    session = ''
+
+    # Copy regression input files to regression_input_dir, as .nii whatever the output_storage
+    vbm_storage.copy_image(vbm_storage.image_files(
+        os.path.join(vbm_out, template_dict['vbm_output_dirname'],
+                     template_dict['regression_file_input_type'] + '*.nii'))[0],
+                os.path.join(regression_input_dir,
+                             sub_id + session + '_' + template_dict['regression_file_input_type'] + '.nii'))
+
+    if template_dict['regression_resample_voxel_size'] is not None:
+        # Resample regression file input images for performing regression (for demo purposes)
+        with vbm_timing.stage('resample', sub_id):
+            regression_resampled_file = resample_nifti_images(os.path.join(regression_input_dir,
+                                                                           sub_id + session + '_' + template_dict[
+                                                                               'regression_file_input_type'] + '.nii'),
+                                                              template_dict['regression_resample_voxel_size'],
+                                                              template_dict['regression_resample_method'])
+
+    result['regression_file'] = glob.glob(os.path.join(regression_input_dir,sub_id + session + '_' + template_dict['regression_file_input_type'] + '.nii'))[0]
+
+
+def restore_subject(each_sub, result, **template_dict):
+    """This function restores the outputs of a subject from the result cache
+    Returns:
+        restored (bool): False if the cache is disabled or has no entry for the subject
+    """
+    cache = vbm_cache.get_cache(**template_dict)
+    if cache is None:
+        return False
+    out_dir = os.path.join(result['vbm_out'], template_dict['vbm_output_dirname'])
+    with vbm_timing.stage('cache_restore', result['sub_id']):
+        covalue = cache.restore(cache.key(each_sub, **template_dict), out_dir)
+    if covalue is None:
+        result['cache'] = 'miss'
+        return False
+    result['cache'] = 'hit'
+    result['covalue'] = covalue
+
+    # The display image is labelled with the sub-id, it is not cached
+    with vbm_timing.stage('render', result['sub_id']):
+        nii_to_image_converter(out_dir, result['sub_id'], **template_dict)
+    return True
+
+
+def store_subject(each_sub, result, **template_dict):
+    """This function stores the outputs of a pre-processed subject in the result cache"""
+    cache = vbm_cache.get_cache(**template_dict)
+    if cache is not None:
+        with vbm_timing.stage('cache_store', result['sub_id']):
+            cache.store(
+                cache.key(each_sub, **template_dict),
+                os.path.join(result['vbm_out'], template_dict['vbm_output_dirname']),
+                result['covalue'],
+                exclude=(template_dict['display_image_name'], ))
+
+
+def rerun_subject(each_sub, result, **template_dict):
+    """This function re-runs only the stages of a subject whose inputs or parameters changed since its last run (rerun=True)
+    Returns:
+        rerun (bool): False if reorientation/segmentation have to be recomputed, the subject then needs a full run
+    """
+    if not template_dict['rerun']:
+        return False
+    manifest = vbm_cache.read_manifest(
+        os.path.join(result['vbm_out'], template_dict['stage_manifest_name']))
+    keys = vbm_cache.stage_keys(each_sub, result['sub_id'], **template_dict)
+    out_dir = os.path.join(result['vbm_out'], template_dict['vbm_output_dirname'])
+    if manifest.get('segment') != keys['segment'] or not all(
+            os.path.isfile(os.path.join(out_dir, file))
+            for file in manifest['files']):
+        return False
+
+    if manifest.get('smooth') != keys['smooth']:
+        # Smooth normalized and modulated images again, wc*/mwc* from segmentation are reused
+        with vbm_timing.stage('smooth', result['sub_id'], children=True):
+            remove_smoothed_maps(out_dir)
+            # spm reads .nii files, complete_subject compresses them again
+            vbm_storage.expand_images(segmented_images(out_dir))
+            smooth_subject(out_dir, **template_dict)
+
+    if manifest.get('qc') != keys['qc']:
+        with vbm_timing.stage('qc', result['sub_id']):
+            result['covalue'] = qc_subject(out_dir, **template_dict)
+    else:
+        result['covalue'] = manifest['covalue']
+
+    if manifest.get('render') != keys['render']:
+        with vbm_timing.stage('render', result['sub_id']):
+            nii_to_image_converter(out_dir, result['sub_id'], **template_dict)
+    return True
+
+
+def remove_smoothed_maps(out_dir):
+    """This function removes the smoothed maps of out_dir before they are smoothed again, so that the maps of kernels
+    FWHM_SMOOTH no longer has (ex: s6* of a previous sweep) and the stored form of the others do not remain
+    """
+    for file in os.listdir(out_dir):
+        name = file[:-3] if file.endswith('.gz') else file
+        smoothed = vbm_storage.TISSUE_MAP.match(name)
+        if name.endswith('.nii') and smoothed and smoothed.group(1):
+            os.remove(os.path.join(out_dir, file))
+
+
+def expected_outputs(out_dir, **template_dict):
+    """This function returns the files the stages of a subject write to out_dir: the images of the output profile and
+    smoothing kernels (vbm_entities_layer.output_types) as stored, the segmentation parameters, the correlation value
+    and the display image
+    """
+    files = [
+        os.path.basename(vbm_storage.image_file(os.path.join(out_dir, type + '.nii'), template_dict['output_storage']))
+        for type in vbm_entities_layer.output_types(template_dict['output_profile'], template_dict['FWHM_SMOOTH'])
+    ]
+    return sorted(files + ['Re_seg8.mat', template_dict['vbm_qc_filename'], template_dict['display_image_name']])
+
+
+def write_stage_manifest(each_sub, result, **template_dict):
+    """This function records the stage keys and outputs of a pre-processed subject for rerun_subject"""
+    manifest = vbm_cache.stage_keys(each_sub, result['sub_id'], **template_dict)
+    manifest['covalue'] = result['covalue']
+    # The form of the images, read by vbm_spm12_file_output (vbm_storage.image_file)
+    manifest['output_storage'] = template_dict['output_storage']
+    manifest['files'] = expected_outputs(
+        os.path.join(result['vbm_out'], template_dict['vbm_output_dirname']), **template_dict)
+    vbm_cache.write_manifest(
+        os.path.join(result['vbm_out'], template_dict['stage_manifest_name']),
+        manifest)
+    result['stages'] = manifest
+
+
+def record_subject(result, state, stage=None, **template_dict):
+    """This function writes the state of a subject and the stage it starts to the run ledger of run_pipeline (vbm_ledger.record)"""
+    if template_dict.get('ledger_file'):
+        vbm_ledger.record(template_dict['ledger_file'], result, state, stage)
+
+
+def archive_subjects(archive, write_dir, **template_dict):
+    """This function adds the directories of the subjects recorded done in the ledger to the zip of run_pipeline
+    (vbm_archive.Archive), whose background thread appends the ones not added yet
+    """
+    if archive is not None:
+        archive.add([
+            os.path.join(write_dir, result['sub_id'])
+            for result in vbm_ledger.results(template_dict['ledger_file'])
+            if result['state'] == vbm_ledger.DONE
+        ])
+
+
+def complete_subject(each_sub, result, store=False, **template_dict):
+    """This function writes the outputs of a pre-processed subject in the form of output_storage (vbm_storage.store_outputs),
+    stores them in the result cache when store, writes its stage manifest and records the subject done or failed
+    With a compressed output storage it runs in the background thread of vbm_storage while the next subject is in spm
+    """
+    def complete():
+        try:
+            with vbm_timing.stage('storage', result['sub_id']):
+                result['storage'] = vbm_storage.store_outputs(
+                    os.path.join(result['vbm_out'], template_dict['vbm_output_dirname']), **template_dict)
+            if store:
+                store_subject(each_sub, result, **template_dict)
+            write_stage_manifest(each_sub, result, **template_dict)
+        except Exception as e:
+            result['error'] = str(e)
+        record_subject(result, vbm_ledger.FAILED if result['error'] is not None else vbm_ledger.DONE,
+                       **template_dict)
+
+    if vbm_storage.compressed(template_dict['output_storage']):
+        record_subject(result, vbm_ledger.RUNNING, 'storage', **template_dict)
+        vbm_storage.submit(complete)
+    else:
+        complete()
+
+
+def resume_subjects(write_dir, subjects, record, regression_input_dir=None, **template_dict):
+    """This function returns the results of the (sub_id, subject) done by a previous run of the output directory
+    whose stage keys did not change and whose outputs (and regression input file with regression_input_dir) still exist,
+    run_pipeline does not run them again
+    They are read from the ledger, or from the stage manifest of the subjects of record, the coinstac record of the previous run
+    """
+    ledger_results = {
+        result['sub_id']: result
+        for result in vbm_ledger.results(template_dict['ledger_file'], in_run=False)
+    }
+    done = dict()
+    for sub_id, each_sub in subjects:
+        result = ledger_results.get(sub_id)
+        if result is None or result['state'] != vbm_ledger.DONE or result['input'] != each_sub:
+            if sub_id not in record or record[sub_id]['input'] != each_sub:
+                continue
+            result = new_result(sub_id)
+            result['vbm_out'] = os.path.join(write_dir, sub_id, 'anat')
+            result['stages'] = vbm_cache.read_manifest(
+                os.path.join(result['vbm_out'], template_dict['stage_manifest_name'])) or None
+            result['covalue'] = result['stages'] and result['stages']['covalue']
+            if regression_input_dir is not None:
+                result['regression_file'] = os.path.join(
+                    regression_input_dir, sub_id + '_' + template_dict['regression_file_input_type'] + '.nii')
+        if result['stages'] is None:
+            continue
+        if regression_input_dir is not None and not os.path.isfile(result.get('regression_file') or ''):
+            continue
+        keys = vbm_cache.stage_keys(each_sub, result['sub_id'], **template_dict)
+        out_dir = os.path.join(result['vbm_out'], template_dict['vbm_output_dirname'])
+        if all(result['stages'].get(stage) == key for stage, key in keys.items()) and all(
+                os.path.isfile(os.path.join(out_dir, file))
+                for file in result['stages']['files']):
+            done[each_sub] = result
+    return done
+
+
+def preprocess_subject(nifti_file, result, reorient, datasink, vbm_preprocess,
+                       **template_dict):
+    """This function runs reorientation, segmentation and smoothing of one subject with spm
+    The bytes each stage writes to the outputs of the subject are recorded with its timing (vbm_timing.output_bytes)
+    """
+    vbm_out = result['vbm_out']
+    out_dir = os.path.join(vbm_out, template_dict['vbm_output_dirname'])
+
+    if template_dict['spm_batch'] == 'subject':
+        # Run reorientation, segmentation and smoothing of wc*, mwc* images as one spm batch
+        subject_batch = vbm_entities_layer.SubjectBatch(
+            reorient.node, vbm_preprocess.get_node('segmentation'),
+            vbm_preprocess.get_node('smoothing'),
+            smooth_sweep(**template_dict))
+        with stdchannel_redirected(sys.stderr, os.devnull), \
+                vbm_timing.stage('spm_batch', result['sub_id'], children=True) as written:
+            since = time.time()
+            subject_batch.run(
+                nifti_file, vbm_out + "/" +
+                template_dict['vbm_output_dirname'] + "/Re.nii")
+            written.update(vbm_timing.output_bytes(out_dir, since))
+        if template_dict['smooth_backend'] == 'python':
+            # The batch has no smoothing, smooth wc*, mwc* images in python
+            with vbm_timing.stage('smooth', result['sub_id'], children=True) as written:
+                since = time.time()
+                smooth_subject(out_dir, **template_dict)
+                written.update(vbm_timing.output_bytes(out_dir, since))
+    else:
+        # Edit reorient node inputs
+        reorient.node.inputs.in_file = nifti_file
+        reorient.node.inputs.out_file = vbm_out + "/" + template_dict[
+            'vbm_output_dirname'] + "/Re.nii"
+
+        # Edit datasink node inputs
+        datasink.node.inputs.base_directory = vbm_out
+
+        # Run the nipype pipeline
+        with stdchannel_redirected(sys.stderr, os.devnull), \
+                vbm_timing.stage('spm_workflow', result['sub_id'], children=True) as written:
+            since = time.time()
+            vbm_preprocess.run()
+            written.update(vbm_timing.output_bytes(out_dir, since))
+
+        with vbm_timing.stage('smooth', result['sub_id'], children=True) as written:
+            since = time.time()
+            if smooth_in_workflow(**template_dict):
+                # Smooth modulated images from segmentation node spm.Smooth()
+                smooth_images(out_dir, **template_dict)
+            else:
+                # The workflow has no smoothing node, smooth wc*, mwc* images with all kernels
+                smooth_subject(out_dir, **template_dict)
+            written.update(vbm_timing.output_bytes(out_dir, since))
+
+
+def run_subject(sub_id,
+                each_sub,
+                write_dir,
+                reorient,
+                datasink,
+                vbm_preprocess,
+                data_type=None,
+                regression_input_dir=None,
+                remove_tmp=remove_tmp_files,
+                **template_dict):
+    """This function runs the pipeline on the subject sub_id of input each_sub and returns its result
+    Returns:
+        result (dict): sub_id, vbm_out directory, correlation value (covalue), error text, regression input file and cache hit/miss of the subject
+    """
+    result = new_result(sub_id)
+    store, completing = False, False
+
+    try:
+        record_subject(result, vbm_ledger.RUNNING, 'prepare', **template_dict)
+        with vbm_timing.stage('prepare', result['sub_id']):
+            nifti_file = prepare_subject(each_sub, write_dir, result, data_type,
+                                         **template_dict)
+
+        if nifti_file and not rerun_subject(each_sub, result, **template_dict) \
+                and not restore_subject(each_sub, result, **template_dict):
+            record_subject(result, vbm_ledger.RUNNING, 'spm', **template_dict)
+            preprocess_subject(nifti_file, result, reorient, datasink,
+                               vbm_preprocess, **template_dict)
+            record_subject(result, vbm_ledger.RUNNING, 'qc', **template_dict)
+            finish_subject(result, **template_dict)
+            store = True
+
+        if nifti_file:
+            if regression_input_dir is not None:
+                # The regression input file is copied before the outputs are stored (output_storage)
+                copy_regression_file(result, regression_input_dir, **template_dict)
+            # Records the subject done or failed once its outputs are stored
+            completing = True
+            complete_subject(each_sub, result, store, **template_dict)
+
+    except Exception as e:
+        # If the above code fails for any reason update the error log for the subject id
+        # ex: the nifti file is not a nifti file
+        # the input file is not a brian scan
+        result['error'] = str(e)
+
+    finally:
+        remove_tmp()
+
+    if not completing:
+        record_subject(result, vbm_ledger.FAILED if result['error'] is not None else vbm_ledger.DONE,
+                       **template_dict)
+    return result
+
+
+def run_cohort(chunk,
+               write_dir,
+               reorient,
+               vbm_preprocess,
+               data_type=None,
+               regression_input_dir=None,
+               remove_tmp=remove_tmp_files,
+               **template_dict):
+    """This function runs the pipeline on a chunk of (sub_id, subject) as one stage-major spm batch (spm_batch='cohort')
+    Returns:
+        results (list): result of each subject of the chunk, as from run_subject
+    """
+    results, files = list(), list()
+    # sub-ids of the subjects recorded done or failed by complete_subject
+    completing = set()
+    for sub_id, each_sub in chunk:
+        result = new_result(sub_id)
+        results.append(result)
+        try:
+            record_subject(result, vbm_ledger.RUNNING, 'prepare', **template_dict)
+            with vbm_timing.stage('prepare', result['sub_id']):
+                nifti_file = prepare_subject(each_sub, write_dir, result,
+                                             data_type, **template_dict)
+            if nifti_file and not rerun_subject(each_sub, result, **template_dict) \
+                    and not restore_subject(each_sub, result, **template_dict):
+                files.append((each_sub, result, nifti_file))
+            elif nifti_file:
+                if regression_input_dir is not None:
+                    copy_regression_file(result, regression_input_dir, **template_dict)
+                completing.add(result['sub_id'])
+                complete_subject(each_sub, result, **template_dict)
+        except Exception as e:
+            result['error'] = str(e)
+
+    sub_ids = [result['sub_id'] for each_sub, result, nifti_file in files]
+    for each_sub, result, nifti_file in files:
+        record_subject(result, vbm_ledger.RUNNING, 'spm', **template_dict)
+    try:
+        if files:
+            cohort_batch = vbm_entities_layer.CohortBatch(
+                reorient.node, vbm_preprocess.get_node('segmentation'),
+                vbm_preprocess.get_node('smoothing'),
+                smooth_sweep(**template_dict))
+            with stdchannel_redirected(sys.stderr, os.devnull), \
+                    vbm_timing.stage('spm_cohort_batch', sub_ids, children=True):
+                errors = cohort_batch.run([
+                    (nifti_file, result['vbm_out'] + "/" +
+                     template_dict['vbm_output_dirname'] + "/Re.nii")
+                    for each_sub, result, nifti_file in files
+                ])
+        else:
+            errors = list()
+    except Exception as e:
+        # The matlab run itself failed, none of the subjects completed
+        errors = [str(e)] * len(files)
+
+    if template_dict['smooth_backend'] == 'python':
+        # The batch has no smoothing, smooth the images of all segmented subjects in one thread pool
+        with vbm_timing.stage('smooth', sub_ids, children=True):
+            errors = smooth_cohort([result for each_sub, result, nifti_file in files],
+                                   errors, **template_dict)
+
+    try:
+        for (each_sub, result, nifti_file), error in zip(files, errors):
+            if error is not None:
+                result['error'] = error
+                continue
+            try:
+                record_subject(result, vbm_ledger.RUNNING, 'qc', **template_dict)
+                finish_subject(result, **template_dict)
+                if regression_input_dir is not None:
+                    copy_regression_file(result, regression_input_dir, **template_dict)
+            except Exception as e:
+                result['error'] = str(e)
+                continue
+            completing.add(result['sub_id'])
+            complete_subject(each_sub, result, True, **template_dict)
+    finally:
+        remove_tmp()
+    for result in results:
+        if result['sub_id'] not in completing:
+            record_subject(result, vbm_ledger.FAILED if result['error'] is not None else vbm_ledger.DONE,
+                           **template_dict)
+    return results
+
+
+def run_chunk(chunk,
+              write_dir,
+              reorient,
+              datasink,
+              vbm_preprocess,
+              data_type=None,
+              regression_input_dir=None,
+              remove_tmp=remove_tmp_files,
+              **template_dict):
+    """This function runs the pipeline on a chunk of (sub_id, subject), one cohort batch or one subject after the other"""
+    if template_dict['spm_batch'] == 'cohort':
+        return run_cohort(chunk, write_dir, reorient, vbm_preprocess, data_type,
+                          regression_input_dir, remove_tmp, **template_dict)
+    return [
+        run_subject(sub_id, each_sub, write_dir, reorient, datasink,
+                    vbm_preprocess, data_type, regression_input_dir,
+                    remove_tmp, **template_dict)
+        for sub_id, each_sub in chunk
+    ]
+
+
+# Pipeline nodes of a worker process, created once per worker by init_worker
+worker_nodes = None
+
+
+def init_worker(work_root, template_dict):
+    """This function initializes a worker process of the process pool
+    Each worker works in its own directory and builds its own nodes/workflow from create_pipeline_nodes
+    and launches spm with the MATLAB Runtime cache of the worker slot it claims, or sends its jobs to the spm workers
+    """
+    global worker_nodes
+    import tempfile
+    vbm_timing.configure(**template_dict)
+    vbm_entities_layer.use_spm(template_dict['matlab_cmd'], template_dict['spm_worker_socket'])
+    vbm_storage.wait_at_exit()
+    vbm_cache.use_mcr_cache(template_dict['mcr_cache_dir'],
+                            vbm_cache.claim_mcr_slot(work_root, int(template_dict['max_workers'])))
+    worker_dir = os.path.join(work_root, 'worker_%d' % os.getpid())
+    os.makedirs(worker_dir, exist_ok=True)
+    os.chdir(worker_dir)
+    tempfile.tempdir = worker_dir
+    with vbm_timing.stage('setup'):
+        worker_nodes = create_pipeline_nodes(**template_dict)
+
+
+def run_worker_chunk(chunk, write_dir, data_type, regression_input_dir,
+                     remove_tmp, template_dict):
+    """This function runs one chunk of subjects with the nodes of the current worker process
+    Returns:
+        (results, events): results of the chunk from run_chunk and the timing events recorded by the worker since its
+        last chunk, with the storage of the outputs of the chunk
+    """
+    [reorient, datasink, vbm_preprocess] = worker_nodes
+    results = run_chunk(chunk, write_dir, reorient, datasink, vbm_preprocess,
+                        data_type, regression_input_dir, remove_tmp,
+                        **template_dict)
+    # The outputs of the chunk are stored before its events are returned, their storage events are part of them
+    with vbm_timing.stage('storage_wait'):
+        vbm_storage.wait()
+    return results, vbm_timing.pop_events()
+
+
+def run_subjects(write_dir,
+                 subjects,
+                 reorient,
+                 datasink,
+                 vbm_preprocess,
+                 data_type=None,
+                 archive=None,
+                 regression_input_dir=None,
+                 remove_tmp=remove_tmp_files,
+                 **template_dict):
+    """This function runs the pipeline on all subjects, serially or in a pool of max_workers processes
+    With spm_batch='cohort' the subjects are run in chunks of spm_batch_size, otherwise one at a time
+    The subjects done are added to archive after each chunk (archive_subjects)
+    subjects is the list of (sub_id, subject) to run, the subject is the input scan or dicom directory
+    Returns:
+        results (list): result of each subject from run_subject in the order of subjects
+    """
+    chunk_size = 1
+    if template_dict['spm_batch'] == 'cohort':
+        chunk_size = max(1, int(template_dict['spm_batch_size']))
+    chunks = [
+        subjects[i:i + chunk_size]
+        for i in range(0, len(subjects), chunk_size)
+    ]
+    max_workers = min(int(template_dict['max_workers']), len(chunks))
+
+    if max_workers <= 1:
+        results = list()
+        for chunk in chunks:
+            results.extend(run_chunk(chunk, write_dir, reorient, datasink,
+                                     vbm_preprocess, data_type, regression_input_dir,
+                                     remove_tmp, **template_dict))
+            archive_subjects(archive, write_dir, **template_dict)
+        # Outputs of the last subjects still being stored (output_storage)
+        with vbm_timing.stage('storage_wait'):
+            vbm_storage.wait()
+        return results
+
+    import tempfile
+    from concurrent.futures import ProcessPoolExecutor
+    from concurrent.futures.process import BrokenProcessPool
+    work_root = tempfile.mkdtemp(prefix='vbm_workers_')
+    try:
+        with ProcessPoolExecutor(
+                max_workers=max_workers,
+                initializer=init_worker,
+                initargs=(work_root, template_dict)) as executor:
+            futures = [
+                executor.submit(run_worker_chunk, chunk, write_dir, data_type,
+                                regression_input_dir, remove_tmp, template_dict)
+                for chunk in chunks
+            ]
+            results = list()
+            for chunk, future in zip(chunks, futures):
+                try:
+                    chunk_results, chunk_events = future.result()
+                    results.extend(chunk_results)
+                    vbm_timing.events.extend(chunk_events)
+                except BrokenProcessPool as e:
+                    # The worker process died while running this chunk
+                    for sub_id, each_sub in chunk:
+                        result = new_result(sub_id)
+                        result['error'] = str(e)
+                        record_subject(result, vbm_ledger.FAILED, **template_dict)
+                        results.append(result)
+                archive_subjects(archive, write_dir, **template_dict)
+    finally:
+        # Each chunk is stored before it returns, wait_at_exit stores the subjects of a chunk that failed
+        shutil.rmtree(work_root, ignore_errors=True)
+        remove_tmp()
+    return results
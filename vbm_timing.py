@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This layer records the wall and cpu time of every stage of the pipeline (MCR startup, segmentation, smoothing, QC,
+display image, file output, archive) for every subject
+
+Stages are timed with:
+with vbm_timing.stage('qc', sub_id):
+    ...
+Events are kept per process, worker processes send theirs back with their results (pop_events).
+At the end of a run write_timings writes them to timings_filename, to trace_filename as Chrome trace events
+(open it in chrome://tracing or https://ui.perfetto.dev) and appends a summary per stage to log_filename.
+cpu is the cpu time of the python process, the cpu time of MATLAB/spm child processes is not included
+
+Stages that run spm are timed with children=True, which also records the resources of the MATLAB Runtime processes
+they start: peak RSS sampled from /proc, user/system cpu and read/written bytes from the rusage of waited children.
+metrics_filename lists them per subject to size max_workers from real runs, with the bytes the stages of the subject
+wrote to its output directory and DataSink hard linked into it from the nipype working directory (output_bytes)
+and how its input scan was staged, with the full copies of the image this wrote (stage_input, volume_copies).
+Jobs sent to persistent spm workers (spm_worker=True) run in the worker processes, the server measures each job from
+/proc (process_usage) and spm_worker.submit appends it to the WORKER_USAGE_ENV file of the stage that sent it, which adds
+it to the resources of its child processes.
+These stages also record whether the MATLAB Runtime cache of the process was cold or warm (vbm_cache.mcr_cache_state),
+metrics_filename compares the wall time of cold and warm launches per stage under mcr_launch
+
+With profile_dir set (options_profile) the python stages of PROFILED_STAGES are also run under cProfile and tracemalloc,
+each event writes <stage>-<label>-<pid>.pstats and .tracemalloc files to profile_dir and records its peak python allocation.
+Stages may be profiled in several threads at once (archive_stream in the thread of vbm_archive), cProfile profiles the
+thread of each stage while tracemalloc traces the whole process: the peak of stages that overlap counts the allocations
+of both since the start of the last one.
+When profile_dir is None a stage only checks it, so profiling stays in production code at no cost
+"""
+import os, re, glob, time, resource, tempfile, threading, contextlib
+import ujson as json
+import vbm_cache
+
+# Events recorded by this process since the last reset/pop_events
+events = list()
+
+# Seconds between two samples of the child processes of a stage
+CHILD_SAMPLE_SECONDS = 0.2
+
+# Environment variable naming the file where spm_worker.submit appends the resources of the persistent worker jobs it sent,
+# set by child_resources for the block it measures
+WORKER_USAGE_ENV = 'VBM_SPM_WORKER_USAGE'
+
+# Python stages profiled when profile_dir is set: input nifti copy, QC correlation, display image,
+# regression file resampling, copies of the images and covariates files of the file output, zip archive and the
+# subjects zipped by its background thread while the others run
+PROFILED_STAGES = ('prepare', 'qc', 'render', 'resample', 'file_output_copy', 'file_output_covariates', 'archive',
+                   'archive_stream')
+
+# Directory of the profiles of this process, None disables profiling (set by configure)
+profile_dir = None
+
+# Stages profiled in the threads of this process and whether profiled started tracemalloc, which stops with the last
+profiling = {'count': 0, 'tracemalloc': False}
+profiling_lock = threading.Lock()
+
+
+def configure(**template_dict):
+    """This function enables profiling of PROFILED_STAGES in this process if template_dict has a profile_dir"""
+    global profile_dir
+    profile_dir = template_dict.get('profile_dir')
+    if profile_dir:
+        os.makedirs(profile_dir, exist_ok=True)
+
+
+@contextlib.contextmanager
+def profiled(name, label, usage):
+    """Runs the block under cProfile and tracemalloc, writes their outputs to profile_dir and the peak allocation to usage"""
+    import cProfile, tracemalloc
+    file_name = os.path.join(
+        profile_dir, re.sub(r'[^\w.-]', '_', '%s-%s-%d' % (name, label, os.getpid())))
+    with profiling_lock:
+        if not profiling['count']:
+            profiling['tracemalloc'] = not tracemalloc.is_tracing()
+            if profiling['tracemalloc']:
+                tracemalloc.start()
+        profiling['count'] += 1
+        tracemalloc.reset_peak()
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        with profiling_lock:
+            usage['python_peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 1024.**2, 1)
+            snapshot = tracemalloc.take_snapshot()
+            profiling['count'] -= 1
+            if not profiling['count'] and profiling['tracemalloc']:
+                tracemalloc.stop()
+        snapshot.dump(file_name + '.tracemalloc')
+        profiler.dump_stats(file_name + '.pstats')
+
+
+def proc_values(file, names):
+    """Returns the integer values of names in a /proc key: value file, empty if the process exited"""
+    values = dict()
+    try:
+        with open(file) as fp:
+            for line in fp:
+                key, _, value = line.partition(':')
+                if key in names:
+                    values[key] = int(value.split()[0])
+    except (OSError, ValueError):
+        pass
+    return values
+
+
+def descendants(pid):
+    """Returns the pids of the children of pid and of their children, from the parent pid in /proc/*/stat"""
+    parents = dict()
+    for stat_file in glob.glob('/proc/[0-9]*/stat'):
+        try:
+            with open(stat_file) as fp:
+                # the process name in parenthesis may contain spaces
+                fields = fp.read().rpartition(')')[2].split()
+            parents[int(stat_file.split('/')[2])] = int(fields[1])
+        except (OSError, ValueError, IndexError):
+            continue
+    found, pids = [pid], list()
+    while found:
+        found = [child for child, parent in parents.items() if parent in found]
+        pids.extend(found)
+    return pids
+
+
+def process_usage(pid):
+    """Returns the cpu seconds (with those of waited children), RSS and read/written bytes of pid and its descendants from /proc"""
+    usage = {'user_s': 0., 'sys_s': 0., 'rss_kb': 0, 'read_bytes': 0, 'write_bytes': 0}
+    ticks = os.sysconf('SC_CLK_TCK')
+    for each in [pid] + descendants(pid):
+        try:
+            with open('/proc/%d/stat' % each) as fp:
+                # utime, stime, cutime, cstime are the fields 14 to 17, counted from the state after the name
+                fields = fp.read().rpartition(')')[2].split()
+            usage['user_s'] += (int(fields[11]) + int(fields[13])) / ticks
+            usage['sys_s'] += (int(fields[12]) + int(fields[14])) / ticks
+        except (OSError, ValueError, IndexError):
+            continue
+        usage['rss_kb'] += proc_values('/proc/%d/status' % each, ('VmRSS',)).get('VmRSS', 0)
+        io = proc_values('/proc/%d/io' % each, ('read_bytes', 'write_bytes'))
+        usage['read_bytes'] += io.get('read_bytes', 0)
+        usage['write_bytes'] += io.get('write_bytes', 0)
+    return usage
+
+
+def worker_usage(usage_file):
+    """Returns the resources of the persistent worker jobs appended to usage_file by spm_worker.submit"""
+    jobs = list()
+    if os.path.isfile(usage_file):
+        with open(usage_file) as fp:
+            jobs = [json.loads(line) for line in fp if line.strip()]
+    return jobs
+
+
+class ChildSampler(threading.Thread):
+    """Samples the memory and i/o of the child processes of this process until stop"""
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.peak_rss_kb = 0
+        self.io = dict()
+        self.processes = set()
+        self.stopped = threading.Event()
+
+    def sample(self):
+        rss_kb = 0
+        for pid in descendants(os.getpid()):
+            status = proc_values('/proc/%d/status' % pid, ('VmRSS', 'VmHWM'))
+            rss_kb += status.get('VmRSS', 0)
+            # VmHWM is the peak of one process, it catches peaks between two samples
+            self.peak_rss_kb = max(self.peak_rss_kb, status.get('VmHWM', 0))
+            io = proc_values('/proc/%d/io' % pid, ('read_bytes', 'write_bytes'))
+            if io:
+                self.io[pid] = io
+            self.processes.add(pid)
+        self.peak_rss_kb = max(self.peak_rss_kb, rss_kb)
+
+    def run(self):
+        while not self.stopped.wait(CHILD_SAMPLE_SECONDS):
+            self.sample()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+@contextlib.contextmanager
+def child_resources(usage):
+    """Fills usage with the resources used by the child processes started in the block"""
+    sampler = ChildSampler()
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    fd, usage_file = tempfile.mkstemp(prefix='vbm_worker_usage_')
+    os.close(fd)
+    previous_file = os.environ.get(WORKER_USAGE_ENV)
+    os.environ[WORKER_USAGE_ENV] = usage_file
+    sampler.start()
+    try:
+        yield
+    finally:
+        sampler.stop()
+        if previous_file is None:
+            del os.environ[WORKER_USAGE_ENV]
+        else:
+            os.environ[WORKER_USAGE_ENV] = previous_file
+        jobs = worker_usage(usage_file)
+        os.remove(usage_file)
+        after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        # ru_maxrss of children is the largest child ever waited for, it only tells something when it grew
+        if after.ru_maxrss > before.ru_maxrss:
+            sampler.peak_rss_kb = max(sampler.peak_rss_kb, after.ru_maxrss)
+        usage.update({
+            'peak_rss_mb': round(sampler.peak_rss_kb / 1024., 1),
+            'user_s': round(after.ru_utime - before.ru_utime, 3),
+            'sys_s': round(after.ru_stime - before.ru_stime, 3),
+            # rusage counts blocks of 512 bytes of waited children, /proc samples miss the end of each process
+            'read_bytes': max((after.ru_inblock - before.ru_inblock) * 512,
+                              sum(io.get('read_bytes', 0) for io in sampler.io.values())),
+            'write_bytes': max((after.ru_oublock - before.ru_oublock) * 512,
+                               sum(io.get('write_bytes', 0) for io in sampler.io.values())),
+            'processes': len(sampler.processes)
+        })
+        # Jobs of the persistent spm workers, run by processes that are not children of this one
+        if jobs:
+            usage['peak_rss_mb'] = max([usage['peak_rss_mb']] + [job['peak_rss_mb'] for job in jobs])
+            for key in ('user_s', 'sys_s'):
+                usage[key] = round(usage[key] + sum(job[key] for job in jobs), 3)
+            for key in ('read_bytes', 'write_bytes'):
+                usage[key] += sum(job[key] for job in jobs)
+            usage['worker_jobs'] = len(jobs)
+
+
+@contextlib.contextmanager
+def stage(name, label=None, children=False):
+    """Records the wall and cpu time of the block as an event of stage name
+    label is the sub-id of the stage or the list of sub-ids of a cohort batch,
+    children=True also records the resources of the child processes of the block (child_resources)
+    The block gets a dict of values added to the event, ex: the bytes it wrote (output_bytes)
+    """
+    start, wall, cpu = time.time(), time.perf_counter(), time.process_time()
+    usage, profile, values = dict(), dict(), dict()
+    mcr_cache = vbm_cache.mcr_cache_state() if children else None
+    try:
+        if children:
+            with child_resources(usage):
+                yield values
+        elif profile_dir and name in PROFILED_STAGES:
+            with profiled(name, label, profile):
+                yield values
+        else:
+            yield values
+    finally:
+        event = {
+            'stage': name,
+            'label': label,
+            'pid': os.getpid(),
+            'start': start,
+            'wall': time.perf_counter() - wall,
+            'cpu': time.process_time() - cpu
+        }
+        if children:
+            event['children'] = usage
+        if mcr_cache:
+            event['mcr_cache'] = mcr_cache
+        event.update(profile)
+        event.update(values)
+        events.append(event)
+
+
+def output_bytes(out_dir, since):
+    """Returns the bytes of the files of out_dir changed since the time since: written_bytes written to the directory
+    (by spm, python or a DataSink copy) and linked_bytes hard links of the files of the nipype working directory
+    """
+    written = {'written_bytes': 0, 'linked_bytes': 0}
+    for entry in os.scandir(out_dir):
+        stat = entry.stat()
+        if entry.is_file() and stat.st_ctime >= since:
+            written['linked_bytes' if stat.st_nlink > 1 else 'written_bytes'] += stat.st_size
+    return written
+
+
+def reset():
+    del events[:]
+
+
+def pop_events():
+    """Returns the events recorded by this process and forgets them"""
+    popped = list(events)
+    reset()
+    return popped
+
+
+def summary(timed_events):
+    """Returns the totals and wall time percentiles of each stage, in the order stages first ran"""
+    import numpy as np
+    stages = dict()
+    for event in timed_events:
+        stages.setdefault(event['stage'], list()).append(event)
+
+    lines = [
+        '%-24s %6s %12s %12s %10s %10s %10s %14s %12s' %
+        ('stage', 'count', 'wall_s', 'cpu_s', 'p50_s', 'p90_s', 'max_s', 'child_rss_mb', 'child_cpu_s')
+    ]
+    for name, stage_events in stages.items():
+        walls = np.array([event['wall'] for event in stage_events])
+        lines.append('%-24s %6d %12.2f %12.2f %10.2f %10.2f %10.2f %14.1f %12.2f' % (
+            name, len(walls), walls.sum(),
+            sum(event['cpu'] for event in stage_events),
+            np.percentile(walls, 50), np.percentile(walls, 90), walls.max(),
+            max(event.get('children', {}).get('peak_rss_mb', 0) for event in stage_events),
+            sum(event.get('children', {}).get('user_s', 0) + event.get('children', {}).get('sys_s', 0)
+                for event in stage_events)))
+    return '\n'.join(lines) + '\n'
+
+
+def chrome_trace(timed_events):
+    """Returns the events in Chrome trace event format, one row per process"""
+    origin = min([event['start'] for event in timed_events] or [0])
+    return {
+        'traceEvents': [{
+            'name': event['stage'],
+            'cat': 'vbm',
+            'ph': 'X',
+            'ts': int((event['start'] - origin) * 1e6),
+            'dur': int(event['wall'] * 1e6),
+            'pid': event['pid'],
+            'tid': event['pid'],
+            'args': {
+                'label': event['label'],
+                'cpu_s': round(event['cpu'], 6)
+            }
+        } for event in timed_events],
+        'displayTimeUnit': 'ms'
+    }
+
+
+def subject_metrics(timed_events):
+    """Returns the child process resources of the stages of each subject, stages without a sub-id are listed under run
+    A cohort batch is listed under each of its subjects with the number of subjects that shared it
+    The bytes written to and linked into the output directory of each subject are summed over its stages (output_bytes),
+    volume_copies counts the full copies of its input scan written to stage it for spm (stage_input)
+    """
+    metrics = {'subjects': dict(), 'run': list(), 'mcr_launch': mcr_launch(timed_events)}
+
+    def new_subject():
+        return {'peak_rss_mb': 0, 'written_bytes': 0, 'linked_bytes': 0, 'volume_copies': 0, 'stages': list()}
+
+    for event in timed_events:
+        if 'written_bytes' in event and isinstance(event['label'], str):
+            subject = metrics['subjects'].setdefault(event['label'], new_subject())
+            subject['written_bytes'] += event['written_bytes']
+            subject['linked_bytes'] += event['linked_bytes']
+        if 'volume_copies' in event and isinstance(event['label'], str):
+            subject = metrics['subjects'].setdefault(event['label'], new_subject())
+            subject['volume_copies'] += event['volume_copies']
+            subject['input_staging'] = event['input_staging']
+        if 'children' not in event:
+            continue
+        entry = dict(event['children'], stage=event['stage'], wall_s=round(event['wall'], 3))
+        if 'mcr_cache' in event:
+            entry['mcr_cache'] = event['mcr_cache']
+        if 'written_bytes' in event:
+            entry.update(written_bytes=event['written_bytes'], linked_bytes=event['linked_bytes'])
+        if event['label'] is None:
+            metrics['run'].append(entry)
+            continue
+        labels = event['label'] if isinstance(event['label'], list) else [event['label']]
+        for label in labels:
+            subject = metrics['subjects'].setdefault(label, new_subject())
+            subject['stages'].append(dict(entry, shared_by=len(labels)))
+            subject['peak_rss_mb'] = max(subject['peak_rss_mb'], entry['peak_rss_mb'])
+    return metrics
+
+
+def mcr_launch(timed_events):
+    """Returns the count and mean/min wall time of the spm stages launched with a cold and with a warm MATLAB Runtime cache"""
+    launches = dict()
+    for event in timed_events:
+        if 'mcr_cache' in event:
+            launches.setdefault(event['stage'], dict()).setdefault(event['mcr_cache'], list()).append(event['wall'])
+    return {
+        name: {
+            state: {
+                'count': len(walls),
+                'mean_wall_s': round(sum(walls) / len(walls), 3),
+                'min_wall_s': round(min(walls), 3)
+            } for state, walls in states.items()
+        } for name, states in launches.items()
+    }
+
+
+def write_timings(out_dir, log_dir, **template_dict):
+    """This function writes the events of the run and the child resources of each subject to out_dir
+    and appends their summary to the log file of log_dir, log_dir=None only writes out_dir
+    """
+    with open(os.path.join(out_dir, template_dict['timings_filename']), 'w') as fp:
+        json.dump({'events': events}, fp)
+    with open(os.path.join(out_dir, template_dict['trace_filename']), 'w') as fp:
+        json.dump(chrome_trace(events), fp)
+    with open(os.path.join(out_dir, template_dict['metrics_filename']), 'w') as fp:
+        json.dump(subject_metrics(events), fp)
+    if log_dir is None:
+        return
+    os.makedirs(log_dir, exist_ok=True)
+    with open(os.path.join(log_dir, template_dict['log_filename']), 'a') as fp:
+        fp.write('\nTimings per stage (' + template_dict['timings_filename'] + '):\n')
+        fp.write(summary(events))